@@ -0,0 +1,304 @@
+import os
+import json
+import shutil
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from json_parsing import OUTPUT_FIELDS
+
+INPUT_DIR = Path("finetuning_samples")
+PATTERN = "*_final_samples.jsonl"
+MERGED_FILE = "merged_finetuning_samples.jsonl"
+CLEANED_FILE = "merged_finetuning_samples_cleaned.jsonl"
+QUARANTINE_FILE = "merged_finetuning_samples_quarantine.jsonl"
+SHARDS_DIR = "dataset_shards"
+SHARD_ROWS = 50_000
+
+# Схема записи, которую пишет dataset_pipeline.build_record
+RECORD_FIELDS = {"instruction": str, "input": str, "chunk_id": int, "source_file": str}
+
+
+def validate_record(record) -> str:
+    """
+    Проверяет запись по схеме instruction/input/output/chunk_id/source_file.
+    Возвращает причину отказа или None, если запись годится для обучения.
+    """
+    if not isinstance(record, dict):
+        return "not_an_object"
+    if "raw_response" in record:
+        return "raw_response"
+    for field, field_type in RECORD_FIELDS.items():
+        value = record.get(field)
+        # bool — подкласс int, но chunk_id=True явно ошибка
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            return f"bad_{field}"
+    if not record["input"].strip():
+        return "empty_input"
+    output = record.get("output")
+    if not output:
+        return "empty_output"
+    if not isinstance(output, dict):
+        return "bad_output"
+    for field in OUTPUT_FIELDS:
+        values = output.get(field)
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            return f"bad_output_{field}"
+    return None
+
+
+def validate_file(path: Path) -> dict:
+    """
+    Читает и проверяет один *_samples.jsonl (выполняется в дочернем процессе).
+    merged — все непустые строки как есть, valid — прошедшие проверку записи,
+    quarantine — {"reason", "file", "line", "record"|"text"} для остальных.
+    """
+    merged, valid, quarantine = [], [], []
+    with path.open("r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            merged.append(line)
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                quarantine.append({"reason": "invalid_json", "file": path.name, "line": line_no, "text": line})
+                continue
+            reason = validate_record(record)
+            if reason is None:
+                valid.append(record)
+            else:
+                quarantine.append({"reason": reason, "file": path.name, "line": line_no, "record": record})
+    return {"merged": merged, "valid": valid, "quarantine": quarantine}
+
+
+def open_atomic(path: Path):
+    return path.with_name(path.name + ".tmp").open("w", encoding="utf-8")
+
+
+def commit_atomic(handle, path: Path):
+    handle.flush()
+    os.fsync(handle.fileno())
+    handle.close()
+    os.replace(handle.name, path)
+
+
+def abort_atomic(handle):
+    """
+    Закрывает и удаляет недописанный временный файл open_atomic; целевой файл не меняется.
+    """
+    handle.close()
+    Path(handle.name).unlink(missing_ok=True)
+
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Для Arrow/Parquet-шардов установите пакет pyarrow.") from e
+    return pyarrow
+
+
+def arrow_schema(pa):
+    return pa.schema([
+        ("instruction", pa.string()),
+        ("input", pa.string()),
+        ("output", pa.struct([(field, pa.list_(pa.string())) for field in OUTPUT_FIELDS])),
+        ("chunk_id", pa.int64()),
+        ("source_file", pa.string()),
+    ])
+
+
+class ShardWriter:
+    """
+    Копит проверенные записи и сбрасывает их шардами по shard_rows строк:
+    part-NNNNN.arrow (Arrow IPC file, открывается через memory map без копирования)
+    и/или part-NNNNN.parquet. В конце пишет manifest.json со списком шардов.
+
+    Шарды и manifest пишутся в соседнюю временную папку .<имя>.tmp, которая в close()
+    подменяет shards_dir целиком; до этого старые шарды остаются нетронутыми. Поэтому
+    shards_dir должна принадлежать только сборке датасета.
+    """
+
+    def __init__(self, shards_dir: Path, formats: tuple, shard_rows: int = SHARD_ROWS):
+        self.pa = load_pyarrow()
+        self.schema = arrow_schema(self.pa)
+        self.shards_dir = Path(shards_dir)
+        self.tmp_dir = self.shards_dir.with_name(f".{self.shards_dir.name}.tmp")
+        self.old_dir = self.shards_dir.with_name(f".{self.shards_dir.name}.old")
+        self.formats = formats
+        self.shard_rows = max(1, shard_rows)
+        self.rows = []
+        self.shards = []
+        self.recover()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.tmp_dir.mkdir(parents=True)
+
+    def recover(self):
+        """
+        Доводит подмену, прерванную падением между двумя rename в close():
+        если shards_dir уже убрана в .old, а новая не на месте, возвращает старую.
+        """
+        if self.old_dir.is_dir():
+            if self.shards_dir.exists():
+                shutil.rmtree(self.old_dir)
+            else:
+                os.replace(self.old_dir, self.shards_dir)
+
+    def add(self, record: dict):
+        self.rows.append({field: record[field] for field in self.schema.names})
+        if len(self.rows) >= self.shard_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        stem = f"part-{len(self.shards):05d}"
+        files = []
+        if "arrow" in self.formats:
+            path = self.tmp_dir / f"{stem}.arrow"
+            with self.pa.OSFile(str(path), "wb") as sink, self.pa.ipc.new_file(sink, self.schema) as writer:
+                writer.write_table(table)
+            files.append(path.name)
+        if "parquet" in self.formats:
+            path = self.tmp_dir / f"{stem}.parquet"
+            self.pa.parquet.write_table(table, str(path))
+            files.append(path.name)
+        self.shards.append({"files": files, "rows": table.num_rows})
+        self.rows = []
+
+    def close(self) -> dict:
+        self.flush()
+        manifest = {
+            "formats": list(self.formats),
+            "rows": sum(shard["rows"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        (self.tmp_dir / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2),
+                                                    encoding="utf-8")
+        if self.shards_dir.exists():
+            os.replace(self.shards_dir, self.old_dir)
+        os.replace(self.tmp_dir, self.shards_dir)
+        shutil.rmtree(self.old_dir, ignore_errors=True)
+        return manifest
+
+    def abort(self):
+        """
+        Отбрасывает недописанные шарды, старые остаются на месте.
+        """
+        self.rows = []
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def load_dataset(shards_dir: Path = Path(SHARDS_DIR)):
+    """
+    Загружает Arrow-шарды как одну pyarrow.Table. Файлы отображаются в память,
+    данные не копируются и не разбираются повторно.
+    """
+    pa = load_pyarrow()
+    tables = [
+        pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+        for path in sorted(Path(shards_dir).glob("part-*.arrow"))
+    ]
+    if not tables:
+        return arrow_schema(pa).empty_table()
+    return pa.concat_tables(tables)
+
+
+def resolve_formats(columnar: str) -> tuple:
+    """
+    Форматы шардов. По умолчанию Arrow, если установлен pyarrow, иначе только JSONL;
+    явно запрошенный формат без pyarrow — ошибка.
+    """
+    if columnar is None:
+        try:
+            load_pyarrow()
+        except RuntimeError:
+            print("pyarrow не установлен — Arrow-шарды не пишутся, только JSONL.")
+            return ()
+        return ("arrow",)
+    return {"none": (), "arrow": ("arrow",), "parquet": ("parquet",), "both": ("arrow", "parquet")}[columnar]
+
+
+def assemble(files: list, output_dir: Path, jobs: int = 1, formats: tuple = (), shards_dir: Path = None,
+             shard_rows: int = SHARD_ROWS) -> dict:
+    """
+    Проверяет файлы в jobs процессах и пишет (атомарно) объединённый, очищенный
+    и карантинный JSONL, а также колоночные шарды. Порядок записей — порядок файлов и строк.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    merged_path = output_dir / MERGED_FILE
+    cleaned_path = output_dir / CLEANED_FILE
+    quarantine_path = output_dir / QUARANTINE_FILE
+    shards = ShardWriter(shards_dir or output_dir / SHARDS_DIR, formats, shard_rows) if formats else None
+
+    counts = {"files": len(files), "lines": 0, "valid": 0, "quarantined": 0, "reasons": {}}
+    merged_out, cleaned_out, quarantine_out = open_atomic(merged_path), open_atomic(cleaned_path), open_atomic(quarantine_path)
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+            # map сохраняет порядок файлов, хотя проверяются они параллельно
+            for path, result in zip(files, pool.map(validate_file, files)):
+                print(f"Обработка файла: {path.name}")
+                for line in result["merged"]:
+                    merged_out.write(line + "\n")
+                for record in result["valid"]:
+                    cleaned_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    if shards:
+                        shards.add(record)
+                for entry in result["quarantine"]:
+                    quarantine_out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    counts["reasons"][entry["reason"]] = counts["reasons"].get(entry["reason"], 0) + 1
+                counts["lines"] += len(result["merged"])
+                counts["valid"] += len(result["valid"])
+                counts["quarantined"] += len(result["quarantine"])
+    except BaseException:
+        for handle in (merged_out, cleaned_out, quarantine_out):
+            abort_atomic(handle)
+        if shards:
+            shards.abort()
+        raise
+    for handle, path in ((merged_out, merged_path), (cleaned_out, cleaned_path), (quarantine_out, quarantine_path)):
+        commit_atomic(handle, path)
+    if shards:
+        counts["shards"] = shards.close()
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сборка датасета из finetuning_samples/*.jsonl.")
+    parser.add_argument("--input-dir", default=str(INPUT_DIR), help="папка с *_samples.jsonl")
+    parser.add_argument("--pattern", default=PATTERN, help="шаблон имён входных файлов")
+    parser.add_argument("--output-dir", default=".", help="куда писать объединённый, очищенный и карантинный JSONL")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="число процессов для проверки файлов")
+    parser.add_argument("--columnar", choices=["none", "arrow", "parquet", "both"],
+                        help="колоночные шарды (по умолчанию arrow, если установлен pyarrow)")
+    parser.add_argument("--shards-dir", help=f"папка шардов (по умолчанию <output-dir>/{SHARDS_DIR})")
+    parser.add_argument("--shard-rows", type=int, default=SHARD_ROWS, help="строк в одном шарде")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    files = sorted(Path(args.input_dir).glob(args.pattern))
+    print(f"Найдено файлов: {len(files)}")
+    formats = resolve_formats(args.columnar)
+    output_dir = Path(args.output_dir)
+    counts = assemble(files, output_dir, args.jobs, formats,
+                      Path(args.shards_dir) if args.shards_dir else None, args.shard_rows)
+
+    print(f"Итоговый объединённый файл сохранён: {output_dir / MERGED_FILE}")
+    print(f"Обработка завершена: из {counts['lines']} строк осталось {counts['valid']} строк. "
+          f"Очищённый файл сохранён: {output_dir / CLEANED_FILE}")
+    if counts["quarantined"]:
+        reasons = ", ".join(f"{reason}={count}" for reason, count in sorted(counts["reasons"].items()))
+        print(f"В карантин ({output_dir / QUARANTINE_FILE}): {counts['quarantined']} ({reasons})")
+    if "shards" in counts:
+        print(f"Шарды {', '.join(formats)}: {len(counts['shards']['shards'])}, строк {counts['shards']['rows']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк стадий подготовки данных на синтетическом корпусе.
+
+Генерирует пары "диаризация .txt + транскрипция .docx" заданной длительности,
+прогоняет по ним parse_diarization_file, parse_transcription_docx / iter_transcription_docx,
+match_segments, assign_roles, merge_consecutive_segments, chunk_dialogue и
+build_input_from_chunk и сохраняет время и пиковую память каждой стадии в JSON.
+
+Примеры:
+    python benchmark.py --minutes 10 60 600
+    python benchmark.py --minutes 60 --speakers 3 --noise-ms 400 --output bench.json
+    python benchmark.py --minutes 60 --baseline bench_prev.json --max-slowdown 1.5
+"""
+import gc
+import sys
+import json
+import time
+import random
+import logging
+import zipfile
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import data_preparation
+from data_preparation import (
+    format_timestamp_ms,
+    parse_diarization_file,
+    parse_transcription_docx,
+    iter_transcription_docx,
+    match_segments,
+    assign_roles,
+    merge_consecutive_segments,
+    process_pair,
+    output_paths,
+    TOLERANCE_RATIO,
+)
+from dataset_pipeline import chunk_dialogue, build_input_from_chunk
+
+WORDS = [
+    "требования", "система", "интеграция", "заказчик", "процесс", "документация", "данные",
+    "архитектура", "сервис", "команда", "аналитик", "проект", "нагрузка", "спецификация",
+    "база", "модель", "сценарий", "пользователь", "API", "очередь", "согласование", "релиз",
+]
+QUESTION_OPENERS = [
+    "Расскажи", "Объясни", "Опиши", "Приведи пример", "Почему", "Что именно", "Какие технологии",
+]
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+_DOCUMENT_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+)
+_DOCUMENT_TAIL = '</w:body></w:document>'
+
+
+def _random_text(rng: random.Random, is_question: bool) -> str:
+    words = rng.choices(WORDS, k=rng.randint(4, 40))
+    if is_question:
+        return f"{rng.choice(QUESTION_OPENERS)}, {' '.join(words)}?"
+    return " ".join(words).capitalize() + "."
+
+
+def generate_pair(base_dir: Path, name: str, minutes: float, speakers: int = 2, noise_ms: int = 200,
+                  seed: int = 0) -> tuple:
+    """
+    Пишет синтетическую пару файлов в формате raw_data и возвращает (diar_file, trans_file).
+
+    - первый спикер — интервьюер (короткие вопросы с ключевыми словами), второй — кандидат,
+      остальные изредка вставляют короткие реплики; при speakers=1 говорит только первый;
+    - границы диаризации сдвинуты относительно транскрипции на случайный шум до noise_ms,
+      иногда реплика режется диаризацией на две части;
+    - docx и txt пишутся потоково, поэтому можно генерировать и 1000 часов.
+    """
+    rng = random.Random(seed)
+    base_dir.mkdir(parents=True, exist_ok=True)
+    diar_file = base_dir / f"{name}_diarization_processed_final.txt"
+    trans_file = base_dir / f"{name}_cleaned_final.docx"
+    total_ms = int(minutes * 60_000)
+
+    with diar_file.open("w", encoding="utf-8") as diar_out, \
+            zipfile.ZipFile(trans_file, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        archive.writestr("_rels/.rels", _RELS)
+        with archive.open("word/document.xml", "w") as doc_out:
+            doc_out.write(_DOCUMENT_HEAD.encode("utf-8"))
+            now = rng.randint(0, 2000)
+            turn = 0
+            while now < total_ms:
+                if speakers > 2 and rng.random() < 0.05:
+                    speaker = rng.randint(2, speakers - 1)
+                else:
+                    speaker = turn % min(2, speakers)
+                is_question = speaker == 0
+                duration = rng.randint(2_000, 12_000) if is_question else rng.randint(5_000, 60_000)
+                start, end = now, min(now + duration, total_ms)
+                text = _random_text(rng, is_question)
+
+                line = f"{format_timestamp_ms(start)} - {format_timestamp_ms(end)} - {escape(text)}"
+                doc_out.write(f"<w:p><w:r><w:t>{line}</w:t></w:r></w:p>".encode("utf-8"))
+
+                # Диаризация: шум на границах и иногда разрез реплики на два сегмента
+                d_start = max(0, start + rng.randint(-noise_ms, noise_ms))
+                d_end = max(d_start + 1, end + rng.randint(-noise_ms, noise_ms))
+                cuts = [d_start, d_end]
+                if d_end - d_start > 10_000 and rng.random() < 0.2:
+                    cuts.insert(1, rng.randint(d_start + 1, d_end - 1))
+                for seg_start, seg_end in zip(cuts, cuts[1:]):
+                    diar_out.write(
+                        f"{format_timestamp_ms(seg_start)} - {format_timestamp_ms(seg_end)} - "
+                        f"speaker_SPEAKER_{speaker:02d}\n"
+                    )
+
+                now = end + rng.randint(100, 1500)
+                turn += 1
+            doc_out.write(_DOCUMENT_TAIL.encode("utf-8"))
+    return diar_file, trans_file
+
+
+def _measure(func, track_memory: bool):
+    """
+    Один прогон функции: (результат, секунды, пиковые байты или None).
+    Время и память меряются в разных прогонах, чтобы tracemalloc не искажал время.
+    """
+    gc.collect()
+    if track_memory:
+        tracemalloc.start()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, None, peak
+    started = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - started, None
+
+
+def _process_pair_outputs(diar_file: Path, trans_file: Path) -> list:
+    out_dir = diar_file.parent / "prepared_data"
+    out_dir.mkdir(exist_ok=True)
+    process_pair(diar_file, trans_file, out_dir)
+    return output_paths(diar_file.name.split("_diarization")[0], out_dir)
+
+
+def benchmark_pair(diar_file: Path, trans_file: Path, repeat: int = 1, track_memory: bool = True,
+                   skip_python_docx: bool = False) -> dict:
+    """
+    Прогоняет все стадии по одной паре файлов. Для времени берётся лучший из repeat прогонов.
+    """
+    stages = [
+        ("parse_diarization_file", lambda inputs: parse_diarization_file(diar_file)),
+        ("iter_transcription_docx", lambda inputs: list(iter_transcription_docx(trans_file))),
+    ]
+    if not skip_python_docx:
+        stages.append(("parse_transcription_docx", lambda inputs: parse_transcription_docx(trans_file)))
+    stages += [
+        ("match_segments", lambda inputs: match_segments(
+            inputs["iter_transcription_docx"], inputs["parse_diarization_file"], TOLERANCE_RATIO)),
+        ("assign_roles", lambda inputs: assign_roles(inputs["match_segments"])),
+        ("merge_consecutive_segments", lambda inputs: merge_consecutive_segments(inputs["assign_roles"])),
+        ("chunk_dialogue", lambda inputs: list(chunk_dialogue(
+            [seg.to_dict() for seg in inputs["merge_consecutive_segments"]], chunk_size=4))),
+        ("build_input_from_chunk", lambda inputs: [build_input_from_chunk(chunk) for chunk in inputs["chunk_dialogue"]]),
+        # Весь потоковый конвейер data_preparation целиком, с записью обоих JSON
+        ("process_pair", lambda inputs: _process_pair_outputs(diar_file, trans_file)),
+    ]
+
+    inputs = {}
+    results = {}
+    for name, stage in stages:
+        best = None
+        for _ in range(max(1, repeat)):
+            output, seconds, _ = _measure(lambda: stage(inputs), track_memory=False)
+            best = seconds if best is None else min(best, seconds)
+        peak = None
+        if track_memory:
+            _, _, peak = _measure(lambda: stage(inputs), track_memory=True)
+        inputs[name] = output
+        results[name] = {"seconds": round(best, 6), "peak_bytes": peak, "items": len(output)}
+        print(f"  {name}: {best:.3f} s, peak={peak}, items={len(output)}")
+    return results
+
+
+def compare_with_baseline(current: dict, baseline: dict, max_slowdown: float) -> list:
+    """
+    Возвращает список регрессий: стадии, которые стали медленнее baseline более чем в max_slowdown раз.
+    Сравниваются только прогоны с одинаковой конфигурацией корпуса.
+    """
+    regressions = []
+    baseline_runs = {json.dumps(run["config"], sort_keys=True): run for run in baseline.get("runs", [])}
+    for run in current["runs"]:
+        previous = baseline_runs.get(json.dumps(run["config"], sort_keys=True))
+        if not previous:
+            continue
+        for stage, stats in run["stages"].items():
+            before = previous["stages"].get(stage)
+            if not before or not before["seconds"]:
+                continue
+            ratio = stats["seconds"] / before["seconds"]
+            if ratio > max_slowdown:
+                regressions.append(
+                    f"{run['config']['minutes']} мин, {stage}: {before['seconds']:.3f} s -> "
+                    f"{stats['seconds']:.3f} s (x{ratio:.2f})"
+                )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк стадий подготовки данных на синтетическом корпусе.")
+    parser.add_argument("--minutes", type=float, nargs="+", default=[10, 60, 600],
+                        help="длительности синтетических интервью в минутах (1000 часов = 60000)")
+    parser.add_argument("--speakers", type=int, default=2, help="число спикеров в диаризации (не меньше 1)")
+    parser.add_argument("--noise-ms", type=int, default=200, help="шум границ диаризации в миллисекундах")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="сколько раз мерить время каждой стадии")
+    parser.add_argument("--no-memory", action="store_true", help="не мерить пиковую память (tracemalloc)")
+    parser.add_argument("--skip-python-docx", action="store_true",
+                        help="не мерить parse_transcription_docx (на больших корпусах очень медленно)")
+    parser.add_argument("--workdir", help="куда писать синтетические файлы (по умолчанию временная папка)")
+    parser.add_argument("--output", default="benchmark_results.json", help="куда сохранить результаты")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="во сколько раз стадия может замедлиться относительно baseline")
+    args = parser.parse_args(argv)
+    if args.speakers < 1:
+        parser.error("--speakers должно быть не меньше 1")
+    return args
+
+
+def main():
+    args = parse_args()
+    # Логи самих стадий (несопоставленные сегменты и т.п.) в бенчмарке только мешают
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "tolerance_ratio": TOLERANCE_RATIO,
+        "keywords": len(data_preparation.KEYWORDS),
+        "runs": [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(args.workdir) if args.workdir else Path(tmp)
+        for minutes in args.minutes:
+            config = {"minutes": minutes, "speakers": args.speakers, "noise_ms": args.noise_ms, "seed": args.seed}
+            name = f"synthetic_{int(minutes)}min"
+            started = time.perf_counter()
+            diar_file, trans_file = generate_pair(workdir, name, minutes, args.speakers, args.noise_ms, args.seed)
+            print(f"{name}: корпус сгенерирован за {time.perf_counter() - started:.1f} s")
+            stages = benchmark_pair(diar_file, trans_file, args.repeat, not args.no_memory, args.skip_python_docx)
+            report["runs"].append({
+                "config": config,
+                "files": {"diarization_bytes": diar_file.stat().st_size, "transcription_bytes": trans_file.stat().st_size},
+                "stages": stages,
+            })
+
+    Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Результаты сохранены в {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare_with_baseline(report, baseline, args.max_slowdown)
+        if regressions:
+            print("Регрессии производительности:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("Регрессий относительно baseline нет.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+DEFAULT_CACHE_PATH = Path(".cache/completions.sqlite")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024   # 512 МБ ответов
+DEFAULT_MAX_AGE = 30 * 24 * 3600        # 30 дней
+
+
+def make_cache_key(model: str, messages: list, max_tokens: int, temperature: float) -> str:
+    """
+    Content-addressed ключ запроса: sha256 от модели, полного списка сообщений
+    (системный промпт, few-shot и сам чанк), max_tokens и temperature.
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Персистентный кэш ответов LLM в SQLite.
+
+    - get()/put() потокобезопасны (одно соединение под замком), поэтому кэш можно
+      использовать из пула потоков dataset_pipeline;
+    - evict() удаляет записи старше max_age секунд, а затем самые давно использованные,
+      пока суммарный размер ответов не станет меньше max_bytes;
+    - refresh=True — не читать из кэша, но перезаписать его свежими ответами;
+    - hits/misses считаются за время жизни объекта.
+    """
+
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: float = DEFAULT_MAX_AGE, refresh: bool = False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(completions)")}
+        if "endpoint" not in columns:
+            # Кэши, созданные до пула endpoint'ов
+            self._conn.execute("ALTER TABLE completions ADD COLUMN endpoint TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions(accessed)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str):
+        """
+        Возвращает сохранённый ответ или None. В режиме refresh всегда промах.
+        """
+        entry = self.lookup([key])
+        return entry[1] if entry else None
+
+    def lookup(self, keys: list):
+        """
+        Первый найденный из ключей (например, один и тот же запрос к разным моделям пула):
+        (ключ, ответ, endpoint) или None. Считается одним попаданием или промахом.
+        """
+        with self._lock:
+            if not self.refresh:
+                for key in keys:
+                    row = self._conn.execute(
+                        "SELECT response, created, endpoint FROM completions WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is None or (self.max_age and row[1] < time.time() - self.max_age):
+                        continue
+                    self._conn.execute("UPDATE completions SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self._conn.commit()
+                    self.hits += 1
+                    return key, row[0], row[2]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, model: str, response: str, endpoint: str = None):
+        """
+        Сохраняет ответ; endpoint — какой endpoint пула его дал (None без пула).
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, model, response, size, created, accessed, endpoint)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode("utf-8")), now, now, endpoint),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """
+        Применяет ограничения по возрасту и размеру. Возвращает число удалённых записей.
+        """
+        removed = 0
+        with self._lock:
+            if self.max_age:
+                cur = self._conn.execute(
+                    "DELETE FROM completions WHERE created < ?", (time.time() - self.max_age,)
+                )
+                removed += cur.rowcount
+            if self.max_bytes:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+                if total > self.max_bytes:
+                    stale = []
+                    for key, size in self._conn.execute(
+                        "SELECT key, size FROM completions ORDER BY accessed"
+                    ):
+                        if total <= self.max_bytes:
+                            break
+                        stale.append((key,))
+                        total -= size
+                    self._conn.executemany("DELETE FROM completions WHERE key = ?", stale)
+                    removed += len(stale)
+            self._conn.commit()
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
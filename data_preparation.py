@@ -1,14 +1,38 @@
 #!/usr/bin/env python3
-import json
+import os
 import sys
+import json
+import heapq
+import hashlib
+import inspect
 import logging
+import zipfile
+import fnmatch
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from docx import Document
 from pathlib import Path
+from keyword_matcher import KeywordCounter
+from progress_manifest import file_sha256, atomic_write_text
+from run_metrics import RunMetrics, default_report_path
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+# Минимальная доля перекрытия сегмента транскрипции с сегментом диаризации
+TOLERANCE_RATIO = 0.5
+
+# Манифест сборки prepared_data: хэши входов и параметров для каждой пары
+BUILD_MANIFEST_NAME = ".build_manifest.json"
+
+# Папки и шаблоны имён входных пар
+DIARIZATION_DIR = Path("raw_data/diarization")
+TRANSCRIPTION_DIR = Path("raw_data/transcribation")
+DIARIZATION_GLOB = "*_diarization_processed_final.txt"
+TRANSCRIPTION_GLOB = "*_cleaned_final.docx"
+
 # Список ключевых слов для интервьюера
 KEYWORDS = [
     "расскажи", "представь", "объясни",
@@ -20,6 +44,9 @@ KEYWORDS = [
     "какой алгоритм", "какие технологии",
     "предложи решение", "раскрой", "какой стэк",
 ]
+KEYWORD_COUNTER = KeywordCounter(KEYWORDS)
+# Исходники, от которых зависит содержимое prepared_data: этот модуль и подсчёт ключевых слов для ролей
+BUILD_MODULES = [__file__, inspect.getfile(KeywordCounter)]
 
 def parse_timestamp(ts_str: str) -> datetime:
     """
@@ -33,17 +60,120 @@ def parse_timestamp(ts_str: str) -> datetime:
         logging.error(f"Ошибка при разборе временной метки: {ts_str} - {e}")
         raise
 
+def parse_timestamp_ms(ts_str: str) -> int:
+    """
+    Быстрый разбор "HH:MM:SS,fff" (или с точкой) в целое число миллисекунд без strptime.
+    00:00:03,799 -> 3799
+    Как и strptime("%H:%M:%S,%f") в parse_timestamp, дробная часть обязательна и содержит 1-6 цифр;
+    знаки после третьего отбрасываются до миллисекунд. Часы не ограничены 23, поэтому подходят
+    и многочасовые записи. Исходная строка для вывода хранится в сегменте (см. TransSegment).
+    """
+    ts = ts_str.strip()
+    try:
+        hours, minutes, rest = ts.split(":")
+        seconds, _, fraction = rest.replace(".", ",").partition(",")
+        if not (hours.isdigit() and minutes.isdigit() and seconds.isdigit() and fraction.isdigit()
+                and len(fraction) <= 6):
+            raise ValueError("ожидается формат HH:MM:SS,fff")
+        if len(minutes) > 2 or len(seconds) > 2 or int(minutes) > 59 or int(seconds) > 59:
+            raise ValueError("минуты и секунды должны быть в диапазоне 00-59")
+        millis = int((fraction + "00")[:3])
+        return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + millis
+    except ValueError as e:
+        logging.error(f"Ошибка при разборе временной метки: {ts_str} - {e}")
+        raise ValueError(f"Некорректная временная метка: {ts_str}") from e
+
+def format_timestamp_ms(ms: int) -> str:
+    """
+    Обратное преобразование: 3799 -> "00:00:03,799".
+    """
+    seconds, millis = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{millis:03d}"
+
+def segment_times(seg) -> str:
+    """
+    "начало - конец" сегмента для логов: исходные строки меток, если они есть.
+    """
+    start = seg.start_time if seg.start_time is not None else format_timestamp_ms(seg.start_ms)
+    end = seg.end_time if seg.end_time is not None else format_timestamp_ms(seg.end_ms)
+    return f"{start} - {end}"
+
+class DiarSegment:
+    """
+    Сегмент диаризации: границы в миллисекундах и интернированный идентификатор спикера.
+    """
+    __slots__ = ("start_ms", "end_ms", "speaker")
+
+    def __init__(self, start_ms: int, end_ms: int, speaker: str):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.speaker = sys.intern(speaker)
+
+    def __repr__(self):
+        return f"DiarSegment({self.start_ms}, {self.end_ms}, {self.speaker!r})"
+
+class TransSegment:
+    """
+    Сегмент транскрипции: границы в миллисекундах и текст.
+    start_time/end_time — исходные строки меток: в JSON они попадают как есть, а не пересобираются
+    из миллисекунд (иначе "00:00:03.5" превратилось бы в "00:00:03,500").
+    """
+    __slots__ = ("start_ms", "end_ms", "text", "start_time", "end_time")
+
+    def __init__(self, start_ms: int, end_ms: int, text: str, start_time: str = None, end_time: str = None):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.text = text
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __repr__(self):
+        return f"TransSegment({self.start_ms}, {self.end_ms}, {self.text!r})"
+
+class DialogueSegment:
+    """
+    Реплика диалога (спикер или роль + текст). В JSON пишутся исходные строки меток транскрипции;
+    из миллисекунд строка формируется, только если исходной нет.
+    """
+    __slots__ = ("start_ms", "end_ms", "speaker", "text", "start_time", "end_time")
+
+    def __init__(self, start_ms: int, end_ms: int, speaker: str, text: str, start_time: str = None,
+                 end_time: str = None):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.speaker = speaker
+        self.text = text
+        self.start_time = start_time
+        self.end_time = end_time
+
+    @classmethod
+    def from_segment(cls, seg, speaker: str):
+        return cls(seg.start_ms, seg.end_ms, speaker, seg.text, seg.start_time, seg.end_time)
+
+    def to_dict(self) -> dict:
+        return {
+            "start_time": self.start_time if self.start_time is not None else format_timestamp_ms(self.start_ms),
+            "end_time": self.end_time if self.end_time is not None else format_timestamp_ms(self.end_ms),
+            "speaker": self.speaker,
+            "text": self.text
+        }
+
+    def __repr__(self):
+        return f"DialogueSegment({self.start_ms}, {self.end_ms}, {self.speaker!r}, {self.text!r})"
+
 def parse_diarization_file(filepath: Path) -> list:
     """
-    Читает файл диаризации и возвращает список сегментов.
-    Каждая запись содержит:
-      - timestamp_start: оригинальная строка времени начала
-      - timestamp_end: оригинальная строка времени окончания
-      - speaker: имя спикера
-      - start_dt: объект datetime начала
-      - end_dt: объект datetime окончания
+    Читает файл диаризации (строки "HH:MM:SS,fff - HH:MM:SS,fff - speaker")
+    и возвращает список DiarSegment.
+    """
+    return list(iter_diarization_file(filepath))
+
+def iter_diarization_file(filepath: Path):
+    """
+    Генератор DiarSegment по строкам файла диаризации (файл не загружается в память целиком).
     """
-    segments = []
     with open(filepath, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -55,54 +185,93 @@ def parse_diarization_file(filepath: Path) -> list:
                 continue
             ts_start, ts_end, speaker = parts
             try:
-                start_dt = parse_timestamp(ts_start)
-                end_dt = parse_timestamp(ts_end)
+                start_ms = parse_timestamp_ms(ts_start)
+                end_ms = parse_timestamp_ms(ts_end)
             except ValueError:
                 continue
-            segments.append({
-                "timestamp_start": ts_start,
-                "timestamp_end": ts_end,
-                "speaker": speaker.strip(),
-                "start_dt": start_dt,
-                "end_dt": end_dt
-            })
-    return segments
+            yield DiarSegment(start_ms, end_ms, speaker.strip())
+
+def parse_transcription_line(text: str):
+    """
+    Разбирает абзац транскрипции "HH:MM:SS,fff - HH:MM:SS,fff - текст" в TransSegment.
+    Возвращает None для пустых абзацев, абзацев без разделителя и с битыми метками.
+    """
+    text = text.strip()
+    if not text or " - " not in text:
+        return None
+    parts = text.split(" - ", 2)
+    if len(parts) != 3:
+        logging.warning(f"Неверный формат строки транскрипции: {text}")
+        return None
+    ts_start, ts_end, seg_text = parts
+    try:
+        start_ms = parse_timestamp_ms(ts_start)
+        end_ms = parse_timestamp_ms(ts_end)
+    except ValueError:
+        return None
+    return TransSegment(start_ms, end_ms, seg_text.strip(), ts_start, ts_end)
 
 def parse_transcription_docx(filepath: Path) -> list:
     """
-    Читает файл транскрипции (docx) и возвращает список сегментов.
-    Каждый сегмент содержит:
-      - timestamp_start: строка времени начала
-      - timestamp_end: строка времени окончания
-      - text: текст сегмента
-      - start_dt: объект datetime начала
-      - end_dt: объект datetime окончания
+    Читает файл транскрипции (docx, абзацы "HH:MM:SS,fff - HH:MM:SS,fff - текст")
+    через python-docx и возвращает список TransSegment.
+    Строит всё дерево документа в памяти — используется как запасной вариант для iter_transcription_docx.
     """
     segments = []
     doc = Document(filepath)
     for para in doc.paragraphs:
-        text = para.text.strip()
-        if not text or " - " not in text:
-            continue
-        parts = text.split(" - ", 2)
-        if len(parts) != 3:
-            logging.warning(f"Неверный формат строки транскрипции: {text}")
-            continue
-        ts_start, ts_end, seg_text = parts
-        try:
-            start_dt = parse_timestamp(ts_start)
-            end_dt = parse_timestamp(ts_end)
-        except ValueError:
-            continue
-        segments.append({
-            "timestamp_start": ts_start,
-            "timestamp_end": ts_end,
-            "text": seg_text.strip(),
-            "start_dt": start_dt,
-            "end_dt": end_dt
-        })
+        segment = parse_transcription_line(para.text)
+        if segment is not None:
+            segments.append(segment)
     return segments
 
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_BODY = _W_NS + "body"
+_W_P = _W_NS + "p"
+# Элементы run'а, которые python-docx превращает в текст абзаца
+_W_RUN_TEXT = {
+    _W_NS + "tab": "\t",
+    _W_NS + "ptab": "\t",
+    _W_NS + "br": "\n",
+    _W_NS + "cr": "\n",
+    _W_NS + "noBreakHyphen": "-",
+}
+
+def iter_transcription_docx(filepath: Path):
+    """
+    Потоковое чтение транскрипции: word/document.xml читается из zip через iterparse,
+    без построения дерева python-docx. Генератор отдаёт TransSegment по одному абзацу.
+
+    Как и Document.paragraphs, учитываются только абзацы верхнего уровня w:body
+    (абзацы в таблицах пропускаются). Обработанные элементы сразу удаляются из дерева,
+    поэтому потребление памяти не зависит от длины транскрипта.
+    """
+    with zipfile.ZipFile(filepath) as archive, archive.open("word/document.xml") as xml_stream:
+        body = None
+        depth = 0
+        parts = []
+        for event, elem in ET.iterparse(xml_stream, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if elem.tag == _W_BODY and depth == 2:
+                    body = elem
+                continue
+
+            # Текст собираем на "end", когда содержимое элемента уже прочитано
+            if body is not None and depth > 3:
+                if elem.tag == _W_NS + "t":
+                    parts.append(elem.text or "")
+                elif elem.tag in _W_RUN_TEXT:
+                    parts.append(_W_RUN_TEXT[elem.tag])
+            elif depth == 3 and body is not None:
+                if elem.tag == _W_P:
+                    segment = parse_transcription_line("".join(parts))
+                    if segment is not None:
+                        yield segment
+                parts = []
+                body.clear()
+            depth -= 1
+
 def calculate_overlap(seg_start, seg_end, ref_start, ref_end):
     """
     Вычисляет длительность перекрытия двух сегментов (в секундах).
@@ -117,35 +286,129 @@ def match_segments(trans_segments: list, diar_segments: list, tolerance_ratio: f
     Для каждого сегмента транскрипции находит лучший соответствующий сегмент диаризации
     по правилу максимального перекрытия. Сегмент считается сопоставленным,
     если длительность перекрытия >= tolerance_ratio * длительность сегмента транскрипции.
+
+    Используется sweep-line: сегменты диаризации сортируются по началу и добавляются
+    в кучу активных интервалов (по времени окончания) по мере движения по сегментам
+    транскрипции, отсортированным по началу. Интервалы, закончившиеся до начала текущего
+    сегмента, выталкиваются из кучи, поэтому сложность ~O((N+M) log M) вместо O(N×M).
+    При равном перекрытии, как и раньше, выигрывает сегмент диаризации, идущий раньше во входном списке.
     
-    Возвращает список объединённых сегментов с ключами:
-      - start_time (строка)
-      - end_time (строка)
-      - speaker (из диаризации)
-      - text (из транскрипции)
+    Возвращает список DialogueSegment (границы и текст из транскрипции, speaker из диаризации).
     """
+    diar_bounds = [(d.start_ms, d.end_ms, idx) for idx, d in enumerate(diar_segments)]
+    diar_bounds.sort()
+    trans_order = sorted(range(len(trans_segments)), key=lambda i: trans_segments[i].start_ms)
+
+    # best[i] = (перекрытие в миллисекундах, индекс сегмента диаризации)
+    best = [(0, None)] * len(trans_segments)
+    active = []  # куча (end, idx, start)
+    next_diar = 0
+    for t_idx in trans_order:
+        t_start, t_end = trans_segments[t_idx].start_ms, trans_segments[t_idx].end_ms
+        while next_diar < len(diar_bounds) and diar_bounds[next_diar][0] < t_end:
+            d_start, d_end, d_idx = diar_bounds[next_diar]
+            heapq.heappush(active, (d_end, d_idx, d_start))
+            next_diar += 1
+        while active and active[0][0] <= t_start:
+            heapq.heappop(active)
+
+        best_overlap, best_idx = 0, None
+        for d_end, d_idx, d_start in active:
+            overlap = min(t_end, d_end) - max(t_start, d_start)
+            if overlap > best_overlap or (overlap == best_overlap and best_idx is not None and d_idx < best_idx):
+                best_overlap, best_idx = overlap, d_idx
+        best[t_idx] = (best_overlap, best_idx)
+
     matched = []
-    for t_seg in trans_segments:
-        best_overlap = 0.0
-        best_diar = None
-        t_duration = (t_seg["end_dt"] - t_seg["start_dt"]).total_seconds()
-        for d_seg in diar_segments:
-            overlap = calculate_overlap(t_seg["start_dt"], t_seg["end_dt"],
-                                        d_seg["start_dt"], d_seg["end_dt"])
-            if overlap > best_overlap:
-                best_overlap = overlap
-                best_diar = d_seg
-        if best_diar and best_overlap >= tolerance_ratio * t_duration:
-            matched.append({
-                "start_time": t_seg["timestamp_start"],
-                "end_time": t_seg["timestamp_end"],
-                "speaker": best_diar["speaker"],
-                "text": t_seg["text"]
-            })
+    for t_seg, (best_overlap, best_idx) in zip(trans_segments, best):
+        # Сравнение в секундах — ровно как timedelta.total_seconds() в прежней реализации
+        t_duration = (t_seg.end_ms - t_seg.start_ms) / 1000
+        if best_idx is not None and best_overlap / 1000 >= tolerance_ratio * t_duration:
+            matched.append(DialogueSegment.from_segment(t_seg, diar_segments[best_idx].speaker))
         else:
-            logging.info(f"Сегмент транскрипции [{t_seg['timestamp_start']} - {t_seg['timestamp_end']}] не сопоставлен, недостаточное перекрытие.")
+            logging.info(
+                f"Сегмент транскрипции [{segment_times(t_seg)}] "
+                f"не сопоставлен, недостаточное перекрытие."
+            )
     return matched
 
+class OutOfOrderError(Exception):
+    """
+    Сегменты на входе потокового сопоставления не упорядочены по началу.
+    """
+
+def iter_matched_segments(trans_segments, diar_segments, tolerance_ratio: float = 0.5, counts: dict = None,
+                          log_unmatched: bool = True):
+    """
+    Потоковый вариант match_segments для входов, упорядоченных по началу сегмента
+    (так пишут и диаризация, и транскрипция): сегменты диаризации читаются по мере
+    продвижения по транскрипции, в памяти только активные интервалы.
+    Результат тот же, что у match_segments. Если порядок нарушен, выбрасывается OutOfOrderError.
+    В counts (если передан) накапливаются transcription и matched.
+    """
+    diar_iter = iter(diar_segments)
+    pending = next(diar_iter, None)
+    next_idx = 0
+    active = []  # куча (end, idx, start, speaker)
+    last_start = None
+    for t_seg in trans_segments:
+        t_start, t_end = t_seg.start_ms, t_seg.end_ms
+        if last_start is not None and t_start < last_start:
+            raise OutOfOrderError("транскрипция не упорядочена по времени")
+        last_start = t_start
+        while pending is not None and pending.start_ms < t_end:
+            heapq.heappush(active, (pending.end_ms, next_idx, pending.start_ms, pending.speaker))
+            next_idx += 1
+            following = next(diar_iter, None)
+            if following is not None and following.start_ms < pending.start_ms:
+                raise OutOfOrderError("диаризация не упорядочена по времени")
+            pending = following
+        while active and active[0][0] <= t_start:
+            heapq.heappop(active)
+
+        best_overlap, best_idx, best_speaker = 0, None, None
+        for d_end, d_idx, d_start, speaker in active:
+            overlap = min(t_end, d_end) - max(t_start, d_start)
+            if overlap > best_overlap or (overlap == best_overlap and best_idx is not None and d_idx < best_idx):
+                best_overlap, best_idx, best_speaker = overlap, d_idx, speaker
+
+        if counts is not None:
+            counts["transcription"] = counts.get("transcription", 0) + 1
+        if best_idx is not None and best_overlap / 1000 >= tolerance_ratio * ((t_end - t_start) / 1000):
+            if counts is not None:
+                counts["matched"] = counts.get("matched", 0) + 1
+            yield DialogueSegment.from_segment(t_seg, best_speaker)
+        elif log_unmatched:
+            logging.info(
+                f"Сегмент транскрипции [{segment_times(t_seg)}] "
+                f"не сопоставлен, недостаточное перекрытие."
+            )
+
+class SpeakerStats:
+    """
+    Накапливаемая статистика по спикерам для assign_roles: число сегментов,
+    вопросительных знаков и вхождений ключевых слов. Сегменты добавляются по одному,
+    ключевые слова считаются за один проход по тексту (KeywordCounter).
+    """
+
+    def __init__(self, counter: KeywordCounter = None):
+        self.counter = counter or KEYWORD_COUNTER
+        self.stats = {}
+
+    def add(self, seg):
+        stats = self.stats.get(seg.speaker)
+        if stats is None:
+            stats = self.stats[seg.speaker] = {"count": 0, "questions": 0, "keywords": 0}
+        stats["count"] += 1
+        stats["questions"] += seg.text.count("?")
+        stats["keywords"] += self.counter.count(seg.text.lower())
+
+    def role_mapping(self):
+        """
+        {спикер: роль} для двух спикеров с наибольшим числом сегментов или None, если спикеров меньше двух.
+        """
+        return _choose_roles(self.stats)
+
 def assign_roles(dialogue: list) -> list:
     """
     Определяет роли «interviewer» и «candidate» для топ-2 спикеров (по количеству сегментов).
@@ -156,17 +419,29 @@ def assign_roles(dialogue: list) -> list:
     а исходное имя спикера заменяется на соответствующую роль.
     """
     # Сгруппировать статистику по каждому спикеру
-    speaker_stats = {}
+    accumulator = SpeakerStats()
     for seg in dialogue:
-        spk = seg["speaker"]
-        if spk not in speaker_stats:
-            speaker_stats[spk] = {"count": 0, "questions": 0, "keywords": 0}
-        speaker_stats[spk]["count"] += 1
-        speaker_stats[spk]["questions"] += seg["text"].count("?")
-        text_lower = seg["text"].lower()
-        for kw in KEYWORDS:
-            speaker_stats[spk]["keywords"] += text_lower.count(kw)
-    
+        accumulator.add(seg)
+    role_mapping = accumulator.role_mapping()
+    if role_mapping is None:
+        return dialogue  # Если спикеров меньше, оставляем без назначения ролей
+
+    # Обновляем диалог: оставляем только сегменты для top-2 спикеров и заменяем их имена на роли
+    updated_dialogue = list(iter_with_roles(dialogue, role_mapping))
+    # Сортируем по началу сегмента (время уже разобрано в миллисекунды)
+    updated_dialogue.sort(key=lambda x: x.start_ms)
+    return updated_dialogue
+
+def iter_with_roles(dialogue, role_mapping: dict):
+    """
+    Оставляет сегменты двух основных спикеров и заменяет их имена на роли.
+    """
+    for seg in dialogue:
+        role = role_mapping.get(seg.speaker)
+        if role is not None:
+            yield DialogueSegment.from_segment(seg, role)
+
+def _choose_roles(speaker_stats: dict):
     # Отбираем топ-2 спикеров по количеству сегментов
     top_speakers = sorted(
         speaker_stats.items(),
@@ -176,7 +451,7 @@ def assign_roles(dialogue: list) -> list:
 
     if len(top_speakers) < 2:
         logging.warning("Найдено менее двух спикеров в диалоге.")
-        return dialogue  # Если спикеров меньше, оставляем без назначения ролей
+        return None
     
     spk1, spk2 = top_speakers[0][0], top_speakers[1][0]
     
@@ -202,49 +477,100 @@ def assign_roles(dialogue: list) -> list:
         role_mapping = {spk2: "interviewer", spk1: "candidate"}
     
     logging.info(f"Роли назначены: {role_mapping}")
-    
-    # Обновляем диалог: оставляем только сегменты для top-2 спикеров и заменяем их имена на роли
-    updated_dialogue = []
-    for seg in dialogue:
-        if seg["speaker"] in role_mapping:
-            new_seg = seg.copy()
-            new_seg["speaker"] = role_mapping[new_seg["speaker"]]
-            updated_dialogue.append(new_seg)
-    # Сортируем по началу сегмента (используем парсинг временной метки)
-    updated_dialogue.sort(key=lambda x: parse_timestamp(x["start_time"]))
-    return updated_dialogue
+    return role_mapping
 
 
 def merge_consecutive_segments(dialogue: list) -> list:
     """
     Объединяет подряд идущие сегменты с одинаковой ролью.
     Для объединения:
-      - start_time берется из первого сегмента,
-      - end_time из последнего сегмента последовательной группы,
+      - начало берется из первого сегмента,
+      - конец из последнего сегмента последовательной группы,
       - текст объединяется через пробел.
     """
-    if not dialogue:
-        return []
-    
-    merged = []
-    current = dialogue[0].copy()
-    
-    for seg in dialogue[1:]:
-        if seg["speaker"] == current["speaker"]:
-            # Обновляем конечное время и объединяем текст
-            current["end_time"] = seg["end_time"]
-            current["text"] = current["text"].strip() + " " + seg["text"].strip()
-        else:
-            merged.append(current)
-            current = seg.copy()
-    merged.append(current)
-    return merged
+    return list(iter_merged_segments(dialogue))
+
+def _join_texts(texts: list) -> str:
+    """
+    Текст объединённой группы. Совпадает с прежней попарной склейкой
+    text = text.strip() + " " + next.strip(): одиночный сегмент не меняется,
+    пустые после strip части, кроме последней, пропускаются.
+    """
+    if len(texts) == 1:
+        return texts[0]
+    stripped = [text.strip() for text in texts]
+    return " ".join(part for part in stripped[:-1] if part) + " " + stripped[-1]
+
+def iter_merged_segments(dialogue):
+    """
+    Генератор для merge_consecutive_segments: в памяти только тексты текущей группы,
+    склейка через join за один проход вместо повторной конкатенации.
+    """
+    current, texts = None, []
+    for seg in dialogue:
+        if current is not None and seg.speaker == current.speaker:
+            current.end_ms = seg.end_ms
+            current.end_time = seg.end_time
+            texts.append(seg.text)
+            continue
+        if current is not None:
+            current.text = _join_texts(texts)
+            yield current
+        current, texts = DialogueSegment.from_segment(seg, seg.speaker), [seg.text]
+    if current is not None:
+        current.text = _join_texts(texts)
+        yield current
 
-def process_pair(diar_file: Path, trans_file: Path, prepared_data_dir: Path):
+class DialogueWriter:
+    """
+    Пишет {"dialogue": [...]} по одному сегменту, байт в байт как
+    json.dump(..., ensure_ascii=False, indent=2) для всего списка.
+    Запись идёт во временный файл, который подменяет path (os.replace) только при успешном
+    выходе из with: оборванный JSON не может оказаться на месте готового результата.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.count = 0
+        self._file = None
+
+    def __enter__(self):
+        self._file = self.tmp_path.open("w", encoding="utf-8")
+        self._file.write('{\n  "dialogue": [')
+        return self
+
+    def write(self, seg):
+        item = json.dumps(seg.to_dict(), ensure_ascii=False, indent=2).replace("\n", "\n    ")
+        self._file.write(("," if self.count else "") + "\n    " + item)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._file.close()
+            self.tmp_path.unlink(missing_ok=True)
+            return
+        self._file.write("\n  ]\n}" if self.count else "]\n}")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+def process_pair(diar_file: Path, trans_file: Path, prepared_data_dir: Path, tolerance_ratio: float = TOLERANCE_RATIO,
+                 metrics: RunMetrics = None) -> dict:
     """
     Обрабатывает пару файлов: diar_file (из папки diarization) и trans_file (из папки transcription).
     Выполняет parse, match, assign_roles, merge_consecutive_segments и сохраняет результат.
+    Возвращает снимок метрик (время стадий), чтобы его можно было собрать из дочернего процесса.
+
+    Стадии — генераторы, входы читаются потоково в два прохода:
+      1) сопоставление только ради статистики спикеров (она и есть всё, что буферизуется);
+      2) повторное сопоставление с заменой имён на роли, причём не объединённый и объединённый
+         JSON пишутся одновременно, по мере появления сегментов.
+    Поэтому пиковая память не зависит от длины записи. Если входы не упорядочены по времени
+    (потоковое сопоставление невозможно), пара обрабатывается целиком в памяти, как раньше.
     """
+    metrics = metrics or RunMetrics("data_preparation")
     logging.info(f"Обрабатываем пару:\n  diarization={diar_file}\n  transcription={trans_file}")
 
     # Получаем "базовое имя" для сохранения
@@ -252,36 +578,179 @@ def process_pair(diar_file: Path, trans_file: Path, prepared_data_dir: Path):
     base_name = diar_file.name.split("_diarization")[0]  # либо более точный split
     # Или, если нужно быть точными, можно взять "interview_syst_analyst_1" в trans_file тоже
 
-    # Читаем сегменты диаризации
-    diar_segments = parse_diarization_file(diar_file)
-    logging.info(f"[{base_name}] Найдено {len(diar_segments)} сегментов диаризации.")
-
-    # Читаем сегменты транскрипции
-    trans_segments = parse_transcription_docx(trans_file)
-    logging.info(f"[{base_name}] Найдено {len(trans_segments)} сегментов транскрипции.")
+    transcription = lambda: iter_transcription_docx(trans_file)
+    counts = {}
+    with metrics.stage("collect_speaker_stats", base_name):
+        try:
+            stats = collect_ordered_speaker_stats(base_name, diar_file, transcription, tolerance_ratio, counts)
+            streamed = True
+        except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+            logging.warning(f"Потоковое чтение {trans_file} не удалось ({e}), используем python-docx.")
+            streamed = False
+        # Запасной вариант вне except: OutOfOrderError из него обрабатывается так же, как из основного пути
+        if not streamed:
+            trans_segments = parse_transcription_docx(trans_file)
+            transcription = lambda: trans_segments
+            counts = {}
+            stats = collect_ordered_speaker_stats(base_name, diar_file, transcription, tolerance_ratio, counts)
 
-    # Сопоставляем
-    dialogue = match_segments(trans_segments, diar_segments, tolerance_ratio=0.5)
-    logging.info(f"[{base_name}] Сопоставлено {len(dialogue)} сегментов диалога.")
+    if stats is None:
+        with metrics.stage("match_segments", base_name):
+            trans_segments = list(transcription())
+            dialogue = match_segments(trans_segments, parse_diarization_file(diar_file), tolerance_ratio=tolerance_ratio)
+        counts = {"transcription": len(trans_segments), "matched": len(dialogue)}
+        final_dialogue = lambda: assign_roles(dialogue)
+    else:
+        role_mapping = stats.role_mapping()
+        def final_dialogue():
+            matched = iter_matched_segments(transcription(), iter_diarization_file(diar_file), tolerance_ratio)
+            return matched if role_mapping is None else iter_with_roles(matched, role_mapping)
 
-    # Назначаем роли
-    final_dialogue = assign_roles(dialogue)
+    logging.info(f"[{base_name}] Найдено {counts.get('transcription', 0)} сегментов транскрипции, "
+                 f"сопоставлено {counts.get('matched', 0)} сегментов диалога.")
+    metrics.inc("transcription_segments", counts.get("transcription", 0))
+    metrics.inc("unmatched_segments", counts.get("transcription", 0) - counts.get("matched", 0))
 
-    # Сохраняем не объединённый вариант
-    final_json = {"dialogue": final_dialogue}
+    # Не объединённый и объединённый варианты пишутся за один проход
     out_unmerged = prepared_data_dir / f"dialoge_{base_name}.json"
-    with out_unmerged.open("w", encoding="utf-8") as f:
-        json.dump(final_json, f, ensure_ascii=False, indent=2)
-    logging.info(f"[{base_name}] Не объединённый JSON сохранён в {out_unmerged}")
-
-    # Объединяем подряд идущие сегменты
-    merged_dialogue = merge_consecutive_segments(final_dialogue)
-    merged_json = {"dialogue": merged_dialogue}
     out_merged = prepared_data_dir / f"dialoge_{base_name}_final.json"
-    with out_merged.open("w", encoding="utf-8") as f:
-        json.dump(merged_json, f, ensure_ascii=False, indent=2)
+    with metrics.stage("write_dialogue", base_name):
+        with DialogueWriter(out_unmerged) as unmerged, DialogueWriter(out_merged) as merged:
+            for seg in iter_merged_segments(_tee(final_dialogue(), unmerged.write)):
+                merged.write(seg)
+    logging.info(f"[{base_name}] Не объединённый JSON сохранён в {out_unmerged}")
     logging.info(f"[{base_name}] Объединённый JSON сохранён в {out_merged}")
+    metrics.inc("pairs_built")
+    return metrics.snapshot()
+
+def collect_speaker_stats(diar_file: Path, transcription, tolerance_ratio: float, counts: dict) -> SpeakerStats:
+    """
+    Первый проход: потоковое сопоставление пары, из результата сохраняется только статистика спикеров.
+    transcription — функция, возвращающая новый итератор сегментов транскрипции.
+    """
+    stats = SpeakerStats()
+    for seg in iter_matched_segments(transcription(), iter_diarization_file(diar_file), tolerance_ratio,
+                                     counts=counts, log_unmatched=False):
+        stats.add(seg)
+    return stats
+
+def collect_ordered_speaker_stats(base_name: str, diar_file: Path, transcription, tolerance_ratio: float,
+                                  counts: dict):
+    """
+    collect_speaker_stats, но для неупорядоченных входов возвращает None: такую пару
+    process_pair обрабатывает целиком в памяти.
+    """
+    try:
+        return collect_speaker_stats(diar_file, transcription, tolerance_ratio, counts)
+    except OutOfOrderError as e:
+        logging.warning(f"[{base_name}] {e}, обрабатываем пару целиком в памяти.")
+        return None
 
+def _tee(segments, callback):
+    for seg in segments:
+        callback(seg)
+        yield seg
+
+
+def params_fingerprint(tolerance_ratio: float = TOLERANCE_RATIO) -> str:
+    """
+    Хэш всего, что влияет на результат помимо входных файлов: tolerance_ratio, KEYWORDS
+    и исходный код модулей BUILD_MODULES (изменение логики тоже требует пересборки).
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({"tolerance_ratio": tolerance_ratio, "keywords": KEYWORDS}, ensure_ascii=False).encode("utf-8"))
+    for module in BUILD_MODULES:
+        digest.update(Path(module).read_bytes())
+    return digest.hexdigest()
+
+def output_paths(base_name: str, prepared_data_dir: Path) -> list:
+    return [
+        prepared_data_dir / f"dialoge_{base_name}.json",
+        prepared_data_dir / f"dialoge_{base_name}_final.json",
+    ]
+
+def load_build_manifest(prepared_data_dir: Path) -> dict:
+    manifest_path = prepared_data_dir / BUILD_MANIFEST_NAME
+    if not manifest_path.is_file():
+        return {}
+    try:
+        return json.loads(manifest_path.read_text(encoding="utf-8"))
+    except json.JSONDecodeError:
+        logging.warning(f"Манифест сборки {manifest_path} повреждён, пересобираем всё.")
+        return {}
+
+def save_build_manifest(manifest: dict, prepared_data_dir: Path):
+    atomic_write_text(prepared_data_dir / BUILD_MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True))
+
+def build_pairs(pairs: dict, prepared_data_dir: Path, jobs: int = 1, force: bool = False,
+                tolerance_ratio: float = TOLERANCE_RATIO, metrics: RunMetrics = None):
+    """
+    Инкрементальная сборка: pairs — {base_name: (diar_file, trans_file)}.
+    Пара пропускается, если хэши обоих входов и параметров совпадают с манифестом
+    и оба выходных JSON на месте. Остальные пары обрабатываются в ProcessPoolExecutor
+    из 'jobs' процессов (при jobs=1 или профилировании — в текущем процессе);
+    манифест обновляется после каждой успешно собранной пары.
+    """
+    metrics = metrics or RunMetrics("data_preparation")
+    manifest = load_build_manifest(prepared_data_dir)
+    params_hash = params_fingerprint(tolerance_ratio)
+
+    stale = {}
+    for base, (dfile, tfile) in sorted(pairs.items()):
+        entry = {
+            "diarization": str(dfile),
+            "diarization_sha256": file_sha256(dfile),
+            "transcription": str(tfile),
+            "transcription_sha256": file_sha256(tfile),
+            "params_sha256": params_hash,
+        }
+        metrics.inc("input_bytes", dfile.stat().st_size + tfile.stat().st_size)
+        outputs_exist = all(p.is_file() for p in output_paths(base, prepared_data_dir))
+        if not force and outputs_exist and manifest.get(base) == entry:
+            logging.info(f"[{base}] Без изменений, пропускаем.")
+            metrics.inc("pairs_up_to_date")
+            continue
+        stale[base] = entry
+
+    logging.info(f"К пересборке {len(stale)} из {len(pairs)} пар (jobs={jobs}).")
+    if not stale:
+        return
+
+    def record_result(base, run):
+        try:
+            metrics.merge(run())
+        except Exception as e:
+            logging.error(f"[{base}] Ошибка обработки пары: {e}")
+            metrics.inc("pairs_failed")
+            manifest.pop(base, None)
+        else:
+            manifest[base] = stale[base]
+        save_build_manifest(manifest, prepared_data_dir)
+
+    if jobs <= 1 or metrics.profile:
+        for base in stale:
+            record_result(base, lambda: process_pair(*pairs[base], prepared_data_dir, tolerance_ratio, metrics=RunMetrics(
+                "data_preparation", profile=metrics.profile)))
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(process_pair, *pairs[base], prepared_data_dir, tolerance_ratio): base
+            for base in stale
+        }
+        for future in as_completed(futures):
+            record_result(futures[future], future.result)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Подготовка диалогов из диаризации и транскрипции.")
+    parser.add_argument("files", nargs="*", help="пара файлов: diarization.txt transcription.docx")
+    parser.add_argument("--jobs", type=int, default=1, help="число процессов для обработки пар")
+    parser.add_argument("--force", action="store_true", help="пересобрать все пары, игнорируя манифест")
+    parser.add_argument("--report", help="куда записать JSON-отчёт о запуске (по умолчанию reports/data_preparation-<время>.json)")
+    parser.add_argument("--prometheus", help="дополнительно записать метрики в Prometheus textfile")
+    parser.add_argument("--profile", action="store_true",
+                        help="профилировать запуск (cProfile + tracemalloc); пары обрабатываются в одном процессе")
+    return parser.parse_args(argv)
 
 def main():
     """
@@ -289,23 +758,52 @@ def main():
     Иначе берём все файлы *_diarization_processed_final.txt в папке diarization и
     ищем соответствующие *_cleaned_final.docx в папке transcription, сопоставляя их по
     базовому имени (до '_diarization' и до '_cleaned').
+    Неизменившиеся пары пропускаются по манифесту сборки, остальные обрабатываются в --jobs процессов.
+    """
+    args = parse_args()
+    metrics = RunMetrics("data_preparation", profile=args.profile)
+    metrics.start_profiling()
+    try:
+        collect_and_build(args, metrics)
+    finally:
+        report_path = Path(args.report) if args.report else default_report_path("data_preparation")
+        metrics.stop_profiling(report_path.with_suffix(".prof"))
+        metrics.write_json(report_path, {"jobs": args.jobs, "tolerance_ratio": TOLERANCE_RATIO})
+        logging.info(f"Отчёт о запуске сохранён в {report_path}")
+        if args.prometheus:
+            metrics.write_prometheus(Path(args.prometheus))
+
+def pair_base(path: Path) -> str:
+    """
+    Базовое имя пары по файлу диаризации или транскрипции
+    ("interview_syst_analyst_1"); None, если файл не из пары.
+    """
+    if fnmatch.fnmatch(path.name, DIARIZATION_GLOB):
+        return path.name.split("_diarization")[0]
+    if fnmatch.fnmatch(path.name, TRANSCRIPTION_GLOB):
+        return path.name.split("_cleaned")[0]
+    return None
+
+def collect_and_build(args, metrics: RunMetrics):
+    """
+    Находит пары файлов (из аргументов или по папкам raw_data) и запускает инкрементальную сборку.
     """
-    args = sys.argv[1:]
     prepared_data_dir = Path("prepared_data")
     prepared_data_dir.mkdir(parents=True, exist_ok=True)
 
-    diarization_dir = Path("raw_data/diarization")
-    transcription_dir = Path("raw_data/transcribation")
+    diarization_dir = DIARIZATION_DIR
+    transcription_dir = TRANSCRIPTION_DIR
 
-    if len(args) == 2:
+    if len(args.files) == 2:
         # Запущен с указанием конкретных файлов
-        diar_file = Path(args[0])
-        trans_file = Path(args[1])
-        process_pair(diar_file, trans_file, prepared_data_dir)
+        diar_file = Path(args.files[0])
+        trans_file = Path(args.files[1])
+        base = diar_file.name.split("_diarization")[0]
+        build_pairs({base: (diar_file, trans_file)}, prepared_data_dir, jobs=1, force=args.force, metrics=metrics)
     else:
         # Собираем все файлы из diarization и transcription
-        diar_files = list(diarization_dir.glob("*_diarization_processed_final.txt"))
-        trans_files = list(transcription_dir.glob("*_cleaned_final.docx"))
+        diar_files = list(diarization_dir.glob(DIARIZATION_GLOB))
+        trans_files = list(transcription_dir.glob(TRANSCRIPTION_GLOB))
 
         # Построим словари: {base_name -> Path}
         # например "interview_syst_analyst_1" -> Path(".../interview_syst_analyst_1_diarization_processed_final.txt")
@@ -325,10 +823,8 @@ def main():
             logging.warning("Не найдено пар файлов с совпадающим базовым именем!")
             return
 
-        for base in common_bases:
-            dfile = diar_map[base]
-            tfile = trans_map[base]
-            process_pair(dfile, tfile, prepared_data_dir)
+        pairs = {base: (diar_map[base], trans_map[base]) for base in common_bases}
+        build_pairs(pairs, prepared_data_dir, jobs=args.jobs, force=args.force, metrics=metrics)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,63 @@
+import os
 import time
-import re
-import sys
 import json
+import socket
+import hashlib
+import heapq
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from dotenv import dotenv_values
 from openai import OpenAI
+from json_parsing import parse_json, StreamingOutputParser, OffSchemaError
+from model_pool import ModelPool, load_endpoint_config, build_pool
+from completion_cache import CompletionCache, DEFAULT_CACHE_PATH, make_cache_key
+from retry_policy import (
+    ApiError, MalformedResponseError, CircuitBreaker, classify_exception, backoff_delay,
+    BREAKER_THRESHOLD, BREAKER_COOLDOWN,
+)
+from run_metrics import RunMetrics, default_report_path
+from token_counter import CHARS_PER_TOKEN, make_token_counter, count_message_tokens
+from progress_manifest import ProgressJournal, file_sha256, COMPLETED, FAILED, SKIPPED
+from work_queue import WorkQueue, LeaseKeeper, ShardWriter, merge_shards, LEASE_SECONDS, SHARD_DIR, POLL_INTERVAL
 
 ##################################################
-WAIT_SECONDS = 2.0  # задержка между запросами (в секундах)
+WAIT_SECONDS = 2.0  # базовая пауза экспоненциального backoff перед повтором (в секундах)
 MAX_RETRIES = 2     # сколько раз пытаться повторить запрос при неудаче
+CONCURRENCY = 4     # сколько чанков обрабатывается одновременно
+BATCH_SIZE = 1      # сколько чанков отправлять в одном запросе
+REQUESTS_PER_MINUTE = 20
+TOKENS_PER_MINUTE = 40000
+MAX_TOKENS = 2048
+TEMPERATURE = 0.7
+CHUNK_SIZE = 4      # реплик в чанке при фиксированном чанкинге
+INSTRUCTION = (
+    "Представь, что ты виртуальный наставник. "
+    "Определи сильные и слабые стороны кандидата по диалогу и сформулируй рекомендации."
+)
+SYSTEM_PROMPT = (
+    "Ты — виртуальный наставник, который анализирует диалог кандидата на позицию системного аналитика и интервьюера. "
+    "На основании диалога определи сильные и слабые стороны кандидата и сформулируй "
+    "персонализированные рекомендации. Исправляй грамматические ошибки и неточности в названиях. "
+    "Если роли неправильно назначены, то твоя задача понять из контекста кто является кандидатом "
+    "и сформулировать для него персонализированные рекомендации. "
+    "Важно: верни строго валидный JSON, содержащий ровно одно поле 'output'. "
+    "Внутри 'output' укажи:\n"
+    "- hard_skills: [список строк]\n"
+    "- soft_skills: [список строк]\n"
+    "- recommendations: [список строк]\n"
+    "Не добавляй никаких других полей и не используй Markdown-блоки. "
+    "Пример корректной структуры:\n"
+    "{\n"
+    "  \"output\": {\n"
+    "    \"hard_skills\": [\"...\"],\n"
+    "    \"soft_skills\": [\"...\"],\n"
+    "    \"recommendations\": [\"...\"]\n"
+    "  }\n"
+    "}"
+)
 FEW_SHOT_EXAMPLES = [
     {
         "role": "user",
@@ -58,84 +107,231 @@ def chunk_dialogue(dialogue, chunk_size=4):
     for i in range(0, len(dialogue), chunk_size):
         yield dialogue[i:i+chunk_size]
 
+def format_turn(seg) -> str:
+    if seg["speaker"] == "interviewer":
+        return f"Вопрос: {seg['text']}"
+    return f"Ответ: {seg['text']}"
+
+def group_question_answer(dialogue) -> list:
+    """
+    Группирует реплики в пары "вопрос-ответ": новая группа начинается с каждой реплики интервьюера,
+    реплики кандидата присоединяются к текущей группе (начальные ответы без вопроса — отдельная группа).
+    """
+    groups = []
+    for seg in dialogue:
+        if not groups or (seg["speaker"] == "interviewer" and groups[-1][-1]["speaker"] != "interviewer"):
+            groups.append([seg])
+        else:
+            groups[-1].append(seg)
+    return groups
+
+def chunk_dialogue_by_tokens(dialogue, max_tokens: int, count_tokens=None, overlap: int = 0):
+    """
+    Упаковывает подряд идущие пары "вопрос-ответ" в чанки, пока суммарный размер реплик
+    (в токенах count_tokens, по строкам как в build_input_from_chunk) не превышает max_tokens.
+    Пара никогда не разрывается; пара больше бюджета становится отдельным чанком.
+    overlap — сколько последних пар предыдущего чанка повторить в начале следующего как контекст
+    (при этом в каждом чанке есть хотя бы одна новая пара).
+    """
+    count_tokens = count_tokens or make_token_counter("chars")
+    groups = group_question_answer(dialogue)
+    sizes = [sum(count_tokens(format_turn(seg)) + 1 for seg in group) for group in groups]
+
+    start = 0
+    while start < len(groups):
+        end = start + 1
+        budget = sizes[start]
+        while end < len(groups) and budget + sizes[end] <= max_tokens:
+            budget += sizes[end]
+            end += 1
+
+        context_start = start
+        while overlap and context_start > max(0, start - overlap) and \
+                budget + sizes[context_start - 1] <= max_tokens:
+            context_start -= 1
+            budget += sizes[context_start]
+
+        yield [seg for group in groups[context_start:end] for seg in group]
+        start = end
+
+def split_dialogue(dialogue, chunk_tokens: int = 0, overlap: int = 0, count_tokens=None) -> list:
+    """
+    Выбирает стратегию чанкинга: по бюджету токенов, если chunk_tokens > 0,
+    иначе фиксированные чанки по CHUNK_SIZE реплик.
+    """
+    if chunk_tokens and chunk_tokens > 0:
+        return list(chunk_dialogue_by_tokens(dialogue, chunk_tokens, count_tokens, overlap))
+    return list(chunk_dialogue(dialogue, chunk_size=CHUNK_SIZE))
+
 def build_input_from_chunk(chunk):
     """
     На основе 4 подряд идущих реплик строим строку вида:
     Вопрос (или реплика интервьюера): ...
     Ответ (или реплика кандидата): ...
     """
-    lines = []
-    for seg in chunk:
-        if seg["speaker"] == "interviewer":
-            lines.append(f"Вопрос: {seg['text']}")
+    return "\n".join(format_turn(seg) for seg in chunk)
+
+def build_messages(prompt: str) -> list:
+    """
+    Формирует список сообщений, где:
+      1) идёт общее системное указание,
+      2) добавляются few-shot-примеры,
+      3) потом идёт пользовательский контент prompt.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    messages.extend(FEW_SHOT_EXAMPLES)
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + (
+    "\n\nТебе передано несколько независимых фрагментов диалога, каждый начинается со строки "
+    "\"Фрагмент N:\". Проанализируй каждый фрагмент отдельно и верни строго валидный JSON-массив, "
+    "в котором для каждого фрагмента есть объект {\"chunk\": N, \"output\": {...}} "
+    "со структурой 'output', описанной выше. Не пропускай фрагменты и не объединяй их."
+)
+
+def build_batch_prompt(prompts: list) -> str:
+    return "\n\n".join(f"Фрагмент {idx}:\n{prompt}" for idx, prompt in enumerate(prompts))
+
+def build_batch_messages(prompts: list) -> list:
+    """
+    Сообщения для пакетного запроса: один системный промпт и одна пара few-shot-примеров
+    на K чанков. Few-shot-ответ переводится в формат массива с ключом chunk.
+    """
+    messages = [{"role": "system", "content": BATCH_SYSTEM_PROMPT}]
+    for example in FEW_SHOT_EXAMPLES:
+        if example["role"] == "user":
+            messages.append({"role": "user", "content": build_batch_prompt([example["content"]])})
         else:
-            lines.append(f"Ответ: {seg['text']}")
-    return "\n".join(lines)
+            output = json.loads(example["content"])["output"]
+            content = json.dumps([{"chunk": 0, "output": output}], ensure_ascii=False, indent=2)
+            messages.append({"role": "assistant", "content": content})
+    messages.append({"role": "user", "content": build_batch_prompt(prompts)})
+    return messages
 
-def parse_json(json_output):
+def parse_batch_response(response_content: str, size: int) -> dict:
     """
-    Убираем markdown-обрамление, если оно есть, и пробуем распарсить строку как JSON.
+    Разбирает ответ на пакетный запрос: {индекс в пакете: output}.
+    Отсутствующие, повторные и некорректные элементы просто не попадают в результат.
     """
-    try:
-        lines = json_output.splitlines()
-        # Ищем начало блока ```json
-        for i, line in enumerate(lines):
-            if line.strip() == "```json":
-                # Берём всё после этой строки до следующего ```
-                json_output = "".join(lines[i+1:])
-                json_output = json_output.split("```")[0]
-                break
-        # Удаляем лишние запятые перед закрывающей фигурной скобкой
-        json_output = re.sub(r',\s*}', '}', json_output)
+    parsed = parse_json(response_content) if response_content else None
+    if isinstance(parsed, dict):
+        parsed = [parsed]
+    outputs = {}
+    if not isinstance(parsed, list):
+        return outputs
+    for item in parsed:
+        if not isinstance(item, dict) or not isinstance(item.get("output"), dict):
+            continue
+        idx = item.get("chunk")
+        if isinstance(idx, int) and 0 <= idx < size and idx not in outputs:
+            outputs[idx] = item["output"]
+    return outputs
 
-        return json.loads(json_output)
-    except Exception:
-        return None
+class BatchReport:
+    """
+    Потокобезопасные счётчики пакетного режима: сколько токенов промпта ушло бы
+    при поштучной отправке и сколько отправлено на самом деле (включая поштучные повторы).
+    """
+
+    def __init__(self):
+        self.single_tokens = 0
+        self.sent_tokens = 0
+        self.batches = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def add(self, single_tokens: int = 0, sent_tokens: int = 0, batches: int = 0, fallbacks: int = 0):
+        with self._lock:
+            self.single_tokens += single_tokens
+            self.sent_tokens += sent_tokens
+            self.batches += batches
+            self.fallbacks += fallbacks
 
-def call_openrouter_api(client, prompt: str, model: str = "google/gemma-3-4b-it:free", max_tokens: int = 2048) -> str:
+    def summary(self) -> str:
+        saved = self.single_tokens - self.sent_tokens
+        share = saved / self.single_tokens * 100 if self.single_tokens else 0.0
+        return (f"Пакетов: {self.batches}, поштучных повторов: {self.fallbacks}. "
+                f"Токены промпта (оценка): поштучно {self.single_tokens}, отправлено {self.sent_tokens}, "
+                f"экономия {saved} ({share:.1f}%)")
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """
+    Грубая оценка числа токенов запроса (по длине текста) плюс запас на ответ.
+    """
+    chars = sum(len(m["content"]) for m in messages)
+    return chars // CHARS_PER_TOKEN + 1 + max_tokens
+
+class RateLimiter:
+    """
+    Потокобезопасный token bucket сразу для двух лимитов: запросов в минуту и токенов в минуту.
+    acquire() блокирует поток, пока в обоих "вёдрах" не наберётся нужное количество.
+    Лимит, равный None или 0, не ограничивается.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.rpm = requests_per_minute or None
+        self.tpm = tokens_per_minute or None
+        self._requests = float(self.rpm or 0)
+        self._tokens = float(self.tpm or 0)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def _wait(self, tokens: int) -> float:
+        wait = 0.0
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+        if self.tpm and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60.0 / self.tpm)
+        return wait
+
+    def wait_time(self, tokens: int = 0) -> float:
+        """
+        Сколько секунд пришлось бы ждать acquire(tokens) сейчас (ничего не списывает).
+        """
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._wait(tokens)
+
+    def acquire(self, tokens: int = 0):
+        if self.tpm:
+            # Запрос больше всего ведра иначе никогда не пройдёт
+            tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                wait = self._wait(tokens)
+                if wait == 0.0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+def call_openrouter_api(client, prompt: str, model: str = "google/gemma-3-4b-it:free", max_tokens: int = MAX_TOKENS,
+                        messages: list = None, metrics: RunMetrics = None, raise_errors: bool = False) -> str:
     """
     Формирует запрос к OpenRouter API, используя SDK OpenAI, и возвращает сгенерированный ответ.
+    Если передан готовый список messages (пакетный режим), prompt не используется.
+    В metrics пишутся латентность запроса, ошибки по типам и токены из поля usage.
+    При raise_errors=True вместо None выбрасывается типизированный ApiError
+    (429, 5xx, таймаут, обрыв соединения, пустой ответ и т.д.).
     """
+    started = time.perf_counter()
     try:
-        # Формируем список сообщений, где:
-        #   1) идёт общее системное указание,
-        #   2) добавляются few-shot-примеры,
-        #   3) потом идёт пользовательский контент prompt.
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "Ты — виртуальный наставник, который анализирует диалог кандидата на позицию системного аналитика и интервьюера. "
-                    "На основании диалога определи сильные и слабые стороны кандидата и сформулируй "
-                    "персонализированные рекомендации. Исправляй грамматические ошибки и неточности в названиях. "
-                    "Если роли неправильно назначены, то твоя задача понять из контекста кто является кандидатом "
-                    "и сформулировать для него персонализированные рекомендации. "
-                    "Важно: верни строго валидный JSON, содержащий ровно одно поле 'output'. "
-                    "Внутри 'output' укажи:\n"
-                    "- hard_skills: [список строк]\n"
-                    "- soft_skills: [список строк]\n"
-                    "- recommendations: [список строк]\n"
-                    "Не добавляй никаких других полей и не используй Markdown-блоки. "
-                    "Пример корректной структуры:\n"
-                    "{\n"
-                    "  \"output\": {\n"
-                    "    \"hard_skills\": [\"...\"],\n"
-                    "    \"soft_skills\": [\"...\"],\n"
-                    "    \"recommendations\": [\"...\"]\n"
-                    "  }\n"
-                    "}"
-                )
-            }
-        ]
-
-        # Добавляем few-shot примеры
-        messages.extend(FEW_SHOT_EXAMPLES)
-
-        # Добавляем текущий пользовательский запрос
-        messages.append({
-            "role": "user",
-            "content": prompt
-        })
+        if messages is None:
+            messages = build_messages(prompt)
 
         completion = client.chat.completions.create(
             extra_headers={
@@ -148,23 +344,780 @@ def call_openrouter_api(client, prompt: str, model: str = "google/gemma-3-4b-it:
             max_tokens=max_tokens,
             n=1,
             stop=None,
-            temperature=0.7
+            temperature=TEMPERATURE
         )
-        return completion.choices[0].message.content.strip()
+        if metrics:
+            metrics.observe_latency(time.perf_counter() - started)
+            metrics.inc("requests")
+            metrics.record_usage(getattr(completion, "usage", None))
+        content = completion.choices[0].message.content
+        if not content or not content.strip():
+            raise MalformedResponseError("пустой ответ")
+        return content.strip()
     except Exception as e:
+        error = classify_exception(e)
+        if metrics:
+            if not isinstance(error, MalformedResponseError):
+                metrics.observe_latency(time.perf_counter() - started)
+            metrics.inc("request_errors")
+            metrics.inc(f"errors_{error.kind}")
         print(f"Error generating content: {e}")
+        if raise_errors:
+            raise error from e
         return None
 
-def main():
+def stream_openrouter_api(client, messages: list, model: str, max_tokens: int = MAX_TOKENS,
+                          metrics: RunMetrics = None, cancel: threading.Event = None) -> str:
+    """
+    Потоковый (stream=True) запрос на одиночный чанк. Ответ разбирается StreamingOutputParser
+    по мере прихода токенов: как только корневой объект закрыт, поток закрывается и возвращается
+    готовый JSON; если ответ ушёл от схемы или "растекается", запрос отменяется сразу,
+    не дожидаясь max_tokens, и выбрасывается MalformedResponseError с уже полученным текстом.
+    Если выставлен cancel (дубль запроса уже получил ответ), поток закрывается и возвращается None.
+    """
+    started = time.perf_counter()
+    parser = StreamingOutputParser()
+    received = []
+    stream = None
+    try:
+        stream = client.chat.completions.create(
+            extra_headers={
+                "HTTP-Referer": "<YOUR_SITE_URL>",
+                "X-Title": "<YOUR_SITE_NAME>"
+            },
+            extra_body={},
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            n=1,
+            stop=None,
+            temperature=TEMPERATURE,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for event in stream:
+            if cancel is not None and cancel.is_set():
+                return None
+            if metrics and getattr(event, "usage", None):
+                metrics.record_usage(event.usage)
+            choices = getattr(event, "choices", None)
+            delta = choices[0].delta.content if choices else None
+            if not delta:
+                continue
+            received.append(delta)
+            if parser.feed(delta):
+                break
+        if metrics:
+            metrics.observe_latency(time.perf_counter() - started)
+            metrics.inc("requests")
+        if not parser.done:
+            if metrics:
+                metrics.inc("errors_malformed")
+            raise MalformedResponseError("поток завершился до конца JSON", content="".join(received) or None)
+        if metrics:
+            metrics.inc("stream_early_finish")
+        return parser.text
+    except OffSchemaError as e:
+        if metrics:
+            metrics.observe_latency(time.perf_counter() - started)
+            metrics.inc("requests")
+            metrics.inc("stream_aborted")
+            metrics.inc("errors_malformed")
+        print(f"Ответ отменён на лету: {e}")
+        raise MalformedResponseError(f"ответ ушёл от схемы: {e}", content="".join(received)) from e
+    except ApiError:
+        raise
+    except Exception as e:
+        error = classify_exception(e)
+        if metrics:
+            metrics.observe_latency(time.perf_counter() - started)
+            metrics.inc("request_errors")
+            metrics.inc(f"errors_{error.kind}")
+        print(f"Error generating content: {e}")
+        raise error from e
+    finally:
+        # Закрытие потока обрывает соединение: провайдер перестаёт генерировать (и тарифицировать) токены
+        if stream is not None and hasattr(stream, "close"):
+            stream.close()
+
+def is_valid_completion(content: str) -> bool:
+    """
+    Ответ на одиночный чанк пригоден, если из него извлекается JSON с полем 'output'.
+    """
+    parsed = parse_json(content)
+    return isinstance(parsed, dict) and "output" in parsed
+
+def build_record(prompt_text: str, response_content: str, chunk_id: int, source_file: str,
+                 endpoint: str = None) -> dict:
+    """
+    Собирает итоговую запись для jsonl: распарсенный 'output' или 'raw_response', если JSON не распознан.
+    При работе через пул endpoint'ов в записи отмечается, какой endpoint дал ответ.
+    """
+    parsed_json = parse_json(response_content)
+    record = {"instruction": INSTRUCTION, "input": prompt_text}
+    if parsed_json and "output" in parsed_json:
+        record["output"] = parsed_json["output"]
+    else:
+        record["raw_response"] = response_content
+    record["chunk_id"] = chunk_id
+    record["source_file"] = source_file
+    if endpoint:
+        record["endpoint"] = endpoint
+    return record
+
+class AnnotationJob:
+    """
+    Единица работы планировщика: один чанк или пакет чанков (список (chunk_id, prompt))
+    и номер попытки.
+    """
+    __slots__ = ("tasks", "attempt")
+
+    def __init__(self, tasks: list, attempt: int = 0):
+        self.tasks = tasks
+        self.attempt = attempt
+
+    def label(self) -> str:
+        if len(self.tasks) == 1:
+            return f"чанк {self.tasks[0][0]}"
+        return f"пакет {self.tasks[0][0]}-{self.tasks[-1][0]}"
+
+class AnnotationScheduler:
+    """
+    Планировщик запросов к API с отложенными повторами.
+
+    - каждая задача выполняется в пуле потоков одной попыткой (кэш -> circuit breaker -> limiter -> API);
+    - при сбое задача не повторяется сразу, а уходит в отложенную очередь с экспоненциальным
+      backoff и jitter (не меньше Retry-After); отложенные задачи запускаются, когда свежие
+      закончились, поэтому медленный чанк не тормозит остальные;
+    - неповторяемые ошибки (4xx) и исчерпанные попытки завершают чанк с None
+      (или с последним невалидным ответом, чтобы сохранить его как raw_response);
+    - пакет, который так и не удалось получить, и отсутствующие в пакетном ответе чанки
+      заново ставятся в очередь поштучно;
+    - с пулом endpoint'ов (pool) endpoint, его лимит и дублирование запроса выбирает ModelPool,
+      а имя endpoint'а, давшего ответ, записывается в sources[chunk_id].
+    """
+
+    def __init__(self, client, model: str, concurrency: int = CONCURRENCY, limiter: RateLimiter = None,
+                 cache: CompletionCache = None, breaker: CircuitBreaker = None, report: BatchReport = None,
+                 metrics: RunMetrics = None, max_retries: int = MAX_RETRIES, stream: bool = False,
+                 pool: ModelPool = None, sources: dict = None):
+        self.client = client
+        self.model = model
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter
+        self.cache = cache
+        self.breaker = breaker or CircuitBreaker()
+        self.report = report
+        self.metrics = metrics
+        self.max_retries = max_retries
+        self.stream = stream
+        self.pool = pool
+        self.sources = sources if sources is not None else {}  # chunk_id -> endpoint, давший ответ
+
+    def attempt(self, job: AnnotationJob) -> str:
+        """
+        Одна попытка задачи. Возвращает валидный ответ или выбрасывает ApiError.
+        """
+        if len(job.tasks) == 1:
+            messages = build_messages(job.tasks[0][1])
+            max_tokens = MAX_TOKENS
+            validate = is_valid_completion
+        else:
+            messages = build_batch_messages([prompt for _, prompt in job.tasks])
+            max_tokens = MAX_TOKENS * len(job.tasks)
+            validate = lambda content: bool(parse_batch_response(content, len(job.tasks)))
+
+        if self.cache:
+            # С пулом ответ мог дать любой endpoint: ключ строится по модели, а не по составу пула
+            models = self.pool.models if self.pool else [self.model]
+            cached = self.cache.lookup([make_cache_key(model, messages, max_tokens, TEMPERATURE) for model in models])
+            if cached is not None and validate(cached[1]):
+                if self.metrics:
+                    self.metrics.inc("cache_hits")
+                if self.pool and cached[2]:
+                    for chunk_id, _ in job.tasks:
+                        self.sources[chunk_id] = cached[2]
+                return cached[1]
+
+        self.breaker.wait()
+        tokens = estimate_tokens(messages, max_tokens)
+        streamed = self.stream and len(job.tasks) == 1
+        try:
+            if self.pool:
+                # Лимиты у каждого endpoint'а свои, их учитывает пул
+                request = lambda endpoint, cancel: self._request(endpoint.client, endpoint.model, messages, max_tokens,
+                                                                 validate, streamed, cancel)
+                content, endpoint = self.pool.call(request, tokens)
+                for chunk_id, _ in job.tasks:
+                    self.sources[chunk_id] = endpoint.name
+                model, endpoint_name = endpoint.model, endpoint.name
+            else:
+                if self.limiter:
+                    self.limiter.acquire(tokens)
+                content = self._request(self.client, self.model, messages, max_tokens, validate, streamed)
+                model, endpoint_name = self.model, None
+        except ApiError as error:
+            self.breaker.record_failure(error)
+            raise
+        self.breaker.record_success()
+        if self.cache:
+            self.cache.put(make_cache_key(model, messages, max_tokens, TEMPERATURE), model, content, endpoint_name)
+        return content
+
+    def _request(self, client, model: str, messages: list, max_tokens: int, validate, streamed: bool,
+                 cancel: threading.Event = None) -> str:
+        """
+        Один запрос к конкретному клиенту и модели с проверкой ответа.
+        None — запрос отменён через cancel (его дубль уже ответил).
+        """
+        if streamed:
+            content = stream_openrouter_api(client, messages, model, max_tokens, self.metrics, cancel)
+        else:
+            content = call_openrouter_api(client, None, model, max_tokens, messages,
+                                          metrics=self.metrics, raise_errors=True)
+        if cancel is not None and cancel.is_set():
+            return None
+        if not validate(content):
+            if self.metrics:
+                self.metrics.inc("errors_malformed")
+            raise MalformedResponseError("ответ не содержит валидного JSON", content=content)
+        return content
+
+    def _run(self, job: AnnotationJob):
+        try:
+            return self.attempt(job), None
+        except ApiError as error:
+            return None, error
+
+    def _split_batch(self, job: AnnotationJob, content: str):
+        """
+        Раскладывает пакетный ответ по чанкам: (готовые пары, задачи для поштучного повтора).
+        """
+        outputs = parse_batch_response(content, len(job.tasks))
+        results, retry = [], []
+        sent_tokens = estimate_tokens(build_batch_messages([prompt for _, prompt in job.tasks]))
+        for idx, (chunk_id, prompt) in enumerate(job.tasks):
+            if idx in outputs:
+                results.append((chunk_id, json.dumps({"output": outputs[idx]}, ensure_ascii=False)))
+            else:
+                print(f"В пакетном ответе нет корректного результата для чанка {chunk_id}, запрашиваем отдельно.")
+                retry.append(AnnotationJob([(chunk_id, prompt)]))
+                sent_tokens += estimate_tokens(build_messages(prompt))
+        if self.report:
+            self.report.add(
+                single_tokens=sum(estimate_tokens(build_messages(prompt)) for _, prompt in job.tasks),
+                sent_tokens=sent_tokens,
+                batches=1,
+                fallbacks=len(retry),
+            )
+        return results, retry
+
+    def _handle_failure(self, job: AnnotationJob, error: ApiError, deferred: list):
+        """
+        Решает судьбу упавшей задачи: отложить с backoff, разбить пакет или завершить чанк.
+        Возвращает (готовые пары, задачи для немедленной постановки в очередь).
+        """
+        job.attempt += 1
+        if error.retryable and job.attempt <= self.max_retries:
+            delay = backoff_delay(job.attempt - 1, error.retry_after, base=WAIT_SECONDS)
+            print(f"Ошибка ({error.kind}) для {job.label()}, повтор #{job.attempt} отложен на {delay:.1f} с.")
+            heapq.heappush(deferred, (time.monotonic() + delay, id(job), job))
+            if self.metrics:
+                self.metrics.inc("retries")
+            return [], []
+        if len(job.tasks) > 1:
+            print(f"Не удалось получить {job.label()} ({error.kind}), запрашиваем чанки отдельно.")
+            return [], [AnnotationJob([task]) for task in job.tasks]
+        if self.metrics:
+            self.metrics.inc("failed_requests")
+        print(f"Не удалось получить ответ для {job.label()} ({error.kind}).")
+        return [(job.tasks[0][0], error.content)], []
+
+    def run(self, tasks: list, batch_size: int = BATCH_SIZE, ordered: bool = True):
+        """
+        Генератор пар (chunk_id, ответ); при ordered=True — строго в порядке tasks.
+        При прерывании (Ctrl-C, закрытие генератора) ещё не начатые запросы отменяются.
+        """
+        total = len(tasks)
+        batch_size = max(1, batch_size)
+        fresh = deque(AnnotationJob(tasks[i:i + batch_size]) for i in range(0, total, batch_size))
+        deferred = []  # куча (время готовности, id, задача)
+        running = {}
+        position = {chunk_id: pos for pos, (chunk_id, _) in enumerate(tasks)}
+        buffered = {}
+        next_pos = 0
+        done = 0
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            while fresh or deferred or running:
+                now = time.monotonic()
+                while len(running) < self.concurrency:
+                    if fresh:
+                        job = fresh.popleft()
+                    elif deferred and deferred[0][0] <= now:
+                        job = heapq.heappop(deferred)[2]
+                    else:
+                        break
+                    running[pool.submit(self._run, job)] = job
+
+                if not running:
+                    time.sleep(max(0.0, deferred[0][0] - now))
+                    continue
+                timeout = max(0.0, deferred[0][0] - now) if deferred and not fresh else None
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    job = running.pop(future)
+                    content, error = future.result()
+                    if error is not None:
+                        results, requeue = self._handle_failure(job, error, deferred)
+                    elif len(job.tasks) > 1:
+                        results, requeue = self._split_batch(job, content)
+                    else:
+                        results, requeue = [(job.tasks[0][0], content)], []
+                    fresh.extend(requeue)
+
+                    for chunk_id, response_content in results:
+                        done += 1
+                        print(f"Чанк {chunk_id + 1} готов ({done} из {total}).")
+                        if not ordered:
+                            yield chunk_id, response_content
+                            continue
+                        buffered[position[chunk_id]] = (chunk_id, response_content)
+                        while next_pos in buffered:
+                            yield buffered.pop(next_pos)
+                            next_pos += 1
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def annotate_chunks(client, tasks: list, model: str, concurrency: int = CONCURRENCY, limiter: RateLimiter = None,
+                    cache: CompletionCache = None, ordered: bool = True, batch_size: int = BATCH_SIZE,
+                    report: BatchReport = None, metrics: RunMetrics = None, breaker: CircuitBreaker = None,
+                    stream: bool = False, pool: ModelPool = None, sources: dict = None):
+    """
+    Отправляет задачи (chunk_id, prompt) через AnnotationScheduler из 'concurrency' потоков и отдаёт пары
+    (chunk_id, ответ). При ordered=True пары идут строго в порядке задач, иначе — по мере готовности.
+    При batch_size > 1 задачи группируются в пакеты по batch_size чанков на запрос.
+    При stream=True одиночные чанки запрашиваются потоково с проверкой схемы на лету.
+    С pool запросы распределяются по endpoint'ам пула, а sources заполняется именами endpoint'ов.
+    Для чанков без ответа после всех попыток отдаётся None.
+    """
+    scheduler = AnnotationScheduler(client, model, concurrency, limiter, cache, breaker, report, metrics,
+                                    stream=stream, pool=pool, sources=sources)
+    yield from scheduler.run(tasks, batch_size=batch_size, ordered=ordered)
+
+class RequestPlanner:
+    """
+    Оценка запуска без обращения к API (--plan): собирает те же списки сообщений, что уходят
+    в call_openrouter_api, и считает их токены локальным счётчиком. Системный промпт и few-shot
+    одинаковы во всех запросах, поэтому их токены считаются один раз на режим (поштучный/пакетный).
+    Ожидаемый ответ на чанк оценивается по длине few-shot-ответа, верхняя граница — max_tokens.
+    """
+
+    def __init__(self, count_tokens, batch_size: int = BATCH_SIZE):
+        self.count_tokens = count_tokens
+        self.batch_size = max(1, batch_size)
+        self._prefix_tokens = {}
+        answers = [m["content"] for m in FEW_SHOT_EXAMPLES if m["role"] == "assistant"]
+        self.answer_tokens = sum(count_tokens(a) for a in answers) // max(1, len(answers))
+
+    def prefix_tokens(self, batched: bool) -> int:
+        if batched not in self._prefix_tokens:
+            messages = build_batch_messages([""]) if batched else build_messages("")
+            self._prefix_tokens[batched] = count_message_tokens(messages[:-1], self.count_tokens)
+        return self._prefix_tokens[batched]
+
+    def plan_requests(self, tasks: list) -> dict:
+        """
+        Разбивает задачи на запросы так же, как AnnotationScheduler.run, и суммирует оценки.
+        limiter_tokens — то, что спишет RateLimiter (его оценка по символам плюс max_tokens).
+        """
+        plan = {"chunks": len(tasks), "requests": 0, "prompt_tokens": 0,
+                "completion_tokens": 0, "max_completion_tokens": 0, "limiter_tokens": 0}
+        for i in range(0, len(tasks), self.batch_size):
+            prompts = [prompt for _, prompt in tasks[i:i + self.batch_size]]
+            batched = len(prompts) > 1
+            messages = build_batch_messages(prompts) if batched else build_messages(prompts[0])
+            max_tokens = MAX_TOKENS * len(prompts)
+            plan["requests"] += 1
+            plan["prompt_tokens"] += self.prefix_tokens(batched) + count_message_tokens(messages[-1:], self.count_tokens)
+            plan["completion_tokens"] += min(max_tokens, self.answer_tokens * len(prompts))
+            plan["max_completion_tokens"] += max_tokens
+            plan["limiter_tokens"] += estimate_tokens(messages, max_tokens)
+        return plan
+
+def pending_tasks(json_file: Path, prompts: list, progress_dir: Path, input_hash: str, resume: bool) -> list:
+    """
+    Задачи (chunk_id, prompt), которые реально уйдут в API: пустые чанки пропускаются,
+    а при resume — и уже готовые по журналу (журнал только читается).
+    """
+    done = set()
+    if resume:
+        journal = ProgressJournal(progress_dir, json_file.stem)
+        journal.load()
+        if journal.input_hash == input_hash:
+            done = {cid for cid, entry in journal.entries.items() if entry.get("status") in (COMPLETED, SKIPPED)}
+    return [(cid, prompt) for cid, prompt in enumerate(prompts) if cid not in done and prompt.strip()]
+
+def estimate_duration(plan: dict, args, latency: float) -> float:
+    """
+    Грубая оценка длительности в секундах: максимум из ограничения RateLimiter
+    (вёдра изначально полные) и пропускной способности concurrency потоков при заданной латентности.
+    """
+    by_rpm = max(0.0, plan["requests"] - args.rpm) * 60.0 / args.rpm if args.rpm else 0.0
+    by_tpm = max(0.0, plan["limiter_tokens"] - args.tpm) * 60.0 / args.tpm if args.tpm else 0.0
+    by_concurrency = -(-plan["requests"] // max(1, args.concurrency)) * latency
+    return max(by_rpm, by_tpm, by_concurrency)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+def plan_files(files: list, output_dir: Path, args, count_tokens) -> dict:
+    """
+    Режим --plan: проходит тот же путь, что process_file (загрузка, чанкинг, промпты, журнал при --resume),
+    но вместо запросов печатает оценки по файлам и итог.
+    """
+    planner = RequestPlanner(count_tokens, args.batch_size)
+    totals = {}
+    price = lambda p: (p["prompt_tokens"] * args.price_prompt
+                       + p["completion_tokens"] * args.price_completion) / 1_000_000
+
+    print(f"{'файл':<50} {'чанков':>7} {'запросов':>9} {'промпт':>9} {'ответ':>9} {'макс.ответ':>11} {'время':>9} {'$':>9}")
+    for json_file in files:
+        with json_file.open("r", encoding="utf-8") as f:
+            dialogue = json.load(f).get("dialogue", [])
+        prompts = [build_input_from_chunk(chunk)
+                   for chunk in split_dialogue(dialogue, args.chunk_tokens, args.chunk_overlap, count_tokens)]
+        tasks = pending_tasks(json_file, prompts, output_dir / ".progress", chunking_hash(json_file, args), args.resume)
+        plan = planner.plan_requests(tasks)
+        for key, value in plan.items():
+            totals[key] = totals.get(key, 0) + value
+        print(f"{json_file.name:<50} {plan['chunks']:>7} {plan['requests']:>9} {plan['prompt_tokens']:>9} "
+              f"{plan['completion_tokens']:>9} {plan['max_completion_tokens']:>11} "
+              f"{format_duration(estimate_duration(plan, args, args.plan_latency)):>9} {price(plan):>9.4f}")
+
+    if not totals:
+        print("Нет файлов для обработки.")
+        return totals
+    print(f"{'ИТОГО':<50} {totals['chunks']:>7} {totals['requests']:>9} {totals['prompt_tokens']:>9} "
+          f"{totals['completion_tokens']:>9} {totals['max_completion_tokens']:>11} "
+          f"{format_duration(estimate_duration(totals, args, args.plan_latency)):>9} {price(totals):>9.4f}")
+    print(f"\nСистемный промпт + few-shot: {planner.prefix_tokens(args.batch_size > 1)} токенов на запрос "
+          f"(счётчик {args.token_counter}). Лимиты: {args.rpm:g} запросов/мин, {args.tpm:g} токенов/мин, "
+          f"{args.concurrency} потоков, латентность ~{args.plan_latency:g} с. "
+          f"Время и стоимость — по ожидаемой длине ответа; кэш ответов не учитывается.")
+    return totals
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Разметка диалогов через OpenAI-совместимый API.")
+    parser.add_argument("file", nargs="?", help="конкретный *_final.json; по умолчанию — все файлы из prepared_data")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="число одновременных запросов")
+    parser.add_argument("--rpm", type=float, default=REQUESTS_PER_MINUTE, help="лимит запросов в минуту (0 — без лимита)")
+    parser.add_argument("--tpm", type=float, default=TOKENS_PER_MINUTE, help="лимит токенов в минуту (0 — без лимита)")
+    parser.add_argument("--api-base", help="переопределяет OPENROUTER_API_BASE, например адрес локального stub-сервера")
+    parser.add_argument("--model", help="переопределяет MODEL_NAME")
+    parser.add_argument("--chunk-tokens", type=int, default=0,
+                        help="бюджет токенов на чанк (0 — фиксированные чанки по 4 реплики)")
+    parser.add_argument("--chunk-overlap", type=int, default=0,
+                        help="сколько последних пар вопрос-ответ повторять в следующем чанке")
+    parser.add_argument("--token-counter", default="chars",
+                        help="локальный счётчик токенов: chars, tiktoken:<encoding> или hf:<токенайзер>")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="сколько чанков отправлять в одном запросе (1 — поштучно)")
+    parser.add_argument("--stream", action="store_true",
+                        help="потоковые ответы: проверять JSON на лету и отменять ответ, ушедший от схемы")
+    parser.add_argument("--endpoints",
+                        help="JSON со списком endpoint'ов (api_base, api_key_env, model, weight, rpm, tpm) "
+                             "вместо одного API_BASE/MODEL_NAME из .env")
+    parser.add_argument("--hedge", action="store_true",
+                        help="с --endpoints: дублировать запрос на другой endpoint, если он дольше p95")
+    parser.add_argument("--queue",
+                        help="SQLite-очередь задач (source_file, chunk_id), общая для нескольких процессов или машин; "
+                             "каждый воркер запускается этой же командой")
+    parser.add_argument("--worker-id", help="имя воркера для --queue (по умолчанию <хост>-<pid>)")
+    parser.add_argument("--lease", type=float, default=LEASE_SECONDS,
+                        help="аренда задачи в секундах: задачи воркера без heartbeat дольше этого уходят другим")
+    parser.add_argument("--merge", action="store_true",
+                        help="с --queue: только собрать *_samples.jsonl из шардов воркеров")
+    parser.add_argument("--breaker-threshold", type=int, default=BREAKER_THRESHOLD,
+                        help="сколько сбоев провайдера подряд приостанавливают все запросы (0 — отключить)")
+    parser.add_argument("--breaker-cooldown", type=float, default=BREAKER_COOLDOWN,
+                        help="на сколько секунд приостанавливать запросы")
+    parser.add_argument("--plan", action="store_true",
+                        help="не обращаться к API, а оценить число запросов, токены, время и стоимость")
+    parser.add_argument("--plan-latency", type=float, default=10.0,
+                        help="предполагаемая латентность одного запроса для --plan, с")
+    parser.add_argument("--resume", action="store_true",
+                        help="продолжить прерванный запуск: обработать только отсутствующие и failed чанки")
+    parser.add_argument("--report", help="куда записать JSON-отчёт о запуске (по умолчанию reports/dataset_pipeline-<время>.json)")
+    parser.add_argument("--prometheus", help="дополнительно записать метрики в Prometheus textfile")
+    parser.add_argument("--profile", action="store_true", help="профилировать запуск (cProfile + tracemalloc)")
+    parser.add_argument("--price-prompt", type=float, default=0.0, help="цена 1M токенов промпта, $")
+    parser.add_argument("--price-completion", type=float, default=0.0, help="цена 1M токенов ответа, $")
+    parser.add_argument("--no-cache", action="store_true", help="не читать и не писать кэш ответов")
+    parser.add_argument("--refresh-cache", action="store_true", help="игнорировать кэш, но перезаписать его свежими ответами")
+    parser.add_argument("--cache-path", default=str(DEFAULT_CACHE_PATH), help="путь к SQLite-кэшу ответов")
+    parser.add_argument("--cache-max-mb", type=float, default=512, help="максимальный размер кэша в МБ")
+    parser.add_argument("--cache-max-age-days", type=float, default=30, help="максимальный возраст записи кэша в днях")
+    return parser.parse_args(argv)
+
+def chunking_hash(json_file: Path, args) -> str:
+    """
+    Хэш входа для журнала прогресса. Параметры чанкинга входят в хэш:
+    при их изменении chunk_id указывают на другие реплики.
+    """
+    chunking = f"{args.chunk_tokens}:{args.chunk_overlap}:{args.token_counter}" if args.chunk_tokens else f"fixed:{CHUNK_SIZE}"
+    return hashlib.sha256(f"{file_sha256(json_file)}:{chunking}".encode("utf-8")).hexdigest()
+
+def process_file(json_file: Path, output_dir: Path, client, model_name: str, args, limiter: RateLimiter,
+                 cache: CompletionCache, report: BatchReport, metrics: RunMetrics, breaker: CircuitBreaker = None,
+                 count_tokens=None, pool: ModelPool = None):
+    """
+    Размечает один *_final.json: чанкинг, запросы к API через журнал прогресса и запись итогового jsonl.
+    """
+    print(f"\nОбработка файла: {json_file.name}")
+    with metrics.stage("load", json_file.name):
+        with json_file.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+
+    dialogue = data.get("dialogue", [])
+    if not dialogue:
+        print("Пустой диалог, пропускаем...")
+        return
+    
+    out_file = output_dir / f"{json_file.stem}_samples.jsonl"
+
+    with metrics.stage("chunk", json_file.name):
+        chunks = split_dialogue(dialogue, args.chunk_tokens, args.chunk_overlap, count_tokens)
+        prompts = [build_input_from_chunk(chunk) for chunk in chunks]
+
+    journal = ProgressJournal(output_dir / ".progress", json_file.stem)
+    journal.start(chunking_hash(json_file, args), len(prompts), resume=args.resume)
+    pending = journal.pending()
+    if args.resume:
+        print(f"Осталось обработать {len(pending)} из {len(prompts)} чанков.")
+
+    tasks = []
+    for chunk_id in pending:
+        if prompts[chunk_id].strip():
+            tasks.append((chunk_id, prompts[chunk_id]))
+        else:
+            journal.append(chunk_id, SKIPPED)
+            metrics.inc("skipped_chunks")
+
+    sources = {}
+    try:
+        with metrics.stage("annotate", json_file.name):
+            for chunk_id, response_content in annotate_chunks(client, tasks, model_name, args.concurrency, limiter,
+                                                              cache, ordered=False, batch_size=args.batch_size,
+                                                              report=report, metrics=metrics, breaker=breaker,
+                                                              stream=args.stream, pool=pool, sources=sources):
+                # Если после всех попыток нет ответа, отмечаем чанк как failed — его подберёт --resume
+                if not response_content:
+                    print(f"Пропускаем чанк {chunk_id} — нет ответа, помечен как failed.")
+                    journal.append(chunk_id, FAILED)
+                    metrics.inc("failed_chunks")
+                    continue
+
+                final_data = build_record(prompts[chunk_id], response_content, chunk_id, json_file.name,
+                                          sources.get(chunk_id))
+                journal.append(chunk_id, COMPLETED, final_data)
+                metrics.inc("records")
+                if "raw_response" in final_data:
+                    metrics.inc("parse_failures")
+    finally:
+        journal.close()
+
+    with metrics.stage("finalize", json_file.name):
+        journal.finalize(out_file)
+    summary = journal.summary()
+    print(f"Результаты сохранены в {out_file}: completed={len(summary[COMPLETED])}, "
+          f"failed={len(summary[FAILED])}, skipped={len(summary[SKIPPED])}")
+
+def file_prompts(json_file: Path, args, count_tokens=None) -> list:
+    """
+    Промпты чанков файла — тот же чанкинг, что в process_file.
+    """
+    with json_file.open("r", encoding="utf-8") as f:
+        dialogue = json.load(f).get("dialogue", [])
+    return [build_input_from_chunk(chunk)
+            for chunk in split_dialogue(dialogue, args.chunk_tokens, args.chunk_overlap, count_tokens)]
+
+def enqueue_files(work_queue: WorkQueue, files: list, args, count_tokens=None):
+    """
+    Ставит чанки файлов в общую очередь (повторная постановка того же входа ничего не меняет).
+    Пустые чанки сразу отмечаются skipped, при --resume failed-чанки возвращаются в очередь.
+    """
+    for json_file in files:
+        prompts = file_prompts(json_file, args, count_tokens)
+        if not prompts:
+            print(f"{json_file.name}: пустой диалог, пропускаем...")
+            continue
+        skipped = [chunk_id for chunk_id, prompt in enumerate(prompts) if not prompt.strip()]
+        state = work_queue.add_file(json_file.name, str(json_file), chunking_hash(json_file, args), len(prompts),
+                                    skipped, retry_failed=args.resume)
+        if state != "existing":
+            print(f"{json_file.name}: {len(prompts)} чанков поставлено в очередь" +
+                  (" (вход изменился, разметка файла начата заново)" if state == "reset" else ""))
+
+def run_queue_worker(work_queue: WorkQueue, worker: str, output_dir: Path, client, model_name: str, args,
+                     limiter: RateLimiter, cache: CompletionCache, report: BatchReport, metrics: RunMetrics,
+                     breaker: CircuitBreaker = None, count_tokens=None, pool: ModelPool = None):
+    """
+    Воркер общей очереди: арендует задачи пачками по concurrency * batch_size * 2 (из любых файлов),
+    размечает их через annotate_chunks, пишет записи в свой шард и отмечает задачи в очереди.
+    Когда свободных задач нет, ждёт, пока закончат (или потеряют аренду) другие воркеры;
+    последний закончивший воркер собирает итоговые *_samples.jsonl из всех шардов.
+    """
+    shard = ShardWriter(output_dir / SHARD_DIR, worker)
+    prompts = {}  # (source_file, input_hash) -> промпты чанков
+    limit = max(1, args.concurrency * args.batch_size * 2)
+    try:
+        with LeaseKeeper(work_queue, worker, args.lease):
+            while True:
+                claimed = work_queue.claim(worker, limit, args.lease)
+                if not claimed:
+                    if work_queue.active():
+                        time.sleep(min(args.lease / 3, POLL_INTERVAL))
+                        continue
+                    # Очередь пуста: файлы собирает закончивший последним; если при сборке
+                    # чанки вернулись в очередь (запись потеряна), воркер доразмечает их
+                    names = work_queue.claim_merge(worker, args.lease)
+                    if names:
+                        with metrics.stage("finalize"):
+                            merge_shards(work_queue, output_dir / SHARD_DIR, output_dir, names)
+                    if not work_queue.active():
+                        if not work_queue.unmerged():
+                            break
+                        # Файлы собирает другой воркер; если он упадёт, сборка перейдёт к нам по истечении аренды
+                        time.sleep(min(args.lease / 3, POLL_INTERVAL))
+                    continue
+
+                tasks = []
+                for idx, (source_file, chunk_id, path, input_hash) in enumerate(claimed):
+                    if (source_file, input_hash) not in prompts:
+                        json_file = Path(path)
+                        if chunking_hash(json_file, args) != input_hash:
+                            raise RuntimeError(f"{json_file}: вход или параметры чанкинга отличаются от поставленных "
+                                               f"в очередь {work_queue.path}")
+                        prompts[(source_file, input_hash)] = file_prompts(json_file, args, count_tokens)
+                    tasks.append((idx, prompts[(source_file, input_hash)][chunk_id]))
+
+                # chunk_id разных файлов совпадают, поэтому внутри пачки задачи нумеруются по порядку
+                sources = {}
+                with metrics.stage("annotate", worker):
+                    for idx, response_content in annotate_chunks(client, tasks, model_name, args.concurrency, limiter,
+                                                                 cache, ordered=False, batch_size=args.batch_size,
+                                                                 report=report, metrics=metrics, breaker=breaker,
+                                                                 stream=args.stream, pool=pool, sources=sources):
+                        source_file, chunk_id, _, input_hash = claimed[idx]
+                        if not response_content:
+                            status = work_queue.finish(source_file, chunk_id, FAILED)
+                            print(f"{source_file}: чанк {chunk_id} без ответа, статус в очереди — {status}.")
+                            metrics.inc("failed_chunks")
+                            continue
+                        final_data = build_record(tasks[idx][1], response_content, chunk_id, source_file,
+                                                  sources.get(idx))
+                        shard.append(source_file, input_hash, chunk_id, final_data)
+                        work_queue.finish(source_file, chunk_id, COMPLETED)
+                        metrics.inc("records")
+                        if "raw_response" in final_data:
+                            metrics.inc("parse_failures")
+    finally:
+        work_queue.release(worker)
+        shard.close()
+
+    counts = work_queue.counts()
+    print(f"\nОчередь {work_queue.path}: completed={counts[COMPLETED]}, failed={counts[FAILED]}, "
+          f"skipped={counts[SKIPPED]}")
+
+def write_run_report(metrics: RunMetrics, args, model_name: str, cache: CompletionCache,
+                     breaker: CircuitBreaker = None, pool: ModelPool = None):
+    """
+    Сохраняет JSON-отчёт (и при необходимости Prometheus textfile) с производными метриками:
+    доля ответов без валидного JSON и оценка стоимости по ценам за 1M токенов.
+    """
+    counters = metrics.snapshot()["counters"]
+    records = counters.get("records", 0)
+    cost = (counters.get("prompt_tokens", 0) * args.price_prompt
+            + counters.get("completion_tokens", 0) * args.price_completion) / 1_000_000
+    extra = {
+        "model": model_name,
+        "parse_failure_rate": counters.get("parse_failures", 0) / records if records else 0.0,
+        "estimated_cost_usd": round(cost, 6),
+    }
+    if cache:
+        extra["cache"] = cache.stats()
+    if breaker:
+        extra["circuit_breaker_trips"] = breaker.trips
+    if pool:
+        extra["endpoints"] = pool.summary()
+
+    report_path = Path(args.report) if args.report else default_report_path("dataset_pipeline")
+    if args.profile:
+        metrics.stop_profiling(report_path.with_suffix(".prof"))
+    metrics.write_json(report_path, extra)
+    print(f"\nОтчёт о запуске сохранён в {report_path}: запросов {counters.get('requests', 0)}, "
+          f"повторов {counters.get('retries', 0)}, токенов {counters.get('prompt_tokens', 0)}"
+          f"+{counters.get('completion_tokens', 0)}, стоимость ~${cost:.4f}")
+    if args.prometheus:
+        metrics.write_prometheus(Path(args.prometheus), {
+            "parse_failure_rate": extra["parse_failure_rate"],
+            "estimated_cost_usd": extra["estimated_cost_usd"],
+        })
+
+def new_client(api_base: str, api_key: str) -> OpenAI:
+    """
+    Клиент без встроенных повторов SDK: 429, 5xx и таймауты должен видеть AnnotationScheduler —
+    иначе SDK молча повторяет их в рабочем потоке мимо backoff, Retry-After, circuit breaker'а и метрик.
+    """
+    return OpenAI(base_url=api_base, api_key=api_key, max_retries=0)
+
+def make_client(args):
+    """
+    Клиент OpenAI-совместимого API и имя модели: из .env, с переопределением --api-base/--model.
+    """
+    config = load_env()
+    api_base = args.api_base or config["API_BASE"]
+    model_name = args.model or config["MODEL_NAME"]
+    return new_client(api_base, config["API_KEY"]), model_name
+
+def make_pool(args) -> ModelPool:
+    """
+    Пул endpoint'ов из --endpoints (None, если не задан). Адрес и ключ, не указанные
+    в конфиге, берутся из .env; лимиты по умолчанию — --rpm/--tpm для каждого endpoint'а.
+    """
+    if not args.endpoints:
+        return None
     config = load_env()
-    api_key = config["API_KEY"]
-    api_base = config["API_BASE"]
-    model_name = config["MODEL_NAME"]
-    client = OpenAI(base_url=api_base, api_key=api_key)
+    env = dotenv_values(".env")
+    return build_pool(
+        load_endpoint_config(Path(args.endpoints)),
+        env,
+        lambda api_base, api_key: new_client(api_base or config["API_BASE"], api_key or config["API_KEY"]),
+        lambda rpm, tpm: RateLimiter(args.rpm if rpm is None else rpm, args.tpm if tpm is None else tpm),
+        hedge=args.hedge,
+    )
+
+def make_cache(args) -> CompletionCache:
+    if args.no_cache:
+        return None
+    return CompletionCache(
+        Path(args.cache_path),
+        max_bytes=int(args.cache_max_mb * 1024 * 1024),
+        max_age=args.cache_max_age_days * 24 * 3600,
+        refresh=args.refresh_cache,
+    )
+
+def main():
+    args = parse_args()
+    count_tokens = make_token_counter(args.token_counter)
 
     # Проверяем, передан ли путь к конкретному файлу:
-    if len(sys.argv) > 1:
-        file_to_process = Path(sys.argv[1])
+    if args.file:
+        file_to_process = Path(args.file)
         if not file_to_process.is_file():
             print(f"Файл {file_to_process} не найден.")
             return
@@ -176,83 +1129,57 @@ def main():
         files = list(prepared_data_dir.glob("*_final.json"))
 
     output_dir = Path("finetuning_samples")
+    if args.plan:
+        plan_files(files, output_dir, args, count_tokens)
+        return
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    for json_file in files:
-        print(f"\nОбработка файла: {json_file.name}")
-        with json_file.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+    work_queue = None
+    if args.queue:
+        # Несколько воркеров делят одну очередь: каждый ставит файлы (повторно — без изменений) и размечает
+        work_queue = WorkQueue(Path(args.queue))
+        if args.merge:
+            merge_shards(work_queue, output_dir / SHARD_DIR, output_dir)
+            work_queue.close()
+            return
+        enqueue_files(work_queue, files, args, count_tokens)
 
-        dialogue = data.get("dialogue", [])
-        if not dialogue:
-            print("Пустой диалог, пропускаем...")
-            continue
-        
-        out_file = output_dir / f"{json_file.stem}_samples.jsonl"
-
-        chunks = list(chunk_dialogue(dialogue, chunk_size=4))
-        total_chunks = len(chunks)
-
-        with out_file.open("w", encoding="utf-8") as outfile:
-            for chunk_id, chunk in enumerate(chunks):
-                print(f"Обрабатываем чанк {chunk_id + 1} из {total_chunks}...")
-                prompt_text = build_input_from_chunk(chunk)
-
-                # Делаем несколько попыток (retry), если ответ не получен
-                response_content = None
-                for attempt in range(MAX_RETRIES + 1):
-                    if attempt > 0:
-                        print(f"Повторная попытка #{attempt} для чанка {chunk_id}")
-                    # Задержка перед запросом
-                    time.sleep(WAIT_SECONDS)
-
-                    completion = call_openrouter_api(
-                        client=client,
-                        prompt=prompt_text,
-                        model=model_name,
-                        max_tokens=2048
-                    )
-                    if completion:
-                        response_content = completion
-                        break
-                    else:
-                        print("Не удалось получить ответ от API.")
-                        # Если еще есть попытки - будем пробовать снова
-                        # Если нет, прервёмся и пропустим этот чанк
+    pool = make_pool(args)
+    if pool:
+        client, model_name = None, pool.name
+    else:
+        client, model_name = make_client(args)
+    limiter = RateLimiter(args.rpm, args.tpm)
+    report = BatchReport()
+    breaker = CircuitBreaker(args.breaker_threshold, args.breaker_cooldown)
+    metrics = RunMetrics("dataset_pipeline", profile=args.profile)
+    cache = make_cache(args)
 
-                # Если после всех попыток нет ответа, переходим к следующему чанку
-                if not response_content:
-                    print(f"Пропускаем чанк {chunk_id} окончательно — нет ответа.")
-                    continue
+    metrics.start_profiling()
+    try:
+        if work_queue:
+            worker = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+            run_queue_worker(work_queue, worker, output_dir, client, model_name, args, limiter, cache, report,
+                             metrics, breaker, count_tokens, pool)
+        else:
+            for json_file in files:
+                process_file(json_file, output_dir, client, model_name, args, limiter, cache, report, metrics,
+                             breaker, count_tokens, pool)
+    finally:
+        if work_queue:
+            work_queue.close()
+        if args.batch_size > 1:
+            print(f"\n{report.summary()}")
+        write_run_report(metrics, args, model_name, cache, breaker, pool)
+        if pool:
+            pool.close()
 
-                # Иначе парсим ответ
-                parsed_json = parse_json(response_content)
-                if parsed_json and "output" in parsed_json:
-                    final_data = {
-                        "instruction": (
-                            "Представь, что ты виртуальный наставник. "
-                            "Определи сильные и слабые стороны кандидата по диалогу и сформулируй рекомендации."
-                        ),
-                        "input": prompt_text,
-                        "output": parsed_json["output"],
-                        "chunk_id": chunk_id,
-                        "source_file": json_file.name
-                    }
-                else:
-                    final_data = {
-                        "instruction": (
-                            "Представь, что ты виртуальный наставник. "
-                            "Определи сильные и слабые стороны кандидата по диалогу и сформулируй рекомендации."
-                        ),
-                        "input": prompt_text,
-                        "raw_response": response_content,
-                        "chunk_id": chunk_id,
-                        "source_file": json_file.name
-                    }
-
-                outfile.write(json.dumps(final_data, ensure_ascii=False) + "\n")
-        
-        print(f"Результаты сохранены в {out_file}")
+    if cache:
+        cache.evict()
+        stats = cache.stats()
+        print(f"\nКэш ответов: попаданий {stats['hits']}, промахов {stats['misses']}, "
+              f"записей {stats['entries']}, {stats['bytes'] / 1024 / 1024:.1f} МБ")
+        cache.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
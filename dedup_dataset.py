@@ -0,0 +1,249 @@
+import json
+import zlib
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from assemble_dataset import CLEANED_FILE, open_atomic, commit_atomic
+from run_metrics import default_report_path
+
+DEDUP_FILE = "merged_finetuning_samples_dedup.jsonl"
+NUM_PERM = 128           # длина MinHash-сигнатуры
+SHINGLE_SIZE = 5         # символьные n-граммы
+INPUT_THRESHOLD = 0.8    # порог сходства (Жаккар) для input
+OUTPUT_THRESHOLD = 0.8   # порог сходства для сериализованного output
+SEED = 1
+SIGNATURE_BATCH = 2048   # сколько текстов хэшируется одной векторной операцией
+
+_BASE = np.uint32(0x01000193)   # основание полиномиального хэша n-грамм
+_DENSIFY = np.uint32(0x9E3779B1)  # сдвиг значений, заимствованных пустыми корзинами
+
+
+def _mix32(h: np.ndarray) -> np.ndarray:
+    """
+    Финализатор murmur3: перемешивает биты 32-битных хэшей (арифметика по модулю 2^32).
+    """
+    h = h ^ (h >> np.uint32(16))
+    h = h * np.uint32(0x85EBCA6B)
+    h = h ^ (h >> np.uint32(13))
+    h = h * np.uint32(0xC2B2AE35)
+    return h ^ (h >> np.uint32(16))
+
+
+def record_fields(record: dict) -> dict:
+    """
+    Тексты, по которым ищутся дубликаты: диалог и output, сериализованный с сортировкой ключей.
+    """
+    return {
+        "input": record.get("input", ""),
+        "output": json.dumps(record.get("output"), ensure_ascii=False, sort_keys=True),
+    }
+
+
+def normalize(text: str, size: int = SHINGLE_SIZE) -> str:
+    """
+    Нижний регистр и схлопнутые пробелы; текст короче n дополняется пробелами до одной n-граммы.
+    """
+    return " ".join(text.lower().split()).ljust(size)
+
+
+class MinHasher:
+    """
+    MinHash-сигнатуры длины num_perm по схеме one permutation hashing с densification
+    (Shrivastava, Li): хэши символьных n-грамм раскладываются по num_perm корзинам, в корзине
+    берётся минимум, пустые корзины заимствуют значение ближайшей непустой справа. Доля совпавших
+    позиций двух сигнатур оценивает коэффициент Жаккара, как у классического MinHash, но вычисление
+    линейно по числу n-грамм, а не по произведению n-грамм на num_perm хэш-функций.
+
+    Сигнатуры считаются пачкой: тексты склеиваются в один массив кодов символов, хэши n-грамм,
+    корзины и минимумы вычисляются векторно для всей пачки, без цикла Python по текстам.
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = SEED):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = np.uint32(zlib.crc32(str(seed).encode("utf-8")))
+
+    def signatures(self, texts: list) -> np.ndarray:
+        """
+        Матрица сигнатур (len(texts), num_perm) типа uint32.
+        """
+        size, num_perm = self.shingle_size, self.num_perm
+        texts = [normalize(text, size) for text in texts]
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+        ends = np.cumsum(lengths)
+        codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+
+        # Полиномиальный хэш всех окон длины size; окна, пересекающие границу текста, отбрасываются
+        count = max(0, len(codes) - size + 1)
+        hashes = np.zeros(count, dtype=np.uint32)
+        for offset in range(size):
+            hashes = hashes * _BASE + codes[offset:offset + count]
+        rows = np.repeat(np.arange(len(texts)), lengths)[:count]
+        valid = np.arange(count) + size <= ends[rows]
+        hashes, rows = _mix32(hashes[valid]), rows[valid]
+
+        cells = rows * num_perm + (hashes % np.uint32(num_perm))
+        signatures = np.full(len(texts) * num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+        np.minimum.at(signatures, cells, _mix32(hashes ^ self.seed))
+        signatures = signatures.reshape(len(texts), num_perm)
+
+        # Densification: для каждой пустой корзины — ближайшая непустая справа (по кругу)
+        filled = (np.bincount(cells, minlength=len(texts) * num_perm) > 0).reshape(len(texts), num_perm)
+        positions = np.where(np.hstack([filled, filled]), np.arange(2 * num_perm), 2 * num_perm)
+        nearest = np.minimum.accumulate(positions[:, ::-1], axis=1)[:, ::-1][:, :num_perm]
+        source = nearest % num_perm
+        distance = (nearest - np.arange(num_perm)).astype(np.uint32)
+        borrowed = np.take_along_axis(signatures, source, axis=1) + distance * _DENSIFY
+        return np.where(filled, signatures, borrowed)
+
+
+def lsh_params(threshold: float, num_perm: int) -> tuple:
+    """
+    Число полос b и строк в полосе r (b * r <= num_perm), при которых порог S-кривой
+    (1/b)^(1/r) ближе всего к заданному порогу сходства.
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, x: int) -> int:
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x: int, y: int) -> int:
+        """
+        Объединяет кластеры и возвращает корень поглощённого. Представителем кластера
+        остаётся запись, встретившаяся раньше.
+        """
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return None
+        self.parent[max(x, y)] = min(x, y)
+        return max(x, y)
+
+
+def find_near_duplicates(signatures: np.ndarray, threshold: float, clusters: UnionFind, field: str,
+                         edges: dict) -> int:
+    """
+    LSH по полосам сигнатур: записи с одинаковой полосой — кандидаты. Каждый кандидат сравнивается
+    только с первой записью корзины (линейно даже для больших корзин), пара принимается,
+    если доля совпавших позиций сигнатур (оценка Жаккара) не ниже threshold.
+    Для каждого поглощённого корня в edges сохраняется пара, через которую произошло объединение.
+    """
+    count, num_perm = signatures.shape
+    bands, rows = lsh_params(threshold, num_perm)
+    linked = 0
+    for band in range(bands):
+        chunk = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = chunk.view(np.dtype((np.void, chunk.dtype.itemsize * rows))).ravel()
+        # Корзины полосы считаются векторно: first[i] — первая запись с той же полосой, что и у i
+        _, first_idx, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        first_of = first_idx[inverse.ravel()]
+        for idx in np.flatnonzero(first_of != np.arange(count)).tolist():
+            first = int(first_of[idx])
+            if clusters.find(first) == clusters.find(idx):
+                continue
+            similarity = float(np.mean(signatures[first] == signatures[idx]))
+            if similarity >= threshold:
+                absorbed = clusters.union(first, idx)
+                edges[absorbed] = {"field": field, "pair": (first, idx), "similarity": round(similarity, 3)}
+                linked += 1
+    return linked
+
+
+def dedup(records: list, input_threshold: float = INPUT_THRESHOLD, output_threshold: float = OUTPUT_THRESHOLD,
+          num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE) -> tuple:
+    """
+    Возвращает (оставленные записи, кластеры). Дубликатами считаются записи, близкие по input
+    или по output (порог 0 отключает поле); в каждом кластере остаётся первая по порядку запись.
+    """
+    hasher = MinHasher(num_perm, shingle_size)
+    clusters = UnionFind(len(records))
+    edges = {}
+    for field, threshold in (("input", input_threshold), ("output", output_threshold)):
+        if not threshold or not records:
+            continue
+        signatures = np.vstack([
+            hasher.signatures([record_fields(record)[field] for record in records[start:start + SIGNATURE_BATCH]])
+            for start in range(0, len(records), SIGNATURE_BATCH)
+        ])
+        find_near_duplicates(signatures, threshold, clusters, field, edges)
+
+    groups = {}
+    for idx in range(len(records)):
+        groups.setdefault(clusters.find(idx), []).append(idx)
+
+    key = lambda idx: {"source_file": records[idx].get("source_file"), "chunk_id": records[idx].get("chunk_id")}
+    kept, report = [], []
+    for root, members in groups.items():
+        kept.append(records[root])
+        if len(members) > 1:
+            report.append({
+                "kept": key(root),
+                # Каждая не оставленная запись когда-то была поглощённым корнем, поэтому у неё есть ребро
+                "collapsed": [dict(key(idx), field=edges[idx]["field"], similarity=edges[idx]["similarity"],
+                                   matched_pair=[key(i) for i in edges[idx]["pair"]])
+                              for idx in members[1:]],
+            })
+    return kept, report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Удаление почти-дубликатов (MinHash/LSH) из очищенного датасета.")
+    parser.add_argument("--input", default=CLEANED_FILE, help="входной JSONL")
+    parser.add_argument("--output", default=DEDUP_FILE, help="куда записать JSONL без дубликатов")
+    parser.add_argument("--report", help="JSON-отчёт о схлопнутых записях (по умолчанию reports/dedup-<время>.json)")
+    parser.add_argument("--input-threshold", type=float, default=INPUT_THRESHOLD,
+                        help="порог сходства input (0 — не сравнивать)")
+    parser.add_argument("--output-threshold", type=float, default=OUTPUT_THRESHOLD,
+                        help="порог сходства output (0 — не сравнивать)")
+    parser.add_argument("--num-perm", type=int, default=NUM_PERM, help="длина MinHash-сигнатуры")
+    parser.add_argument("--shingle-size", type=int, default=SHINGLE_SIZE, help="длина символьной n-граммы")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    with open(args.input, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    kept, clusters = dedup(records, args.input_threshold, args.output_threshold, args.num_perm, args.shingle_size)
+
+    output_path = Path(args.output)
+    out = open_atomic(output_path)
+    for record in kept:
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    commit_atomic(out, output_path)
+
+    report_path = Path(args.report) if args.report else default_report_path("dedup")
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps({
+        "input": args.input,
+        "rows": len(records),
+        "kept": len(kept),
+        "removed": len(records) - len(kept),
+        "input_threshold": args.input_threshold,
+        "output_threshold": args.output_threshold,
+        "num_perm": args.num_perm,
+        "shingle_size": args.shingle_size,
+        "clusters": clusters,
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Записей: {len(records)}, оставлено {len(kept)}, удалено дубликатов {len(records) - len(kept)} "
+          f"в {len(clusters)} кластерах. Результат: {output_path}, отчёт: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from json_parsing import parse_json, OUTPUT_FIELDS
+from assemble_dataset import CLEANED_FILE
+from run_metrics import default_report_path
+
+PREDICTION_FIELD = "prediction"
+
+
+def normalize_item(item: str) -> str:
+    """
+    Элементы списков сравниваются без учёта регистра, лишних пробелов и точки в конце.
+    """
+    return " ".join(str(item).lower().split()).rstrip(".;")
+
+
+def prediction_output(prediction):
+    """
+    Разбирает предсказание (сырой текст модели или уже распарсенный JSON) так же, как dataset_pipeline.
+    Возвращает (распарсенный JSON или None, соответствует ли он схеме).
+    Схема строгая, как требует системный промпт: ровно поле 'output' с тремя списками строк.
+    """
+    parsed = prediction if isinstance(prediction, dict) else parse_json(prediction) if isinstance(prediction, str) else None
+    if not isinstance(parsed, dict):
+        return None, False
+    output = parsed.get("output")
+    compliant = (
+        set(parsed) == {"output"}
+        and isinstance(output, dict)
+        and set(output) == set(OUTPUT_FIELDS)
+        and all(isinstance(output[f], list) and all(isinstance(v, str) for v in output[f]) for f in OUTPUT_FIELDS)
+    )
+    return parsed, compliant
+
+
+def load_jsonl(path: Path) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ItemEncoder:
+    """
+    Кодирует пары (номер примера, нормализованный элемент) в int64-ключи,
+    чтобы пересечения множеств считались np.isin по всей выборке сразу.
+    """
+
+    def __init__(self):
+        self.vocab = {}
+
+    def encode(self, lists: list) -> np.ndarray:
+        keys = {
+            (sample << 32) + self.vocab.setdefault(normalize_item(item), len(self.vocab))
+            for sample, items in enumerate(lists) for item in items
+        }
+        return np.fromiter(keys, dtype=np.int64, count=len(keys))
+
+
+def set_counts(references: list, predictions: list, encoder: ItemEncoder) -> dict:
+    """
+    Для каждого примера: число совпавших, предсказанных и эталонных уникальных элементов.
+    """
+    n = len(references)
+    ref_keys, pred_keys = encoder.encode(references), encoder.encode(predictions)
+    tp_keys = pred_keys[np.isin(pred_keys, ref_keys)]
+    return {
+        "tp": np.bincount(tp_keys >> 32, minlength=n),
+        "pred": np.bincount(pred_keys >> 32, minlength=n),
+        "ref": np.bincount(ref_keys >> 32, minlength=n),
+    }
+
+
+def prf(tp, pred, ref) -> dict:
+    """
+    Micro-precision/recall/F1 по суммам счётчиков.
+    """
+    tp, pred, ref = float(tp), float(pred), float(ref)
+    precision = tp / pred if pred else 0.0
+    recall = tp / ref if ref else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": round(precision, 4), "recall": round(recall, 4), "f1": round(f1, 4)}
+
+
+def evaluate(references: list, predictions: list, prediction_field: str = PREDICTION_FIELD) -> dict:
+    """
+    Сопоставляет предсказания с эталоном по (source_file, chunk_id) и считает метрики:
+    долю валидного JSON, долю ответов по схеме, micro-P/R/F1 и средний по примерам F1
+    для каждого поля output — в целом и по source_file. Отсутствующее или нераспарсенное
+    предсказание считается пустым.
+    """
+    by_key = {}
+    for record in predictions:
+        by_key[(record.get("source_file"), record.get("chunk_id"))] = record.get(prediction_field)
+    ref_keys = {(r.get("source_file"), r.get("chunk_id")) for r in references}
+
+    files, file_idx = np.unique([r.get("source_file") or "" for r in references], return_inverse=True)
+    files = files.tolist()
+    has_prediction = np.zeros(len(references), dtype=bool)
+    valid = np.zeros(len(references), dtype=bool)
+    compliant = np.zeros(len(references), dtype=bool)
+    predicted_outputs = []
+    for i, record in enumerate(references):
+        key = (record.get("source_file"), record.get("chunk_id"))
+        has_prediction[i] = key in by_key
+        parsed, compliant[i] = prediction_output(by_key.get(key))
+        valid[i] = parsed is not None
+        output = parsed.get("output") if isinstance(parsed, dict) else None
+        predicted_outputs.append(output if isinstance(output, dict) else {})
+
+    encoder = ItemEncoder()
+    counts = {}
+    for field in OUTPUT_FIELDS:
+        as_list = lambda value: value if isinstance(value, list) else []
+        counts[field] = set_counts(
+            [as_list((r.get("output") or {}).get(field)) for r in references],
+            [as_list(out.get(field)) for out in predicted_outputs],
+            encoder,
+        )
+
+    def summarize(selector: np.ndarray) -> dict:
+        n = int(selector.sum())
+        summary = {
+            "samples": n,
+            "predicted": int(has_prediction[selector].sum()),
+            "json_valid_rate": round(float(valid[selector].mean()), 4) if n else 0.0,
+            "schema_compliance_rate": round(float(compliant[selector].mean()), 4) if n else 0.0,
+        }
+        for field in OUTPUT_FIELDS:
+            c = {name: values[selector] for name, values in counts[field].items()}
+            per_sample_p = np.divide(c["tp"], c["pred"], out=np.zeros(n), where=c["pred"] > 0)
+            per_sample_r = np.divide(c["tp"], c["ref"], out=np.zeros(n), where=c["ref"] > 0)
+            per_sample_f1 = np.divide(2 * per_sample_p * per_sample_r, per_sample_p + per_sample_r,
+                                      out=np.zeros(n), where=(per_sample_p + per_sample_r) > 0)
+            summary[field] = dict(prf(c["tp"].sum(), c["pred"].sum(), c["ref"].sum()),
+                                  mean_sample_f1=round(float(per_sample_f1.mean()), 4) if n else 0.0)
+        return summary
+
+    return {
+        "total": summarize(np.ones(len(references), dtype=bool)),
+        "by_source_file": {name: summarize(file_idx == idx) for idx, name in enumerate(files)},
+        "unmatched_predictions": len(set(by_key) - ref_keys),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Оценка предсказаний модели по эталонным output.")
+    parser.add_argument("predictions", help="JSONL с source_file, chunk_id и ответом модели")
+    parser.add_argument("--references", default=CLEANED_FILE, help="эталонный JSONL")
+    parser.add_argument("--prediction-field", default=PREDICTION_FIELD,
+                        help="поле с ответом модели (сырой текст или уже распарсенный JSON)")
+    parser.add_argument("--report", help="куда записать JSON-отчёт (по умолчанию reports/evaluate-<время>.json)")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    result = evaluate(load_jsonl(args.references), load_jsonl(args.predictions), args.prediction_field)
+
+    print(f"{'source_file':<50} {'n':>5} {'json':>6} {'schema':>7} " + " ".join(f"{f[:12] + ' F1':>15}" for f in OUTPUT_FIELDS))
+    for name, summary in list(result["by_source_file"].items()) + [("ИТОГО", result["total"])]:
+        print(f"{name:<50} {summary['samples']:>5} {summary['json_valid_rate']:>6.1%} "
+              f"{summary['schema_compliance_rate']:>7.1%} "
+              + " ".join(f"{summary[f]['f1']:>15.3f}" for f in OUTPUT_FIELDS))
+    if result["unmatched_predictions"]:
+        print(f"Предсказаний без эталона: {result['unmatched_predictions']}")
+
+    report_path = Path(args.report) if args.report else default_report_path("evaluate")
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps(dict(result, predictions=args.predictions, references=args.references),
+                                      ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Отчёт сохранён в {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,225 @@
+import os
+import sys
+import json
 import shutil
+import argparse
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
+from progress_manifest import file_sha256, atomic_write_text
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-def move_final_files(source_dir: Path, destination_dir: Path, extension: str):
+# Результаты butterboard_interview_analysis по умолчанию ищутся в соседнем репозитории
+RESULTS_DIR = Path(os.environ.get("BUTTERBOARD_RESULTS_DIR", "../butterboard_interview_analysis/results"))
+RAW_DATA_DIR = Path("raw_data")
+STATE_FILE = ".sync_state.json"
+JOBS = 8
+LINK_MODES = ("auto", "reflink", "hardlink", "copy")
+FICLONE = 0x40049409  # ioctl клонирования файла (Linux: btrfs, xfs и др.)
+
+
+def reflink(src: Path, dst: Path):
     """
-    Перемещает файлы из source_dir в destination_dir, если имя файла заканчивается на '_final'
-    и файл имеет заданное расширение.
-    
+    Copy-on-write копия: данные не копируются, пока один из файлов не изменят.
+    """
+    if not sys.platform.startswith("linux"):
+        raise OSError("reflink поддерживается только в Linux")
+    import fcntl
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+
+def copy_file(src: Path, dst: Path):
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        shutil.copyfileobj(s, d, 1 << 20)
+        d.flush()
+        os.fsync(d.fileno())
+    shutil.copystat(src, dst)
+
+
+def place_file(src: Path, dst: Path, link: str = "auto") -> str:
+    """
+    Кладёт src в dst атомарно: сначала во временный файл рядом с dst, затем os.replace —
+    data_preparation никогда не увидит наполовину скопированный файл.
+    На одной файловой системе (link=auto) пробуется reflink, затем жёсткая ссылка, иначе копия.
+    Жёсткая ссылка делит файл с исходником: правка файла в raw_data изменит и результаты транскрибации.
+    Возвращает использованный способ.
+    """
+    if dst.exists() and os.path.samefile(src, dst):
+        # Уже жёсткая ссылка на тот же файл (rename поверх неё ничего бы не сделал)
+        return "hardlink"
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    same_fs = src.stat().st_dev == dst.parent.stat().st_dev
+    methods = {
+        "auto": ("reflink", "hardlink", "copy") if same_fs else ("copy",),
+        "reflink": ("reflink", "copy"),
+        "hardlink": ("hardlink", "copy"),
+        "copy": ("copy",),
+    }[link]
+    for method in methods:
+        try:
+            if method == "reflink":
+                reflink(src, tmp)
+            elif method == "hardlink":
+                os.link(src, tmp)
+            else:
+                copy_file(src, tmp)
+            os.replace(tmp, dst)
+            return method
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            if method == "copy":
+                raise
+    raise OSError(f"не удалось скопировать {src}")
+
+
+class SyncState:
+    """
+    Состояние синхронизации папки назначения (<папка>/.sync_state.json):
+    имя файла -> размер, mtime и sha256 исходника на момент последней копии.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if path.exists():
+            try:
+                self.entries = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError):
+                logging.warning(f"Файл состояния {path} повреждён, все файлы будут проверены заново.")
+
+    def get(self, name: str) -> dict:
+        with self._lock:
+            return self.entries.get(name)
+
+    def set(self, name: str, entry: dict):
+        with self._lock:
+            self.entries[name] = entry
+
+    def save(self):
+        with self._lock:
+            text = json.dumps(self.entries, ensure_ascii=False, indent=2, sort_keys=True)
+        atomic_write_text(self.path, text)
+
+
+def sync_file(file: Path, dest_file: Path, state: SyncState, link: str) -> str:
+    """
+    Синхронизирует один файл. Возвращает "unchanged", "copied" или "updated".
+    Хэш считается только если размер или mtime изменились: неизменённые файлы
+    стоят один stat().
+    """
+    stat = file.stat()
+    entry = state.get(dest_file.name)
+    dest_ok = dest_file.exists() and entry is not None and dest_file.stat().st_size == entry["size"]
+    if dest_ok and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return "unchanged"
+
+    digest = file_sha256(file)
+    new_entry = {"source": str(file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+    if entry is None and dest_file.exists() and dest_file.stat().st_size == stat.st_size:
+        # Первый запуск с файлом состояния: уже скопированное раньше не копируем повторно
+        dest_ok = file_sha256(dest_file) == digest
+        entry = {"sha256": digest} if dest_ok else None
+    if dest_ok and entry["sha256"] == digest:
+        # Файл "тронули" (touch, повторная выгрузка), но содержимое то же — копировать незачем
+        state.set(dest_file.name, new_entry)
+        return "unchanged"
+
+    method = place_file(file, dest_file, link)
+    state.set(dest_file.name, new_entry)
+    logging.info(f"Скопирован файл ({method}): {file} -> {dest_file}")
+    return "updated" if entry else "copied"
+
+
+def move_final_files(source_dir: Path, destination_dir: Path, extension: str, jobs: int = JOBS,
+                     link: str = "auto") -> dict:
+    """
+    Копирует из source_dir в destination_dir файлы с заданным расширением,
+    имя которых (без расширения) заканчивается на '_final'. Копируются только новые
+    и изменившиеся файлы (по состоянию в destination_dir/.sync_state.json), в jobs потоков.
+
     Параметры:
       source_dir (Path): исходная директория, где находятся файлы.
-      destination_dir (Path): целевая директория для перемещения.
+      destination_dir (Path): целевая директория.
       extension (str): расширение файла, например ".docx" или ".txt".
+      jobs (int): число потоков копирования.
+      link (str): auto, reflink, hardlink или copy (см. place_file).
+    Возвращает счётчики {"unchanged", "copied", "updated", "failed"}.
     """
+    counts = {"unchanged": 0, "copied": 0, "updated": 0, "failed": 0}
     if not source_dir.is_dir():
         logging.error(f"Исходная директория {source_dir} не существует.")
-        return
-    
+        return counts
+
     # Создаём целевую директорию, если её нет
     destination_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # Ищем файлы по паттерну
     pattern = f"*{extension}"
-    files = list(source_dir.glob(pattern))
+    files = [file for file in source_dir.glob(pattern) if file.stem.endswith("_final")]
     if not files:
-        logging.info(f"В директории {source_dir} не найдено файлов с расширением {extension}.")
-    
-    # Перебор найденных файлов
-    for file in files:
-        # Проверяем, что имя файла (без расширения) заканчивается на '_final'
-        if file.stem.endswith("_final"):
-            dest_file = destination_dir / file.name
-            try:
-                shutil.copy2(str(file), str(dest_file))
-                logging.info(f"Скопирован файл: {file} -> {dest_file}")
-            except Exception as e:
-                logging.error(f"Ошибка при перемещении {file}: {e}")
+        logging.info(f"В директории {source_dir} не найдено файлов *_final{extension}.")
+        return counts
+
+    state = SyncState(destination_dir / STATE_FILE)
+
+    def task(file: Path):
+        try:
+            return sync_file(file, destination_dir / file.name, state, link)
+        except Exception as e:
+            logging.error(f"Ошибка при копировании {file}: {e}")
+            return "failed"
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for result in pool.map(task, files):
+                counts[result] += 1
+    finally:
+        state.save()
+    logging.info(f"{source_dir} -> {destination_dir}: без изменений {counts['unchanged']}, "
+                 f"новых {counts['copied']}, обновлено {counts['updated']}, ошибок {counts['failed']}")
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Инкрементальная выгрузка *_final файлов из результатов транскрибации.")
+    parser.add_argument("--results-dir", default=str(RESULTS_DIR),
+                        help="папка results проекта butterboard_interview_analysis "
+                             "(по умолчанию $BUTTERBOARD_RESULTS_DIR или ../butterboard_interview_analysis/results)")
+    parser.add_argument("--trans-source", help="папка с .docx (по умолчанию <results-dir>/postprocessed)")
+    parser.add_argument("--diar-source", help="папка с .txt (по умолчанию <results-dir>/diarization)")
+    parser.add_argument("--raw-data-dir", default=str(RAW_DATA_DIR), help="куда складывать файлы")
+    parser.add_argument("--jobs", type=int, default=JOBS, help="число потоков копирования")
+    parser.add_argument("--link", choices=LINK_MODES, default="auto",
+                        help="auto — reflink или жёсткая ссылка на одной файловой системе, иначе копия")
+    return parser.parse_args(argv)
 
 
 def main():
+    args = parse_args()
+    results_dir = Path(args.results_dir).expanduser()
+    raw_data_dir = Path(args.raw_data_dir)
+
     # Задаём пути исходных директорий
-    trans_source = Path("/Users/forcemajor01/data_science/work_place/butterboard/butterboard_interview_analysis/results/postprocessed")
-    diar_source = Path("/Users/forcemajor01/data_science/work_place/butterboard/butterboard_interview_analysis/results/diarization")
-    
+    trans_source = Path(args.trans_source).expanduser() if args.trans_source else results_dir / "postprocessed"
+    diar_source = Path(args.diar_source).expanduser() if args.diar_source else results_dir / "diarization"
+
     # Задаём пути целевых директорий
-    trans_destination = Path("/Users/forcemajor01/data_science/work_place/butterboard/butterboard_finetuning/raw_data/transcribation")
-    diar_destination = Path("/Users/forcemajor01/data_science/work_place/butterboard/butterboard_finetuning/raw_data/diarization")
-    
-    # Перемещаем файлы для транскрибации (.docx)
-    move_final_files(trans_source, trans_destination, ".docx")
-    
-    # Перемещаем файлы для диаризации (.txt)
-    move_final_files(diar_source, diar_destination, ".txt")
+    trans_destination = raw_data_dir / "transcribation"
+    diar_destination = raw_data_dir / "diarization"
+
+    # Копируем файлы для транскрибации (.docx)
+    move_final_files(trans_source, trans_destination, ".docx", args.jobs, args.link)
+
+    # Копируем файлы для диаризации (.txt)
+    move_final_files(diar_source, diar_destination, ".txt", args.jobs, args.link)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import re
+import json
+
+# Поля объекта "output" — схема ответа модели из системного промпта dataset_pipeline
+OUTPUT_FIELDS = ("hard_skills", "soft_skills", "recommendations")
+MAX_ITEM_CHARS = 600     # строка списка длиннее — модель "растеклась" вместо короткого пункта
+MAX_LIST_ITEMS = 25      # пунктов в одном списке
+MAX_REPEATS = 2          # сколько раз модели можно повторить один и тот же пункт (дальше — зацикливание)
+MAX_WHITESPACE = 200     # подряд идущих пробельных символов вне строк
+FENCES = ("```json", "```")
+
+
+def parse_json(json_output):
+    """
+    Убираем markdown-обрамление, если оно есть, и пробуем распарсить строку как JSON.
+    """
+    try:
+        lines = json_output.splitlines()
+        # Ищем начало блока ```json
+        for i, line in enumerate(lines):
+            if line.strip() == "```json":
+                # Берём всё после этой строки до следующего ```
+                json_output = "".join(lines[i+1:])
+                json_output = json_output.split("```")[0]
+                break
+        # Удаляем лишние запятые перед закрывающей фигурной скобкой
+        json_output = re.sub(r',\s*}', '}', json_output)
+
+        return json.loads(json_output)
+    except Exception:
+        return None
+
+
+class OffSchemaError(ValueError):
+    """
+    Поток ответа уже не может стать объектом {"output": {...}} нужной схемы.
+    """
+
+
+class StreamingOutputParser:
+    """
+    Инкрементальный разбор ответа на одиночный чанк по мере поступления токенов.
+
+    Допускается только схема системного промпта: {"output": {"hard_skills": [...], "soft_skills": [...],
+    "recommendations": [...]}} со списками строк (перед объектом — пробелы или ```json, перед "}" —
+    лишняя запятая, как и в parse_json). Любой другой символ там, где схема его не допускает,
+    и признаки "растекания" (слишком длинный или повторяющийся пункт, слишком много пунктов,
+    поток пробелов) сразу выбрасывают OffSchemaError — запрос можно отменить, не дожидаясь
+    max_tokens. Как только пришла закрывающая скобка корневого объекта, done=True,
+    а text содержит объект целиком; всё, что модель пишет дальше, игнорируется.
+    """
+
+    def __init__(self):
+        self.chars = []          # корневой объект от "{" (заполняется по мере разбора)
+        self.prefix = ""         # всё до "{"
+        self.done = False
+        self.stack = []          # открытые контейнеры: "root", "output" или имя поля со списком
+        self.expect = "root"     # чего ждём: root, key, key_or_end, colon, value, item_or_end, item, comma_or_end
+        self.in_string = False
+        self.escape = False
+        self.unicode_left = 0
+        self.string = []
+        self.keys_seen = []
+        self.items = []
+        self.trailing_comma = False
+        self.whitespace = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chars)
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Разбирает очередной фрагмент ответа. Возвращает done.
+        """
+        for ch in chunk or "":
+            if self.done:
+                break
+            if self.expect == "root" and ch != "{":
+                self._prefix(ch)
+                continue
+            self.chars.append(ch)
+            if self.in_string:
+                self._string_char(ch)
+            else:
+                self._structural(ch)
+        return self.done
+
+    def _prefix(self, ch: str):
+        self.prefix += ch
+        head = self.prefix.lstrip()
+        fence = head.rstrip()
+        if not fence:
+            return
+        if head != fence and fence not in FENCES or not any(f.startswith(fence) for f in FENCES):
+            raise OffSchemaError(f"текст перед JSON: {self.prefix[:40]!r}")
+
+    def _fail(self, ch: str):
+        context = self.stack[-1] if self.stack else "root"
+        raise OffSchemaError(f"неожиданный символ {ch!r} в {context} (ожидалось {self.expect})")
+
+    def _string_char(self, ch: str):
+        if self.unicode_left:
+            if ch not in "0123456789abcdefABCDEF":
+                self._fail(ch)
+            self.unicode_left -= 1
+            if not self.unicode_left:
+                self.string.append("?")
+            return
+        if self.escape:
+            self.escape = False
+            if ch == "u":
+                self.unicode_left = 4
+            elif ch in '"\\/bfnrt':
+                self.string.append(ch)
+            else:
+                self._fail(ch)
+            return
+        if ch == "\\":
+            self.escape = True
+        elif ch == '"':
+            self.in_string = False
+            self._end_string("".join(self.string))
+        elif ch < " ":
+            self._fail(ch)
+        else:
+            self.string.append(ch)
+            if len(self.string) > MAX_ITEM_CHARS:
+                raise OffSchemaError(f"пункт длиннее {MAX_ITEM_CHARS} символов")
+
+    def _end_string(self, value: str):
+        if self.expect in ("key", "key_or_end"):
+            allowed = ("output",) if self.stack[-1] == "root" else OUTPUT_FIELDS
+            if value not in allowed or value in self.keys_seen[-1]:
+                raise OffSchemaError(f"лишнее или повторное поле {value!r}")
+            self.keys_seen[-1].append(value)
+            self.expect = "colon"
+            return
+        # Пункт списка
+        self.items.append(value)
+        if len(self.items) > MAX_LIST_ITEMS:
+            raise OffSchemaError(f"больше {MAX_LIST_ITEMS} пунктов в {self.stack[-1]}")
+        if self.items.count(value) > MAX_REPEATS:
+            raise OffSchemaError(f"пункт повторяется в {self.stack[-1]}: {value[:40]!r}")
+        self.expect = "comma_or_end"
+
+    def _structural(self, ch: str):
+        if ch in " \t\r\n":
+            self.whitespace += 1
+            if self.whitespace > MAX_WHITESPACE:
+                raise OffSchemaError("слишком много пробельных символов")
+            return
+        self.whitespace = 0
+        expect = self.expect
+        trailing_comma, self.trailing_comma = self.trailing_comma, False
+
+        if expect == "root":
+            self._open_object("root")
+        elif expect in ("key", "key_or_end"):
+            if ch == '"':
+                self._open_string()
+            elif ch == "}" and (expect == "key_or_end" or trailing_comma):
+                self._close_object()
+            else:
+                self._fail(ch)
+        elif expect == "colon":
+            if ch != ":":
+                self._fail(ch)
+            self.expect = "value"
+        elif expect == "value":
+            key = self.keys_seen[-1][-1]
+            if key == "output" and ch == "{":
+                self._open_object("output")
+            elif key in OUTPUT_FIELDS and ch == "[":
+                self.stack.append(key)
+                self.items = []
+                self.expect = "item_or_end"
+            else:
+                self._fail(ch)
+        elif expect in ("item", "item_or_end"):
+            if ch == '"':
+                self._open_string()
+            elif ch == "]" and expect == "item_or_end":
+                self._close_list()
+            else:
+                self._fail(ch)
+        elif expect == "comma_or_end":
+            container = self.stack[-1]
+            if ch == ",":
+                self.expect = "key" if container in ("root", "output") else "item"
+                self.trailing_comma = container in ("root", "output")
+            elif ch == "}" and container in ("root", "output"):
+                self._close_object()
+            elif ch == "]" and container in OUTPUT_FIELDS:
+                self._close_list()
+            else:
+                self._fail(ch)
+
+    def _open_string(self):
+        self.in_string = True
+        self.string = []
+
+    def _open_object(self, name: str):
+        self.stack.append(name)
+        self.keys_seen.append([])
+        self.expect = "key_or_end"
+
+    def _close_object(self):
+        name = self.stack.pop()
+        keys = self.keys_seen.pop()
+        required = ("output",) if name == "root" else OUTPUT_FIELDS
+        missing = [key for key in required if key not in keys]
+        if missing:
+            raise OffSchemaError(f"в {name} нет полей {missing}")
+        if name == "root":
+            self.done = True
+        else:
+            self.expect = "comma_or_end"
+
+    def _close_list(self):
+        self.stack.pop()
+        self.expect = "comma_or_end"
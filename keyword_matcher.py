@@ -0,0 +1,70 @@
+import re
+
+
+class KeywordCounter:
+    """
+    Считает вхождения набора ключевых слов за один проход по тексту.
+
+    Результат совпадает с sum(text.count(kw) for kw in keywords): каждое слово считается
+    независимо, без перекрытий с самим собой (как str.count), но вхождения разных слов
+    могут перекрываться ("почему" внутри "почему ты" засчитывается обоим).
+
+    Одно скомпилированное регулярное выражение (lookahead, собранный из префиксного дерева слов)
+    находит каждую позицию, с которой начинается хотя бы одно слово, и самое длинное из них.
+    Остальные слова, начинающиеся в этой позиции, — ровно его префиксы из списка,
+    они заранее сохранены в prefixes.
+    """
+
+    _END = ""  # ключ-маркер конца слова в узле дерева (символы текста всегда непустые)
+
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(keywords))
+        if any(not kw for kw in self.keywords):
+            raise ValueError("Пустое ключевое слово не поддерживается.")
+        self.trie = {}
+        for idx, kw in enumerate(self.keywords):
+            node = self.trie
+            for ch in kw:
+                node = node.setdefault(ch, {})
+            node[self._END] = idx
+        # Одинаковые слова в исходном списке считаются столько раз, сколько повторяются
+        self.weights = [0] * len(self.keywords)
+        index = {kw: idx for idx, kw in enumerate(self.keywords)}
+        for kw in keywords:
+            self.weights[index[kw]] += 1
+        # Для каждого слова: (индекс, длина) всех слов из списка, являющихся его префиксами, включая его само
+        self.prefixes = {
+            kw: [(index[other], len(other)) for other in self.keywords if kw.startswith(other)]
+            for kw in self.keywords
+        }
+        self.pattern = re.compile(f"(?=({self._trie_regex(self.trie)}))") if self.keywords else None
+
+    @classmethod
+    def _trie_regex(cls, node: dict) -> str:
+        """
+        Регулярное выражение по поддереву node. Продолжение после конца слова необязательное
+        и жадное, поэтому совпадение — самое длинное слово, начинающееся в позиции.
+        """
+        branches = []
+        for ch, child in sorted((k, v) for k, v in node.items() if k != cls._END):
+            branch = re.escape(ch)
+            if len(child) > 1 or cls._END not in child:
+                rest = cls._trie_regex(child)
+                branch += f"(?:{rest})?" if cls._END in child else rest
+            branches.append(branch)
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    def count(self, text: str) -> int:
+        if self.pattern is None:
+            return 0
+        next_allowed = {}  # индекс слова -> позиция, с которой возможно следующее вхождение
+        total = 0
+        for match in self.pattern.finditer(text):
+            pos = match.start()
+            for idx, length in self.prefixes[match.group(1)]:
+                if next_allowed.get(idx, 0) <= pos:
+                    next_allowed[idx] = pos + length
+                    total += self.weights[idx]
+        return total
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+EWMA_ALPHA = 0.2          # вес нового наблюдения в скользящих средних латентности и доли ошибок
+DEFAULT_LATENCY = 10.0    # априорная латентность endpoint'а без наблюдений, с
+LATENCY_WINDOW = 200      # сколько последних латентностей хранится для p95
+HEDGE_QUANTILE = 0.95
+MIN_HEDGE_SAMPLES = 20    # до стольких наблюдений p95 ненадёжен и запрос не дублируется
+HEDGE_WORKERS = 32
+
+
+class EndpointStats:
+    """
+    Наблюдаемое качество endpoint'а: EWMA латентности успешных запросов, EWMA доли ошибок,
+    окно последних латентностей для квантилей и число запросов в полёте.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.window = deque(maxlen=LATENCY_WINDOW)
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.cancelled = 0
+
+    def record(self, latency: float = None, error: bool = False):
+        self.requests += 1
+        self.error_rate += EWMA_ALPHA * (float(error) - self.error_rate)
+        if error:
+            self.errors += 1
+            return
+        self.window.append(latency)
+        self.latency = latency if self.latency is None else self.latency + EWMA_ALPHA * (latency - self.latency)
+
+    def quantile(self, q: float) -> float:
+        if len(self.window) < MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self.window)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Endpoint:
+    """
+    Один OpenAI-совместимый endpoint с моделью, весом и собственным rate limiter'ом.
+    """
+
+    def __init__(self, name: str, client, model: str, weight: float = 1.0, limiter=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.limiter = limiter
+        self.stats = EndpointStats()
+
+
+class ModelPool:
+    """
+    Пул endpoint'ов с маршрутизацией по наблюдаемой латентности и доле ошибок.
+
+    Endpoint выбирается случайно с вероятностью, пропорциональной
+    weight * (1 - error_rate)^2 / (EWMA латентности * (1 + запросов в полёте) + ожидание лимита):
+    быстрые и здоровые получают больше трафика, но медленные и сбоившие продолжают получать
+    немного запросов, поэтому их оценки обновляются, и восстановившийся endpoint возвращается.
+
+    При hedge=True запрос, не завершившийся за p95 латентности своего endpoint'а (считая с отправки,
+    без ожидания лимита), дублируется на другой endpoint; берётся первый успешный ответ, проигравшему
+    выставляется cancel (потоковый запрос закрывает соединение, обычный — просто отбрасывается).
+    """
+
+    def __init__(self, endpoints: list, hedge: bool = False, hedge_quantile: float = HEDGE_QUANTILE):
+        if not any(e.weight > 0 for e in endpoints):
+            raise ValueError("В пуле нет endpoint'ов с положительным весом.")
+        self.endpoints = endpoints
+        self.hedge = hedge and len(endpoints) > 1
+        self.hedge_quantile = hedge_quantile
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS) if self.hedge else None
+
+    @property
+    def name(self) -> str:
+        return "+".join(f"{e.name}:{e.model}" for e in self.endpoints)
+
+    @property
+    def models(self) -> list:
+        """
+        Модели пула без повторов, в порядке конфига: ключи кэша строятся по модели, давшей ответ,
+        поэтому изменение состава или весов пула кэш не сбрасывает.
+        """
+        return list(dict.fromkeys(e.model for e in self.endpoints))
+
+    def _score(self, endpoint: Endpoint, tokens: int) -> float:
+        stats = endpoint.stats
+        observed = [e.stats.latency for e in self.endpoints if e.stats.latency is not None]
+        latency = stats.latency if stats.latency is not None else min(observed, default=DEFAULT_LATENCY)
+        wait_time = endpoint.limiter.wait_time(tokens) if endpoint.limiter else 0.0
+        health = (1.0 - stats.error_rate) ** 2
+        return endpoint.weight * max(health, 0.01) / (latency * (1 + stats.inflight) + wait_time + 1e-3)
+
+    def choose(self, tokens: int = 0, exclude: tuple = ()) -> Endpoint:
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude and e.weight > 0]
+            if not candidates:
+                return None
+            scores = [self._score(e, tokens) for e in candidates]
+            endpoint = random.choices(candidates, weights=scores)[0]
+            endpoint.stats.inflight += 1
+            return endpoint
+
+    def _run(self, endpoint: Endpoint, request, tokens: int, cancel: threading.Event,
+             sent: threading.Event = None):
+        """
+        Выполняет request(endpoint, cancel) с учётом лимита endpoint'а и обновляет его статистику.
+        sent выставляется, когда лимит пройден и запрос реально уходит (или попытка завершилась).
+        Отменённый запрос (request вернул None после cancel) в статистику не попадает.
+        """
+        try:
+            if endpoint.limiter:
+                endpoint.limiter.acquire(tokens)
+            if sent:
+                sent.set()
+            started = time.perf_counter()
+            try:
+                content = request(endpoint, cancel)
+            except Exception:
+                if not (cancel and cancel.is_set()):
+                    with self._lock:
+                        endpoint.stats.record(error=True)
+                raise
+            with self._lock:
+                if cancel and cancel.is_set():
+                    endpoint.stats.cancelled += 1
+                else:
+                    endpoint.stats.record(time.perf_counter() - started)
+            return content
+        finally:
+            if sent:
+                sent.set()
+            with self._lock:
+                endpoint.stats.inflight -= 1
+
+    def call(self, request, tokens: int = 0) -> tuple:
+        """
+        Отправляет request(endpoint, cancel) -> ответ на выбранный endpoint (и, возможно, дубль).
+        Возвращает (ответ, endpoint) или выбрасывает исключение последней неудачной попытки.
+        """
+        primary = self.choose(tokens)
+        if not self.hedge:
+            return self._run(primary, request, tokens, None), primary
+
+        cancels = {primary: threading.Event()}
+        sent = threading.Event()
+        futures = {self._executor.submit(self._run, primary, request, tokens, cancels[primary], sent): primary}
+        deadline = primary.stats.quantile(self.hedge_quantile)
+        # Ожидание собственного rate limiter'а — не медленный ответ: отсчёт p95 идёт с отправки запроса
+        sent.wait()
+        done, _ = wait(futures, timeout=deadline) if deadline is not None else wait(futures)
+        if not done:
+            second = self.choose(tokens, exclude=(primary,))
+            if second is not None:
+                with self._lock:
+                    primary.stats.hedges += 1
+                cancels[second] = threading.Event()
+                futures[self._executor.submit(self._run, second, request, tokens, cancels[second])] = second
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    content = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                winner = futures[future]
+                for endpoint, cancel in cancels.items():
+                    if endpoint is not winner:
+                        cancel.set()
+                if winner is not primary:
+                    with self._lock:
+                        winner.stats.hedge_wins += 1
+                return content, winner
+        raise error
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                e.name: {
+                    "model": e.model,
+                    "weight": e.weight,
+                    "requests": e.stats.requests,
+                    "errors": e.stats.errors,
+                    "error_rate_ewma": round(e.stats.error_rate, 4),
+                    "latency_ewma": round(e.stats.latency, 3) if e.stats.latency is not None else None,
+                    "latency_p95": e.stats.quantile(0.95),
+                    "hedges": e.stats.hedges,
+                    "hedge_wins": e.stats.hedge_wins,
+                    "cancelled": e.stats.cancelled,
+                }
+                for e in self.endpoints
+            }
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_endpoint_config(path: Path) -> list:
+    """
+    Читает JSON-список endpoint'ов:
+      [{"name": "openrouter", "api_base": "https://openrouter.ai/api/v1", "api_key_env": "OPENROUTER_API_KEY",
+        "model": "google/gemma-3-4b-it:free", "weight": 1, "rpm": 20, "tpm": 40000}, ...]
+    Ключ задаётся именем переменной (api_key_env, ищется в .env и окружении) или прямо в api_key.
+    """
+    entries = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path}: ожидается непустой JSON-список endpoint'ов.")
+    for idx, entry in enumerate(entries):
+        if not entry.get("model"):
+            raise ValueError(f"{path}: у endpoint'а #{idx} не указана model.")
+        entry.setdefault("name", f"endpoint{idx}")
+    return entries
+
+
+def build_pool(entries: list, env: dict, make_client, make_limiter, hedge: bool = False) -> ModelPool:
+    """
+    Создаёт пул: make_client(api_base, api_key) и make_limiter(rpm, tpm) передаются снаружи,
+    чтобы модуль не зависел от SDK и реализации лимитера.
+    """
+    endpoints = []
+    for entry in entries:
+        key_env = entry.get("api_key_env")
+        api_key = entry.get("api_key") or (env.get(key_env) or os.environ.get(key_env) if key_env else None)
+        endpoints.append(Endpoint(
+            entry["name"],
+            make_client(entry.get("api_base"), api_key),
+            entry["model"],
+            float(entry.get("weight", 1.0)),
+            make_limiter(entry.get("rpm"), entry.get("tpm")),
+        ))
+    return ModelPool(endpoints, hedge=hedge)
@@ -0,0 +1,323 @@
+import json
+import bisect
+import random
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from assemble_dataset import CLEANED_FILE
+from progress_manifest import file_sha256, atomic_write_text
+
+TOKENIZER = "unsloth/Llama-3.2-3B-Instruct"
+MAX_SEQ_LENGTH = 2048
+BATCH_SIZE = 2             # per_device_train_batch_size из personalization-training.ipynb
+SHARD_TOKENS = 64 * 1024 * 1024
+OUTPUT_DIR = Path("pretokenized")
+SEED = 3407
+
+# Системный промпт обучения — ровно как в personalization-training.ipynb (с неразрывным дефисом в "Markdown‑блоки")
+SYSTEM_PROMPT = (
+    "Ты — виртуальный наставник, который анализирует диалог кандидата на позицию системного аналитика и интервьюера. "
+    "На основании диалога определи сильные и слабые стороны кандидата и сформулируй персонализированные рекомендации. "
+    "Исправляй грамматические ошибки и неточности в названиях. Если роли неправильно назначены, "
+    "то твоя задача понять из контекста кто является кандидатом и сформулировать для него рекомендации. "
+    "Важно: верни строго валидный JSON, содержащий ровно одно поле 'output'. "
+    "Внутри 'output' укажи:\n"
+    "- hard_skills: [список строк]\n"
+    "- soft_skills: [список строк]\n"
+    "- recommendations: [список строк]\n"
+    "Не добавляй никаких других полей и не используй Markdown‑блоки."
+)
+
+# Шаблон llama-3.1 из unsloth.chat_templates для диалога system/user/assistant без инструментов
+CHAT_TEMPLATE = "llama-3.1"
+BOS = "<|begin_of_text|>"
+SYSTEM_HEADER = "<|start_header_id|>system<|end_header_id|>\n\nCutting Knowledge Date: December 2023\nToday Date: 26 July 2024\n\n"
+INSTRUCTION_PART = "<|start_header_id|>user<|end_header_id|>\n\n"
+RESPONSE_PART = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+EOT = "<|eot_id|>"
+
+
+def to_chat_format(example: dict) -> dict:
+    system_msg = {"role": "system", "content": SYSTEM_PROMPT}
+    user_msg   = {"role": "user",   "content": example["input"]}
+    assistant_msg = {
+        "role": "assistant",
+        "content": json.dumps({"output": example["output"]}, ensure_ascii=False)
+    }
+    return {"messages": [system_msg, user_msg, assistant_msg]}
+
+
+def render_chat(messages: list) -> tuple:
+    """
+    То же, что tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    с get_chat_template(tokenizer, "llama-3.1"). Возвращает (текст, промежутки ответов ассистента в символах):
+    как train_on_responses_only, в лосс идёт всё после RESPONSE_PART до следующей реплики пользователя.
+    """
+    if messages and messages[0]["role"] == "system":
+        system_message, messages = messages[0]["content"], messages[1:]
+    else:
+        system_message = "{system_message}"
+    parts = [BOS, SYSTEM_HEADER, system_message, EOT]
+    length = sum(len(part) for part in parts)
+    spans = []
+    for message in messages:
+        header = f"<|start_header_id|>{message['role']}<|end_header_id|>\n\n"
+        if header == RESPONSE_PART:
+            spans.append([length + len(header), None])
+        elif header == INSTRUCTION_PART and spans and spans[-1][1] is None:
+            spans[-1][1] = length
+        parts += [header, message["content"], EOT]
+        length += len(header) + len(message["content"]) + len(EOT)
+    text = "".join(parts)
+    return text, [(start, end if end is not None else len(text)) for start, end in spans]
+
+
+def load_tokenizer(name: str):
+    """
+    Быстрый токенайзер transformers (нужны offsets_mapping); имя модели из кэша HF или путь к папке.
+    """
+    try:
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise RuntimeError("Для претокенизации установите пакет transformers.") from e
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    if not tokenizer.is_fast:
+        raise RuntimeError(f"Токенайзер {name} не поддерживает offsets_mapping (нужен fast-токенайзер).")
+    return tokenizer
+
+
+def tokenize_sample(tokenizer, text: str, spans: list, max_seq_length: int) -> tuple:
+    """
+    (input_ids, loss_mask, обрезан ли пример): маска 1 у токенов, начинающихся внутри ответа ассистента.
+    Текст уже содержит <|begin_of_text|>, поэтому спецтокены не добавляются.
+    Длинные примеры обрезаются до max_seq_length, как в SFTTrainer.
+    """
+    encoded = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    truncated = len(encoded["input_ids"]) > max_seq_length
+    ids = np.asarray(encoded["input_ids"], dtype=np.uint32)[:max_seq_length]
+    starts = np.asarray([start for start, _ in encoded["offset_mapping"]], dtype=np.int64)[:max_seq_length]
+    mask = np.zeros(len(ids), dtype=np.uint8)
+    for start, end in spans:
+        mask[(starts >= start) & (starts < end)] = 1
+    return ids, mask, truncated
+
+
+def pack_samples(lengths: np.ndarray, max_seq_length: int) -> list:
+    """
+    Best-fit decreasing: примеры от длинных к коротким кладутся в последовательность
+    с наименьшим подходящим остатком места. Возвращает список последовательностей (списков индексов).
+    """
+    packs = []
+    free = []  # отсортированный список (свободно токенов, номер последовательности)
+    for idx in sorted(range(len(lengths)), key=lambda i: -int(lengths[i])):
+        length = int(lengths[idx])
+        pos = bisect.bisect_left(free, (length, -1))
+        if pos < len(free):
+            space, pack_id = free.pop(pos)
+        else:
+            space, pack_id = max_seq_length, len(packs)
+            packs.append([])
+        packs[pack_id].append(idx)
+        if space - length > 0:
+            bisect.insort(free, (space - length, pack_id))
+    return packs
+
+
+def bucket_batches(lengths: np.ndarray, batch_size: int, seed: int = SEED) -> np.ndarray:
+    """
+    Батчи из примеров близкой длины (сортировка по длине), порядок батчей перемешан.
+    Матрица (батчей, batch_size), неполный последний батч дополнен -1.
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    random.Random(seed).shuffle(batches)
+    layout = np.full((len(batches), batch_size), -1, dtype=np.int64)
+    for row, batch in enumerate(batches):
+        layout[row, :len(batch)] = batch
+    return layout
+
+
+class ShardWriter:
+    """
+    Пишет токены (uint32) и маски лосса (uint8) в шарды shard-NNNNN.tokens / shard-NNNNN.mask,
+    которые потом открываются через np.memmap. index — (шард, смещение, длина) каждого примера.
+    """
+
+    def __init__(self, output_dir: Path, shard_tokens: int = SHARD_TOKENS):
+        self.output_dir = output_dir
+        self.shard_tokens = shard_tokens
+        self.index = []
+        self.shard = -1
+        self.offset = 0
+        self._tokens = self._mask = None
+
+    def _open_next(self):
+        self.close()
+        self.shard += 1
+        self.offset = 0
+        self._tokens = (self.output_dir / f"shard-{self.shard:05d}.tokens").open("wb")
+        self._mask = (self.output_dir / f"shard-{self.shard:05d}.mask").open("wb")
+
+    def add(self, ids: np.ndarray, mask: np.ndarray):
+        if self._tokens is None or self.offset + len(ids) > self.shard_tokens:
+            self._open_next()
+        self._tokens.write(ids.tobytes())
+        self._mask.write(mask.tobytes())
+        self.index.append((self.shard, self.offset, len(ids)))
+        self.offset += len(ids)
+
+    def close(self):
+        for handle in (self._tokens, self._mask):
+            if handle:
+                handle.close()
+        self._tokens = self._mask = None
+
+
+def build_signature(input_path: Path, args) -> dict:
+    return {
+        "input_sha256": file_sha256(input_path),
+        "tokenizer": args.tokenizer,
+        "chat_template": CHAT_TEMPLATE,
+        "system_prompt": SYSTEM_PROMPT,
+        "max_seq_length": args.max_seq_length,
+        "batch_size": args.batch_size,
+        "shard_tokens": args.shard_tokens,
+    }
+
+
+def pretokenize(input_path: Path, output_dir: Path, args) -> dict:
+    """
+    Токенизирует датасет один раз и сохраняет шарды, индекс, раскладки и manifest.json.
+    Если manifest совпадает по входу и параметрам, ничего не пересчитывается.
+    """
+    signature = build_signature(input_path, args)
+    manifest_path = output_dir / "manifest.json"
+    if not args.force and manifest_path.is_file():
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        if manifest.get("signature") == signature:
+            print(f"Претокенизированные данные в {output_dir} актуальны, пропускаем.")
+            return manifest
+
+    tokenizer = load_tokenizer(args.tokenizer)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for old in output_dir.glob("shard-*"):
+        old.unlink()
+
+    writer = ShardWriter(output_dir, args.shard_tokens)
+    truncated = 0
+    with input_path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            text, spans = render_chat(to_chat_format(json.loads(line))["messages"])
+            ids, mask, was_truncated = tokenize_sample(tokenizer, text, spans, args.max_seq_length)
+            truncated += was_truncated
+            writer.add(ids, mask)
+    writer.close()
+
+    index = np.asarray(writer.index, dtype=np.int64).reshape(-1, 3)
+    lengths = index[:, 2]
+    np.save(output_dir / "index.npy", index)
+
+    packs = pack_samples(lengths, args.max_seq_length)
+    pack_offsets = np.cumsum([0] + [len(pack) for pack in packs], dtype=np.int64)
+    np.save(output_dir / "packs.npy", np.asarray([idx for pack in packs for idx in pack], dtype=np.int64))
+    np.save(output_dir / "pack_offsets.npy", pack_offsets)
+    batches = bucket_batches(lengths, args.batch_size)
+    np.save(output_dir / "batches_bucketed.npy", batches)
+
+    real = int(lengths.sum())
+    bucketed = int(sum(lengths[row[row >= 0]].max() * args.batch_size for row in batches)) if len(batches) else 0
+    manifest = {
+        "signature": signature,
+        "samples": int(len(lengths)),
+        "tokens": real,
+        "truncated": truncated,
+        "packs": len(packs),
+        # Доля полезных токенов при каждой раскладке
+        "efficiency": {
+            "padded_to_max_seq_length": real / (len(lengths) * args.max_seq_length) if len(lengths) else 0.0,
+            "bucketed": real / bucketed if bucketed else 0.0,
+            "packed": real / (len(packs) * args.max_seq_length) if packs else 0.0,
+        },
+    }
+    atomic_write_text(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest
+
+
+class PretokenizedDataset:
+    """
+    Чтение результата pretokenize без повторной токенизации: шарды открываются через np.memmap.
+
+    - sample(i) — input_ids и labels (-100 вне ответа ассистента) одного примера;
+    - pack(j) — склеенная последовательность из packs.npy: input_ids, labels и position_ids,
+      сбрасывающиеся в начале каждого примера (для padding-free обучения, как DataCollatorWithFlattening);
+    - bucketed_batches() — батчи примеров близкой длины.
+    """
+
+    def __init__(self, data_dir: Path = OUTPUT_DIR):
+        self.data_dir = Path(data_dir)
+        self.manifest = json.loads((self.data_dir / "manifest.json").read_text(encoding="utf-8"))
+        self.index = np.load(self.data_dir / "index.npy")
+        self.packs = np.load(self.data_dir / "packs.npy")
+        self.pack_offsets = np.load(self.data_dir / "pack_offsets.npy")
+        self._shards = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _shard(self, shard: int) -> tuple:
+        if shard not in self._shards:
+            tokens = np.memmap(self.data_dir / f"shard-{shard:05d}.tokens", dtype=np.uint32, mode="r")
+            mask = np.memmap(self.data_dir / f"shard-{shard:05d}.mask", dtype=np.uint8, mode="r")
+            self._shards[shard] = (tokens, mask)
+        return self._shards[shard]
+
+    def sample(self, idx: int) -> dict:
+        shard, offset, length = self.index[idx]
+        tokens, mask = self._shard(int(shard))
+        ids = tokens[offset:offset + length].astype(np.int64)
+        return {"input_ids": ids, "labels": np.where(mask[offset:offset + length] == 1, ids, -100)}
+
+    def num_packs(self) -> int:
+        return len(self.pack_offsets) - 1
+
+    def pack(self, idx: int) -> dict:
+        samples = [self.sample(int(i)) for i in self.packs[self.pack_offsets[idx]:self.pack_offsets[idx + 1]]]
+        return {
+            "input_ids": np.concatenate([s["input_ids"] for s in samples]),
+            "labels": np.concatenate([s["labels"] for s in samples]),
+            "position_ids": np.concatenate([np.arange(len(s["input_ids"])) for s in samples]),
+        }
+
+    def bucketed_batches(self) -> list:
+        layout = np.load(self.data_dir / "batches_bucketed.npy")
+        return [row[row >= 0].tolist() for row in layout]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Претокенизация датасета для personalization-training.ipynb.")
+    parser.add_argument("--input", default=CLEANED_FILE, help="JSONL с полями input/output")
+    parser.add_argument("--output-dir", default=str(OUTPUT_DIR), help="куда писать шарды и раскладки")
+    parser.add_argument("--tokenizer", default=TOKENIZER, help="имя токенайзера в кэше HF или локальная папка")
+    parser.add_argument("--max-seq-length", type=int, default=MAX_SEQ_LENGTH, help="максимальная длина последовательности")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="размер батча для раскладки по длине")
+    parser.add_argument("--shard-tokens", type=int, default=SHARD_TOKENS, help="токенов в одном шарде")
+    parser.add_argument("--force", action="store_true", help="пересчитать, даже если manifest актуален")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    manifest = pretokenize(Path(args.input), Path(args.output_dir), args)
+    efficiency = manifest["efficiency"]
+    print(f"Примеров: {manifest['samples']}, токенов: {manifest['tokens']}, обрезано: {manifest['truncated']}, "
+          f"упакованных последовательностей: {manifest['packs']}.")
+    print(f"Доля полезных токенов: паддинг до {args.max_seq_length} — {efficiency['padded_to_max_seq_length']:.1%}, "
+          f"по длине — {efficiency['bucketed']:.1%}, упаковка — {efficiency['packed']:.1%}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+
+COMPLETED = "completed"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def file_sha256(path: Path) -> str:
+    """
+    sha256 содержимого файла (читается блоками, чтобы не держать файл в памяти).
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atomic_write_text(path: Path, text: str):
+    """
+    Пишет файл через временный файл + fsync + os.replace: читатель видит либо старую,
+    либо новую версию целиком, но никогда не обрезанную.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def truncate_torn_tail(path: Path) -> int:
+    """
+    Обрезает append-only jsonl после последнего перевода строки: оборванная при падении
+    последняя строка иначе склеится со следующей дописанной записью, и испортятся обе.
+    Возвращает число отброшенных байт.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return 0
+    with path.open("r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            step = min(end, 1 << 16)
+            f.seek(end - step)
+            block = f.read(step)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                end = end - step + newline + 1
+                break
+            end -= step
+        if end < size:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+    return size - end
+
+
+class ProgressJournal:
+    """
+    Журнал разметки одного входного файла.
+
+    В finetuning_samples/.progress/ лежат два файла:
+      - <stem>.journal.jsonl — append-only журнал; каждая строка
+        {"chunk_id": ..., "status": ..., "record": {...}} дописывается и сразу fsync'ится,
+        поэтому после падения или Ctrl-C все оплаченные ответы сохраняются;
+      - <stem>.manifest.json — сводка: хэш входа, число чанков и списки
+        completed/failed/skipped chunk_id (перезаписывается атомарно).
+
+    Источник истины — журнал: если процесс убит между записью журнала и манифеста,
+    манифест восстанавливается из журнала при следующем запуске.
+    """
+
+    def __init__(self, progress_dir: Path, stem: str):
+        self.progress_dir = Path(progress_dir)
+        self.progress_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.progress_dir / f"{stem}.journal.jsonl"
+        self.manifest_path = self.progress_dir / f"{stem}.manifest.json"
+        self.entries = {}
+        self.input_hash = None
+        self.total_chunks = 0
+        self._journal = None
+
+    def load(self) -> dict:
+        """
+        Читает журнал; последняя запись для chunk_id побеждает.
+        Оборванная последняя строка (падение посреди записи) игнорируется.
+        """
+        self.entries = {}
+        if self.manifest_path.is_file():
+            manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+            self.input_hash = manifest.get("input_hash")
+            self.total_chunks = manifest.get("total_chunks", 0)
+        if self.journal_path.is_file():
+            with self.journal_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["chunk_id"]] = entry
+        return self.entries
+
+    def start(self, input_hash: str, total_chunks: int, resume: bool):
+        """
+        Открывает журнал на дозапись. Без resume (или если вход изменился) журнал начинается заново.
+        """
+        if resume:
+            self.load()
+            if self.input_hash is not None and self.input_hash != input_hash:
+                print("Входной файл изменился с прошлого запуска — начинаем заново.")
+                resume = False
+        if not resume:
+            self.entries = {}
+        self.input_hash = input_hash
+        self.total_chunks = total_chunks
+        if resume and truncate_torn_tail(self.journal_path):
+            print(f"Отброшена оборванная последняя строка журнала {self.journal_path}.")
+        self._journal = self.journal_path.open("a" if resume else "w", encoding="utf-8")
+        self.write_manifest()
+
+    def pending(self) -> list:
+        """
+        chunk_id, которые ещё нужно обработать: отсутствующие в журнале и failed.
+        """
+        return [
+            chunk_id for chunk_id in range(self.total_chunks)
+            if self.entries.get(chunk_id, {}).get("status") not in (COMPLETED, SKIPPED)
+        ]
+
+    def append(self, chunk_id: int, status: str, record: dict = None):
+        entry = {"chunk_id": chunk_id, "status": status}
+        if record is not None:
+            entry["record"] = record
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.entries[chunk_id] = entry
+
+    def summary(self) -> dict:
+        by_status = {COMPLETED: [], FAILED: [], SKIPPED: []}
+        for chunk_id in sorted(self.entries):
+            by_status[self.entries[chunk_id]["status"]].append(chunk_id)
+        return by_status
+
+    def write_manifest(self):
+        manifest = {"input_hash": self.input_hash, "total_chunks": self.total_chunks}
+        manifest.update(self.summary())
+        atomic_write_text(self.manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    def finalize(self, out_file: Path):
+        """
+        Атомарно пишет итоговый jsonl: записи completed-чанков в порядке chunk_id.
+        """
+        lines = [
+            json.dumps(self.entries[chunk_id]["record"], ensure_ascii=False) + "\n"
+            for chunk_id in sorted(self.entries)
+            if self.entries[chunk_id]["status"] == COMPLETED
+        ]
+        atomic_write_text(Path(out_file), "".join(lines))
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        self.write_manifest()
@@ -0,0 +1,192 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+BACKOFF_BASE = 2.0       # базовая задержка экспоненциального backoff (секунды)
+BACKOFF_CAP = 120.0      # верхняя граница задержки
+BREAKER_THRESHOLD = 5    # сколько сбоев подряд открывают circuit breaker
+BREAKER_COOLDOWN = 60.0  # на сколько секунд приостанавливается вся работа
+
+
+class ApiError(Exception):
+    """
+    Типизированный сбой запроса к API. retryable — имеет ли смысл повторять,
+    retry_after — пауза из заголовка Retry-After (секунды), если провайдер её прислал,
+    trips_breaker — считается ли сбой признаком недоступности провайдера.
+    """
+    kind = "error"
+    retryable = True
+    trips_breaker = False
+
+    def __init__(self, message: str = "", retry_after: float = None, content: str = None):
+        super().__init__(message or self.kind)
+        self.retry_after = retry_after
+        self.content = content
+
+
+class RateLimitedError(ApiError):
+    kind = "rate_limited"
+
+
+class ServerError(ApiError):
+    kind = "server_error"
+    trips_breaker = True
+
+
+class RequestTimeoutError(ApiError):
+    kind = "timeout"
+    trips_breaker = True
+
+
+class ConnectionFailedError(ApiError):
+    kind = "connection"
+    trips_breaker = True
+
+
+class ClientError(ApiError):
+    """
+    4xx кроме 408/429: неверный ключ, модель, слишком длинный запрос — повтор не поможет.
+    """
+    kind = "client_error"
+    retryable = False
+
+
+class MalformedResponseError(ApiError):
+    """
+    Ответ получен, но пустой или не проходит проверку (нет валидного JSON с 'output').
+    content хранит последний ответ, чтобы не потерять его после исчерпания попыток.
+    """
+    kind = "malformed"
+
+
+def parse_retry_after(value) -> float:
+    """
+    Retry-After бывает числом секунд или HTTP-датой. Возвращает секунды или None.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_exception(exc: Exception) -> ApiError:
+    """
+    Переводит исключение SDK OpenAI (или httpx) в ApiError. Используется duck typing
+    по status_code/response, чтобы не зависеть от версии SDK.
+    """
+    if isinstance(exc, ApiError):
+        return exc
+    name = type(exc).__name__
+    message = f"{name}: {exc}"
+    status = getattr(exc, "status_code", None)
+    response = getattr(exc, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    retry_after = None
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        retry_after = parse_retry_after(headers.get("retry-after"))
+
+    if "Timeout" in name or status == 408:
+        return RequestTimeoutError(message, retry_after)
+    if status == 429:
+        return RateLimitedError(message, retry_after)
+    if status is not None and status >= 500:
+        return ServerError(message, retry_after)
+    if status is not None and 400 <= status < 500:
+        return ClientError(message)
+    if "Connection" in name:
+        return ConnectionFailedError(message)
+    return ApiError(message)
+
+
+def backoff_delay(attempt: int, retry_after: float = None, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP) -> float:
+    """
+    Экспоненциальный backoff с full jitter: случайная пауза в [0, min(cap, base * 2^attempt)].
+    Если провайдер прислал Retry-After, ждём не меньше него (плюс небольшой jitter,
+    чтобы отложенные запросы не вернулись одновременно).
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, base))
+    return delay
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker на весь запуск: после threshold сбоев подряд (5xx, таймауты, обрывы соединения)
+    все потоки ждут cooldown секунд. После паузы breaker полуоткрыт: через wait() проходит ровно один
+    пробный запрос, остальные потоки ждут его результата. Успех (или ответ провайдера, не считающийся
+    его недоступностью, например 429) закрывает breaker и отпускает всех, сбой снова открывает его
+    на cooldown. Если пробный запрос не отчитался за cooldown секунд, пропускается следующий.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trips = 0
+        self.state = "closed"     # closed, open или half_open (пробный запрос в полёте)
+        self.probe_started = 0.0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def wait(self):
+        """
+        Блокирует поток, пока breaker открыт или пока не решится судьба пробного запроса.
+        """
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                if self.state == "closed":
+                    return
+                if self.state == "open":
+                    if now < self.opened_until:
+                        self._changed.wait(self.opened_until - now)
+                        continue
+                    self.state = "half_open"
+                    self.probe_started = now
+                    print("Пауза закончилась, отправляем пробный запрос.")
+                    return
+                if now - self.probe_started >= self.cooldown:
+                    # Пробный запрос не отчитался (завис или его поток погиб) — пробуем следующим
+                    self.probe_started = now
+                    return
+                self._changed.wait(self.probe_started + self.cooldown - now)
+
+    def record_success(self):
+        with self._changed:
+            self._close()
+
+    def record_failure(self, error: ApiError):
+        if not self.threshold:
+            return
+        with self._changed:
+            if not error.trips_breaker:
+                # Провайдер ответил (429, 4xx, невалидный JSON) — он доступен: серия сбоев прервана.
+                # Открытый breaker не трогаем: это может быть поздний ответ на запрос, ушедший до паузы
+                if self.state != "open":
+                    self._close()
+                return
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.opened_until = time.monotonic() + self.cooldown
+                self.state = "open"
+                self.trips += 1
+                self._changed.notify_all()
+                print(f"Провайдер недоступен ({error.kind}), приостанавливаем запросы на {self.cooldown:g} с.")
+
+    def _close(self):
+        self.failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            self._changed.notify_all()
@@ -0,0 +1,203 @@
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+# Границы бакетов гистограммы латентности запросов (секунды)
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+
+def default_report_path(script: str) -> Path:
+    return Path("reports") / f"{script}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+
+
+class RunMetrics:
+    """
+    Метрики одного запуска скрипта.
+
+    - stage(name, file) — контекстный менеджер: время стадии суммарно и по файлам;
+      при profile=True дополнительно пиковая память стадии по tracemalloc;
+    - inc()/observe_latency()/record_usage() — счётчики, гистограмма латентности и токены из usage;
+    - snapshot()/merge() — перенос метрик из дочерних процессов в родительский;
+    - write_json()/write_prometheus() — отчёт о запуске и textfile для node_exporter.
+
+    Все методы потокобезопасны.
+    """
+
+    def __init__(self, script: str, profile: bool = False):
+        self.script = script
+        self.profile = profile
+        self.started = time.time()
+        self.stages = {}
+        self.files = {}
+        self.counters = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._profile_text = None
+
+    @contextmanager
+    def stage(self, name: str, file: str = None):
+        if self.profile and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if self.profile and tracemalloc.is_tracing() else None
+            self.add_stage(name, seconds, file, peak)
+
+    def add_stage(self, name: str, seconds: float, file: str = None, peak_bytes: int = None):
+        with self._lock:
+            stats = self.stages.setdefault(name, {"count": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            if peak_bytes is not None:
+                stats["peak_bytes"] = max(stats.get("peak_bytes", 0), peak_bytes)
+            if file is not None:
+                per_file = self.files.setdefault(file, {})
+                per_file[name] = per_file.get(name, 0.0) + seconds
+
+    def inc(self, counter: str, value: float = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def observe_latency(self, seconds: float):
+        with self._lock:
+            idx = 0
+            while idx < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[idx]:
+                idx += 1
+            self.latency_buckets[idx] += 1
+            self.latency_sum += seconds
+            self.latency_count += 1
+
+    def record_usage(self, usage):
+        """
+        Учитывает поле usage ответа OpenAI-совместимого API (может отсутствовать).
+        """
+        if usage is None:
+            return
+        self.inc("prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+        self.inc("completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "stages": json.loads(json.dumps(self.stages)),
+                "files": json.loads(json.dumps(self.files)),
+                "counters": dict(self.counters),
+                "latency_buckets": list(self.latency_buckets),
+                "latency_sum": self.latency_sum,
+                "latency_count": self.latency_count,
+            }
+
+    def merge(self, snapshot: dict):
+        with self._lock:
+            for name, stats in snapshot["stages"].items():
+                own = self.stages.setdefault(name, {"count": 0, "seconds": 0.0})
+                own["count"] += stats["count"]
+                own["seconds"] += stats["seconds"]
+                if "peak_bytes" in stats:
+                    own["peak_bytes"] = max(own.get("peak_bytes", 0), stats["peak_bytes"])
+            for file, per_file in snapshot["files"].items():
+                own = self.files.setdefault(file, {})
+                for name, seconds in per_file.items():
+                    own[name] = own.get(name, 0.0) + seconds
+            for counter, value in snapshot["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+            self.latency_buckets = [a + b for a, b in zip(self.latency_buckets, snapshot["latency_buckets"])]
+            self.latency_sum += snapshot["latency_sum"]
+            self.latency_count += snapshot["latency_count"]
+
+    def start_profiling(self):
+        """
+        Запускает cProfile на весь прогон и tracemalloc для пиковой памяти по стадиям.
+        """
+        if not self.profile:
+            return
+        tracemalloc.start()
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def stop_profiling(self, prof_path: Path = None, top: int = 30):
+        if not self._profiler:
+            return
+        self._profiler.disable()
+        if prof_path:
+            Path(prof_path).parent.mkdir(parents=True, exist_ok=True)
+            self._profiler.dump_stats(str(prof_path))
+        buffer = io.StringIO()
+        pstats.Stats(self._profiler, stream=buffer).sort_stats("cumulative").print_stats(top)
+        self._profile_text = buffer.getvalue()
+        self._profiler = None
+        tracemalloc.stop()
+
+    def report(self, extra: dict = None) -> dict:
+        snapshot = self.snapshot()
+        latency = {
+            "count": self.latency_count,
+            "mean_seconds": self.latency_sum / self.latency_count if self.latency_count else None,
+            "buckets": {
+                **{f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS, snapshot["latency_buckets"])},
+                "le_inf": snapshot["latency_buckets"][-1],
+            },
+        }
+        report = {
+            "script": self.script,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": time.time() - self.started,
+            "stages": snapshot["stages"],
+            "files": snapshot["files"],
+            "counters": snapshot["counters"],
+            "request_latency": latency,
+        }
+        if extra:
+            report.update(extra)
+        if self._profile_text:
+            report["profile_top"] = self._profile_text
+        return report
+
+    def write_json(self, path: Path, extra: dict = None) -> dict:
+        report = self.report(extra)
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        return report
+
+    def write_prometheus(self, path: Path, extra_gauges: dict = None):
+        """
+        Пишет метрики в формате Prometheus textfile (для textfile collector node_exporter).
+        """
+        prefix = f"butterboard_{self.script}"
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter"]
+        for name, stats in snapshot["stages"].items():
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stats["seconds"]:.6f}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for counter, value in snapshot["counters"].items():
+            lines.append(f'{prefix}_events_total{{event="{counter}"}} {value}')
+        lines.append(f"# TYPE {prefix}_request_latency_seconds histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, snapshot["latency_buckets"]):
+            cumulative += count
+            lines.append(f'{prefix}_request_latency_seconds_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += snapshot["latency_buckets"][-1]
+        lines.append(f'{prefix}_request_latency_seconds_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{prefix}_request_latency_seconds_sum {snapshot['latency_sum']:.6f}")
+        lines.append(f"{prefix}_request_latency_seconds_count {snapshot['latency_count']}")
+        for name, value in (extra_gauges or {}).items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        tmp.replace(path)
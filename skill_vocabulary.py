@@ -0,0 +1,327 @@
+import json
+import argparse
+from pathlib import Path
+from functools import lru_cache
+from collections import Counter
+
+from assemble_dataset import CLEANED_FILE, open_atomic, commit_atomic
+from progress_manifest import atomic_write_text
+from run_metrics import default_report_path
+
+VOCABULARY_FILE = "skill_vocabulary.json"
+SKILL_FIELDS = ("hard_skills", "soft_skills")
+NGRAM_SIZE = 3
+FUZZY_THRESHOLD = 0.6    # минимальный коэффициент Жаккара по n-граммам для кандидата нечёткого совпадения
+TYPO_DISTANCE = 1        # допустимое расстояние Левенштейна между словами (для слов от 9 букв — на 1 больше)
+CACHE_SIZE = 1 << 16     # сколько сырых строк помнит нормализатор
+TOP_SKILLS = 30
+
+STOP_WORDS = {"и", "в", "во", "на", "с", "со", "к", "по", "для", "о", "об", "от", "из", "за", "при", "а"}
+# Окончания (самые длинные первыми): отрезаются, чтобы разные падежи и числа давали одну основу
+ENDINGS = sorted([
+    "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ать", "ять", "ить", "еть",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ых", "их", "ую", "юю",
+    "ов", "ев", "ам", "ям", "ах", "ях", "ом", "ем",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+MIN_STEM = 3
+
+
+def stem(word: str) -> str:
+    """
+    Грубый стеммер: снимает одно окончание, если остаётся основа не короче MIN_STEM.
+    Слова латиницей (названия технологий) не меняются.
+    """
+    if not any("а" <= ch <= "я" for ch in word):
+        return word
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def skill_key(raw: str) -> str:
+    """
+    Ключ навыка: нижний регистр, ё -> е, без пунктуации и служебных слов,
+    основы слов отсортированы — порядок слов и окончания не влияют на ключ.
+    """
+    text = raw.lower().replace("ё", "е")
+    text = "".join(ch if ch.isalnum() or ch in "+#" else " " for ch in text)
+    return " ".join(sorted(stem(word) for word in text.split() if word not in STOP_WORDS))
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Расстояние Левенштейна, но не больше limit + 1 (дальше считать незачем).
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ch_a in enumerate(a, 1):
+        current = [i]
+        for j, ch_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ch_a != ch_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def is_typo_variant(key: str, other: str) -> bool:
+    """
+    Ключи отличаются только опечатками: слов столько же, и каждому несовпавшему слову
+    находится пара на расстоянии не больше TYPO_DISTANCE (2 для длинных слов).
+    Приставка "не" опечаткой не считается: "функциональн" и "нефункциональн" — разные навыки.
+    """
+    words, others = key.split(), other.split()
+    if len(words) != len(others):
+        return False
+    rest = list((Counter(others) - Counter(words)).elements())
+    for word in (Counter(words) - Counter(others)).elements():
+        limit = TYPO_DISTANCE + (len(word) >= 9)
+        for candidate in rest:
+            negated = candidate == "не" + word or word == "не" + candidate
+            if not negated and edit_distance(word, candidate, limit) <= limit:
+                rest.remove(candidate)
+                break
+        else:
+            return False
+    return True
+
+
+def ngrams(key: str, size: int = NGRAM_SIZE) -> frozenset:
+    padded = f" {key} "
+    return frozenset(padded[i:i + size] for i in range(max(1, len(padded) - size + 1)))
+
+
+class SkillVocabulary:
+    """
+    Канонический словарь навыков: ID -> название (самая частая форма) и известные варианты.
+
+    Поиск: сначала точное совпадение ключа skill_key, затем нечёткий поиск по инвертированному
+    индексу символьных n-грамм ключей — кандидаты набираются только из списков тех n-грамм,
+    что есть в запросе, отбираются по Жаккару и проверяются на опечатку (is_typo_variant).
+    normalize() кэширует ответы в LRU, поэтому повторяющиеся строки корпуса разбираются один раз.
+    """
+
+    def __init__(self, threshold: float = FUZZY_THRESHOLD, ngram_size: int = NGRAM_SIZE, cache_size: int = CACHE_SIZE):
+        self.threshold = threshold
+        self.ngram_size = ngram_size
+        self.names = []          # ID -> каноническое название
+        self.variants = []       # ID -> {сырая строка: частота}
+        self.by_key = {}         # ключ -> ID
+        self.keys = []           # известные ключи по порядку добавления
+        self.key_grams = []      # ключ -> его n-граммы
+        self.key_ids = []        # ключ -> ID
+        self.index = {}          # n-грамма -> номера ключей
+        self.normalize = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _add_key(self, key: str, skill_id: int):
+        self.by_key[key] = skill_id
+        grams = ngrams(key, self.ngram_size)
+        for gram in grams:
+            self.index.setdefault(gram, []).append(len(self.key_ids))
+        self.keys.append(key)
+        self.key_grams.append(grams)
+        self.key_ids.append(skill_id)
+
+    def fuzzy_match(self, key: str) -> tuple:
+        """
+        (ID, сходство) ближайшего известного ключа, отличающегося лишь опечатками, или (None, 0.0).
+        """
+        grams = ngrams(key, self.ngram_size)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.index.get(gram, ()))
+        scored = []
+        for key_idx, common in shared.items():
+            score = common / (len(grams) + len(self.key_grams[key_idx]) - common)
+            if score >= self.threshold:
+                scored.append((score, key_idx))
+        for score, key_idx in sorted(scored, reverse=True):
+            if is_typo_variant(key, self.keys[key_idx]):
+                return self.key_ids[key_idx], score
+        return None, 0.0
+
+    def _lookup(self, raw: str):
+        key = skill_key(raw)
+        if not key:
+            return None
+        if key in self.by_key:
+            return self.by_key[key]
+        return self.fuzzy_match(key)[0]
+
+    def add(self, raw: str, count: int = 1) -> int:
+        """
+        Добавляет вариант навыка: к найденному каноническому навыку или как новый навык.
+        """
+        key = skill_key(raw)
+        if not key:
+            return None
+        skill_id = self.by_key.get(key)
+        if skill_id is None:
+            skill_id = self.fuzzy_match(key)[0]
+            if skill_id is None:
+                skill_id = len(self.names)
+                self.names.append(raw.strip())
+                self.variants.append({})
+            self._add_key(key, skill_id)
+        self.variants[skill_id][raw] = self.variants[skill_id].get(raw, 0) + count
+        self.normalize.cache_clear()
+        return skill_id
+
+    def canonical(self, raw: str) -> str:
+        """
+        Каноническое название навыка; неизвестный навык возвращается как есть.
+        """
+        skill_id = self.normalize(raw)
+        return raw if skill_id is None else self.names[skill_id]
+
+    @classmethod
+    def build(cls, records, threshold: float = FUZZY_THRESHOLD, ngram_size: int = NGRAM_SIZE):
+        """
+        Строит словарь по записям датасета. Варианты добавляются от частых к редким,
+        поэтому каноническим названием становится самая частая форма, а опечатки
+        и редкие формы притягиваются к ней, а не наоборот.
+        """
+        counts = Counter()
+        for record in records:
+            for skill in iter_skills(record):
+                counts[skill] += 1
+        vocabulary = cls(threshold, ngram_size)
+        for raw, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            vocabulary.add(raw, count)
+        return vocabulary
+
+    def to_dict(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "ngram_size": self.ngram_size,
+            "skills": [
+                {"id": skill_id, "name": name, "variants": self.variants[skill_id]}
+                for skill_id, name in enumerate(self.names)
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        vocabulary = cls(data.get("threshold", FUZZY_THRESHOLD), data.get("ngram_size", NGRAM_SIZE))
+        for skill in sorted(data["skills"], key=lambda s: s["id"]):
+            skill_id = len(vocabulary.names)
+            vocabulary.names.append(skill["name"])
+            vocabulary.variants.append(dict(skill["variants"]))
+            for raw in skill["variants"]:
+                key = skill_key(raw)
+                if key and key not in vocabulary.by_key:
+                    vocabulary._add_key(key, skill_id)
+        return vocabulary
+
+    def save(self, path: Path):
+        atomic_write_text(Path(path), json.dumps(self.to_dict(), ensure_ascii=False, indent=2))
+
+    @classmethod
+    def load(cls, path: Path):
+        return cls.from_dict(json.loads(Path(path).read_text(encoding="utf-8")))
+
+
+def iter_skills(record: dict):
+    output = record.get("output") or {}
+    for field in SKILL_FIELDS:
+        values = output.get(field)
+        if isinstance(values, list):
+            yield from (v for v in values if isinstance(v, str))
+
+
+def normalize_record(record: dict, vocabulary: SkillVocabulary) -> dict:
+    """
+    Заменяет навыки записи каноническими названиями; повторы внутри списка схлопываются.
+    """
+    output = dict(record.get("output") or {})
+    for field in SKILL_FIELDS:
+        values = output.get(field)
+        if isinstance(values, list):
+            output[field] = list(dict.fromkeys(vocabulary.canonical(v) if isinstance(v, str) else v for v in values))
+    return dict(record, output=output)
+
+
+def frequency_table(records, vocabulary: SkillVocabulary) -> dict:
+    """
+    Частоты канонических навыков по полям: {поле: Counter(ID или сырая строка для неизвестных)}.
+    """
+    tables = {field: Counter() for field in SKILL_FIELDS}
+    for record in records:
+        output = record.get("output") or {}
+        for field in SKILL_FIELDS:
+            values = output.get(field)
+            if isinstance(values, list):
+                ids = (vocabulary.normalize(v) for v in values if isinstance(v, str))
+                tables[field].update(skill_id for skill_id in ids if skill_id is not None)
+    return tables
+
+
+def iter_records(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Канонический словарь навыков и нормализация датасета.")
+    parser.add_argument("--input", default=CLEANED_FILE, help="входной JSONL")
+    parser.add_argument("--vocabulary", default=VOCABULARY_FILE, help="файл словаря навыков")
+    parser.add_argument("--build", action="store_true", help="перестроить словарь по --input")
+    parser.add_argument("--threshold", type=float, default=FUZZY_THRESHOLD,
+                        help="порог сходства n-грамм при построении словаря")
+    parser.add_argument("--output", help="переписать датасет с каноническими названиями навыков в этот файл")
+    parser.add_argument("--top", type=int, default=TOP_SKILLS, help="сколько самых частых навыков вывести")
+    parser.add_argument("--report", help="JSON с таблицами частот (по умолчанию reports/skills-<время>.json)")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    vocabulary_path = Path(args.vocabulary)
+    if args.build or not vocabulary_path.exists():
+        vocabulary = SkillVocabulary.build(iter_records(args.input), args.threshold)
+        vocabulary.save(vocabulary_path)
+        mentions = sum(sum(v.values()) for v in vocabulary.variants)
+        print(f"Словарь: {len(vocabulary)} навыков из {mentions} упоминаний, сохранён в {vocabulary_path}")
+    else:
+        vocabulary = SkillVocabulary.load(vocabulary_path)
+
+    if args.output:
+        output_path = Path(args.output)
+        out = open_atomic(output_path)
+        for record in iter_records(args.input):
+            out.write(json.dumps(normalize_record(record, vocabulary), ensure_ascii=False) + "\n")
+        commit_atomic(out, output_path)
+        print(f"Нормализованный датасет сохранён: {output_path}")
+
+    tables = frequency_table(iter_records(args.input), vocabulary)
+    for field, table in tables.items():
+        print(f"\n{field}: {len(table)} навыков, {sum(table.values())} упоминаний")
+        for skill_id, count in table.most_common(args.top):
+            print(f"{count:>8}  {vocabulary.names[skill_id]}")
+    info = vocabulary.normalize.cache_info()
+    print(f"\nКэш нормализатора: {info.hits} попаданий, {info.misses} промахов")
+
+    report_path = Path(args.report) if args.report else default_report_path("skills")
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps({
+        "input": args.input,
+        "vocabulary": str(vocabulary_path),
+        "frequencies": {
+            field: [{"id": skill_id, "name": vocabulary.names[skill_id], "count": count}
+                    for skill_id, count in table.most_common()]
+            for field, table in tables.items()
+        },
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Отчёт сохранён в {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import assemble_dataset
+from assemble_dataset import assemble, load_dataset
+
+
+def write_samples(path, count):
+    with path.open("w", encoding="utf-8") as f:
+        for i in range(count):
+            record = {"instruction": "i", "input": f"текст {i}", "chunk_id": i, "source_file": path.name,
+                      "output": {field: [] for field in assemble_dataset.OUTPUT_FIELDS}}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def test_shards_are_swapped_in_only_after_success(tmp_path):
+    samples = tmp_path / "a_final_samples.jsonl"
+    write_samples(samples, 5)
+    shards_dir = tmp_path / "out" / assemble_dataset.SHARDS_DIR
+    counts = assemble([samples], tmp_path / "out", formats=("arrow",), shard_rows=2)
+    assert counts["shards"]["rows"] == 5
+    before = sorted(p.name for p in shards_dir.iterdir())
+    assert before == ["manifest.json", "part-00000.arrow", "part-00001.arrow", "part-00002.arrow"]
+
+    write_samples(samples, 7)
+
+    # Второй файл пропал: сборка падает после того, как часть новых шардов уже записана
+    with pytest.raises(FileNotFoundError):
+        assemble([samples, tmp_path / "missing_final_samples.jsonl"], tmp_path / "out", formats=("arrow",),
+                 shard_rows=2)
+    assert sorted(p.name for p in shards_dir.iterdir()) == before
+    assert load_dataset(shards_dir).num_rows == 5
+    cleaned = tmp_path / "out" / assemble_dataset.CLEANED_FILE
+    assert len(cleaned.read_text(encoding="utf-8").splitlines()) == 5
+    # Временные файлы и папки за упавшей сборкой не остаются
+    assert sorted(p.name for p in shards_dir.parent.iterdir()) == sorted(
+        [assemble_dataset.SHARDS_DIR, assemble_dataset.MERGED_FILE, assemble_dataset.CLEANED_FILE,
+         assemble_dataset.QUARANTINE_FILE])
+
+    counts = assemble([samples], tmp_path / "out", formats=("arrow",), shard_rows=4)
+    assert json.loads((shards_dir / "manifest.json").read_text(encoding="utf-8")) == counts["shards"]
+    assert sorted(p.name for p in shards_dir.iterdir()) == ["manifest.json", "part-00000.arrow", "part-00001.arrow"]
+    assert load_dataset(shards_dir).num_rows == 7
+
+
+def test_interrupted_swap_restores_previous_shards(tmp_path):
+    shards_dir = tmp_path / assemble_dataset.SHARDS_DIR
+    old_dir = tmp_path / f".{assemble_dataset.SHARDS_DIR}.old"
+    old_dir.mkdir()
+    (old_dir / "manifest.json").write_text("{}", encoding="utf-8")
+    writer = assemble_dataset.ShardWriter(shards_dir, ("arrow",))
+    assert (shards_dir / "manifest.json").read_text(encoding="utf-8") == "{}"
+    writer.abort()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [assemble_dataset.SHARDS_DIR]
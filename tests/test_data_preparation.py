@@ -0,0 +1,103 @@
+import json
+import zipfile
+from pathlib import Path
+
+import pytest
+
+import data_preparation
+import keyword_matcher
+from data_preparation import (DialogueSegment, DialogueWriter, DiarSegment, iter_matched_segments,
+                              iter_merged_segments, iter_with_roles, parse_timestamp_ms, parse_transcription_line)
+
+
+@pytest.mark.parametrize("ts, expected", [
+    ("00:00:03,799", 3799),
+    ("00:00:03.5", 3500),
+    ("00:00:03,123456", 3123),
+    ("25:00:00,000", 90_000_000),
+])
+def test_parse_timestamp_ms(ts, expected):
+    assert parse_timestamp_ms(ts) == expected
+
+
+@pytest.mark.parametrize("ts", ["00:00:03", "00:00:03,", "00:00:03,1234567", "00:03,500", "aa:00:03,500"])
+def test_parse_timestamp_ms_rejects_what_strptime_rejected(ts):
+    with pytest.raises(ValueError):
+        parse_timestamp_ms(ts)
+
+
+def test_transcription_line_without_fraction_is_skipped():
+    assert parse_transcription_line("00:00:01 - 00:00:02 - текст") is None
+
+
+def test_original_timestamp_strings_reach_output():
+    lines = [
+        "00:00:01.5 - 00:00:02.25 - Расскажите о себе?",
+        "00:00:02,250000 - 00:00:04,1234 - Я разработчик",
+        "00:00:04,1234 - 00:00:05.9 - и тестировщик",
+    ]
+    trans = [parse_transcription_line(line) for line in lines]
+    diar = [DiarSegment(0, 2250, "A"), DiarSegment(2250, 6000, "B")]
+    dialogue = iter_with_roles(iter_matched_segments(trans, diar), {"A": "interviewer", "B": "candidate"})
+    result = [seg.to_dict() for seg in iter_merged_segments(dialogue)]
+    assert result == [
+        {"start_time": "00:00:01.5", "end_time": "00:00:02.25", "speaker": "interviewer",
+         "text": "Расскажите о себе?"},
+        {"start_time": "00:00:02,250000", "end_time": "00:00:05.9", "speaker": "candidate",
+         "text": "Я разработчик и тестировщик"},
+    ]
+
+
+def test_out_of_order_fallback_transcription_is_processed_in_memory(tmp_path, monkeypatch):
+    def broken_stream(path):
+        raise zipfile.BadZipFile("нестандартный архив")
+        yield
+
+    lines = [
+        "00:00:03,000 - 00:00:04,000 - Я разработчик",
+        "00:00:01,000 - 00:00:02,000 - Расскажите о себе?",
+    ]
+    monkeypatch.setattr(data_preparation, "iter_transcription_docx", broken_stream)
+    monkeypatch.setattr(data_preparation, "parse_transcription_docx",
+                        lambda path: [parse_transcription_line(line) for line in lines])
+    diar_file = tmp_path / "pair_diarization.txt"
+    diar_file.write_text("00:00:00,000 - 00:00:02,500 - A\n00:00:02,500 - 00:00:05,000 - B\n", encoding="utf-8")
+
+    data_preparation.process_pair(diar_file, tmp_path / "pair_transcription.docx", tmp_path)
+
+    dialogue = json.loads((tmp_path / "dialoge_pair.json").read_text(encoding="utf-8"))["dialogue"]
+    # assign_roles в конце сортирует реплики по началу
+    assert [(seg["start_time"], seg["speaker"]) for seg in dialogue] == [
+        ("00:00:01,000", "interviewer"),
+        ("00:00:03,000", "candidate"),
+    ]
+
+
+def test_dialogue_writer_keeps_previous_output_on_failure(tmp_path):
+    path = tmp_path / "dialoge_pair.json"
+    path.write_text("старый результат", encoding="utf-8")
+    with pytest.raises(RuntimeError):
+        with DialogueWriter(path) as writer:
+            writer.write(DialogueSegment(0, 1000, "interviewer", "Вопрос?"))
+            raise RuntimeError("сбой посреди записи")
+    assert path.read_text(encoding="utf-8") == "старый результат"
+    assert list(tmp_path.iterdir()) == [path]
+
+    segments = [DialogueSegment(0, 1000, "interviewer", "Вопрос?"), DialogueSegment(1000, 2000, "candidate", "Ответ")]
+    with DialogueWriter(path) as writer:
+        for seg in segments:
+            writer.write(seg)
+    assert json.loads(path.read_text(encoding="utf-8")) == {"dialogue": [seg.to_dict() for seg in segments]}
+    assert list(tmp_path.iterdir()) == [path]
+
+
+
+def test_params_fingerprint_covers_keyword_matcher(tmp_path, monkeypatch):
+    # Роли считаются в keyword_matcher: его изменение должно пересобирать пары
+    assert Path(keyword_matcher.__file__).resolve() in {Path(module).resolve() for module in data_preparation.BUILD_MODULES}
+    matcher = tmp_path / "keyword_matcher.py"
+    matcher.write_bytes(Path(keyword_matcher.__file__).read_bytes())
+    monkeypatch.setattr(data_preparation, "BUILD_MODULES", [data_preparation.__file__, matcher])
+    before = data_preparation.params_fingerprint()
+    matcher.write_text(matcher.read_text(encoding="utf-8") + "\n# другой подсчёт\n", encoding="utf-8")
+    assert data_preparation.params_fingerprint() != before
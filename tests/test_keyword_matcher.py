@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from data_preparation import KEYWORD_COUNTER, KEYWORDS
+from keyword_matcher import KeywordCounter
+
+
+def naive_count(text: str, keywords: list) -> int:
+    """
+    Прежний подсчёт в assign_roles, с которым сверяется KeywordCounter.
+    """
+    return sum(text.count(kw) for kw in keywords)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_matches_naive_count_on_random_texts(seed):
+    rng = random.Random(seed)
+    alphabet = "абв "
+    keywords = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 6))]
+    text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+    assert KeywordCounter(keywords).count(text) == naive_count(text, keywords)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "Почему вы ушли? почему ты так решил? Как бы вы поступили?",
+    "расскажите, расскажите про проект — что вы делали и как? почемупочему",
+    "ПОЧЕМУ заглавными не считается, а почему ты — считается дважды",
+    "приведи пример: какие технологии, какой стэк и что именно ты бы предложил? предложи решение, сравни",
+])
+def test_data_preparation_keywords_match_naive_count(text):
+    assert KEYWORD_COUNTER.count(text) == naive_count(text, KEYWORDS)
+
+
+def test_overlaps_and_duplicates():
+    # "аа" в "аааа" — два непересекающихся вхождения, как у str.count; повтор слова в списке удваивает счёт
+    assert KeywordCounter(["аа", "а", "аа"]).count("аааа") == naive_count("аааа", ["аа", "а", "аа"]) == 8
+
+
+def test_empty_keyword_is_rejected():
+    with pytest.raises(ValueError):
+        KeywordCounter(["а", ""])
@@ -0,0 +1,102 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from data_preparation import DiarSegment, TransSegment, match_segments, iter_matched_segments
+
+ORIGIN = datetime(1900, 1, 1)
+
+
+def reference_match_segments(trans_segments: list, diar_segments: list, tolerance_ratio: float = 0.5) -> list:
+    """
+    Прежняя реализация (вложенный цикл по datetime), с которой сверяется sweep-line.
+    """
+    def calculate_overlap(seg_start, seg_end, ref_start, ref_end):
+        latest_start = max(seg_start, ref_start)
+        earliest_end = min(seg_end, ref_end)
+        overlap = (earliest_end - latest_start).total_seconds()
+        return max(0, overlap)
+
+    matched = []
+    for t_seg in trans_segments:
+        best_overlap = 0.0
+        best_diar = None
+        t_duration = (t_seg["end_dt"] - t_seg["start_dt"]).total_seconds()
+        for d_seg in diar_segments:
+            overlap = calculate_overlap(t_seg["start_dt"], t_seg["end_dt"],
+                                        d_seg["start_dt"], d_seg["end_dt"])
+            if overlap > best_overlap:
+                best_overlap = overlap
+                best_diar = d_seg
+        if best_diar and best_overlap >= tolerance_ratio * t_duration:
+            matched.append((t_seg["start_ms"], t_seg["end_ms"], best_diar["speaker"], t_seg["text"]))
+    return matched
+
+
+def as_dict(start_ms, end_ms, **fields):
+    return dict(start_ms=start_ms, end_ms=end_ms, start_dt=ORIGIN + timedelta(milliseconds=start_ms),
+                end_dt=ORIGIN + timedelta(milliseconds=end_ms), **fields)
+
+
+def random_segments(rng, count, grid, max_len, sort):
+    # Грубая сетка даёт много совпадающих границ (равные перекрытия) и нулевые длительности
+    bounds = []
+    for _ in range(count):
+        start = rng.randrange(0, 60) * grid
+        bounds.append((start, start + rng.randrange(0, max_len + 1) * grid))
+    return sorted(bounds) if sort else bounds
+
+
+def run_both(trans_bounds, diar_bounds, tolerance_ratio):
+    speakers = [f"SPEAKER_{i % 3:02d}" for i in range(len(diar_bounds))]
+    texts = [f"реплика {i}" for i in range(len(trans_bounds))]
+    expected = reference_match_segments(
+        [as_dict(s, e, text=t) for (s, e), t in zip(trans_bounds, texts)],
+        [as_dict(s, e, speaker=sp) for (s, e), sp in zip(diar_bounds, speakers)],
+        tolerance_ratio,
+    )
+    trans = [TransSegment(s, e, t) for (s, e), t in zip(trans_bounds, texts)]
+    diar = [DiarSegment(s, e, sp) for (s, e), sp in zip(diar_bounds, speakers)]
+    actual = [(m.start_ms, m.end_ms, m.speaker, m.text) for m in match_segments(trans, diar, tolerance_ratio)]
+    return expected, actual, trans, diar
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_nested_loop_on_random_segments(seed):
+    rng = random.Random(seed)
+    grid = rng.choice([1, 7, 250, 1000])
+    tolerance_ratio = rng.choice([0.0, 0.25, 0.5, 0.5, 0.75, 1.0])
+    sort = seed % 2 == 0
+    trans_bounds = random_segments(rng, rng.randrange(0, 40), grid, 6, sort)
+    diar_bounds = random_segments(rng, rng.randrange(0, 40), grid, 8, sort)
+
+    expected, actual, trans, diar = run_both(trans_bounds, diar_bounds, tolerance_ratio)
+    assert actual == expected
+    if sort:
+        streamed = [(m.start_ms, m.end_ms, m.speaker, m.text)
+                    for m in iter_matched_segments(trans, diar, tolerance_ratio, log_unmatched=False)]
+        assert streamed == expected
+
+
+def test_ties_go_to_the_earlier_diarization_segment():
+    # Оба сегмента диаризации перекрывают реплику на 1 с; выигрывает первый во входном списке
+    trans_bounds = [(1000, 3000)]
+    expected, actual, _, _ = run_both(trans_bounds, [(2000, 4000), (0, 2000)], 0.5)
+    assert actual == expected == [(1000, 3000, "SPEAKER_00", "реплика 0")]
+
+
+def test_zero_length_segments_are_never_matched():
+    expected, actual, _, _ = run_both([(1000, 1000), (2000, 3000)], [(0, 5000), (2500, 2500)], 0.0)
+    assert actual == expected == [(2000, 3000, "SPEAKER_00", "реплика 1")]
+
+
+@pytest.mark.parametrize("tolerance_ratio", [0.1, 0.3, 0.5, 0.7, 0.9])
+@pytest.mark.parametrize("duration", [1, 3, 7, 999, 1001, 3333])
+def test_tolerance_boundary(tolerance_ratio, duration):
+    # Перекрытие ровно на границе допуска и на 1 мс по обе стороны от неё
+    for delta in (-1, 0, 1):
+        overlap = max(0, round(tolerance_ratio * duration) + delta)
+        expected, actual, _, _ = run_both([(10_000, 10_000 + duration)],
+                                          [(10_000 + duration - overlap, 20_000)], tolerance_ratio)
+        assert actual == expected
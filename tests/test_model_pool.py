@@ -0,0 +1,88 @@
+import sqlite3
+import types
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("dotenv")
+
+import dataset_pipeline as dp
+from completion_cache import CompletionCache
+from model_pool import Endpoint, ModelPool
+
+ANSWER = dp.FEW_SHOT_EXAMPLES[1]["content"]
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        message = types.SimpleNamespace(content=ANSWER)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+def endpoint(name, model, weight=1.0):
+    completions = FakeCompletions()
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions))
+    return Endpoint(name, client, model, weight), completions
+
+
+def annotate(pool, cache, count=6):
+    sources = {}
+    tasks = [(i, f"Вопрос: {i}?\nОтвет: да.") for i in range(count)]
+    results = list(dp.annotate_chunks(None, tasks, pool.name, concurrency=2, cache=cache, pool=pool, sources=sources))
+    assert all(content == ANSWER for _, content in results)
+    return sources
+
+
+def test_cache_is_keyed_by_the_model_that_answered(tmp_path):
+    cache = CompletionCache(tmp_path / "cache.sqlite")
+    first, first_calls = endpoint("first", "model-a")
+    assert annotate(ModelPool([first]), cache) == {i: "first" for i in range(6)}
+    assert first_calls.calls == 6
+    rows = sqlite3.connect(str(tmp_path / "cache.sqlite")).execute("SELECT DISTINCT model, endpoint FROM completions")
+    assert rows.fetchall() == [("model-a", "first")]
+
+    # Новый endpoint и другие веса не сбрасывают кэш, а запись помнит, кто дал ответ
+    reweighted, reweighted_calls = endpoint("first", "model-a", weight=3.0)
+    extra, extra_calls = endpoint("extra", "model-b")
+    assert annotate(ModelPool([extra, reweighted]), cache) == {i: "first" for i in range(6)}
+    assert reweighted_calls.calls == extra_calls.calls == 0
+
+    # Ответ другой модели из кэша не берётся
+    other, other_calls = endpoint("other", "model-c")
+    assert annotate(ModelPool([other]), cache) == {i: "other" for i in range(6)}
+    assert other_calls.calls == 6
+    cache.close()
+
+
+class SlowLimiter:
+    """
+    Лимитер, который держит каждый запрос delay секунд.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def acquire(self, tokens=0):
+        dp.time.sleep(self.delay)
+
+    def wait_time(self, tokens=0):
+        return 0.0
+
+
+def test_limiter_wait_does_not_trigger_a_hedge():
+    primary, _ = endpoint("primary", "model-a")
+    backup, backup_calls = endpoint("backup", "model-b", weight=1e-9)
+    primary.limiter = SlowLimiter(0.2)
+    for _ in range(50):
+        primary.stats.record(0.01)
+    pool = ModelPool([primary, backup], hedge=True)
+    # Ответ приходит сразу, но только после 0.2 с ожидания лимита — дольше p95 (0.01 с)
+    request = lambda ep, cancel: dp.call_openrouter_api(ep.client, "q", ep.model, raise_errors=True)
+    content, winner = pool.call(request)
+    assert winner is primary and content == ANSWER
+    assert primary.stats.hedges == 0 and backup_calls.calls == 0
+    pool.close()
@@ -0,0 +1,59 @@
+import json
+
+from progress_manifest import ProgressJournal, truncate_torn_tail, COMPLETED
+
+
+def record(chunk_id):
+    return {"input": f"chunk {chunk_id}", "output": {"hard_skills": [], "soft_skills": [], "recommendations": []}}
+
+
+def test_truncate_torn_tail(tmp_path):
+    path = tmp_path / "a.jsonl"
+    path.write_text('{"a": 1}\n{"b": 2}\n{"c":', encoding="utf-8")
+    assert truncate_torn_tail(path) == len('{"c":')
+    assert path.read_text(encoding="utf-8") == '{"a": 1}\n{"b": 2}\n'
+    assert truncate_torn_tail(path) == 0
+
+    path.write_text('{"c":', encoding="utf-8")
+    truncate_torn_tail(path)
+    assert path.read_text(encoding="utf-8") == ""
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    journal = ProgressJournal(tmp_path, "dialog")
+    journal.start("hash", total_chunks=3, resume=False)
+    journal.append(0, COMPLETED, record(0))
+    journal.close()
+    # Падение посреди записи чанка 1; последняя запись без перевода строки полная, но тоже оборвана
+    with journal.journal_path.open("a", encoding="utf-8") as f:
+        f.write(json.dumps({"chunk_id": 1, "status": COMPLETED, "record": record(1)})[:25])
+
+    journal = ProgressJournal(tmp_path, "dialog")
+    journal.start("hash", total_chunks=3, resume=True)
+    assert journal.pending() == [1, 2]
+    journal.append(1, COMPLETED, record(1))
+    journal.close()
+
+    journal = ProgressJournal(tmp_path, "dialog")
+    journal.start("hash", total_chunks=3, resume=True)
+    assert journal.pending() == [2]
+    journal.append(2, COMPLETED, record(2))
+    journal.close()
+
+    out_file = tmp_path / "dialog_samples.jsonl"
+    journal.finalize(out_file)
+    lines = out_file.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["input"] for line in lines] == ["chunk 0", "chunk 1", "chunk 2"]
+
+
+def test_unterminated_complete_line_is_not_trusted(tmp_path):
+    journal = ProgressJournal(tmp_path, "dialog")
+    journal.start("hash", total_chunks=2, resume=False)
+    journal.close()
+    with journal.journal_path.open("a", encoding="utf-8") as f:
+        f.write(json.dumps({"chunk_id": 0, "status": COMPLETED, "record": record(0)}))
+
+    journal = ProgressJournal(tmp_path, "dialog")
+    journal.start("hash", total_chunks=2, resume=True)
+    assert journal.pending() == [0, 1]
+    journal.close()
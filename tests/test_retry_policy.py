@@ -0,0 +1,82 @@
+import threading
+import time
+
+from retry_policy import CircuitBreaker, ServerError, RateLimitedError
+
+
+def start_waiters(breaker, count):
+    passed = []
+    threads = [threading.Thread(target=lambda: (breaker.wait(), passed.append(time.monotonic())), daemon=True)
+               for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return passed, threads
+
+
+def test_half_open_lets_exactly_one_probe_through():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.2)
+    breaker.record_failure(ServerError())
+    breaker.wait()  # один сбой — ещё закрыт
+    breaker.record_failure(ServerError())
+    assert breaker.state == "open" and breaker.trips == 1
+
+    passed, threads = start_waiters(breaker, 4)
+    time.sleep(0.1)
+    assert passed == []
+    time.sleep(0.15)
+    assert len(passed) == 1 and breaker.state == "half_open"
+
+    # Проба не удалась — снова пауза, и снова ровно одна проба
+    breaker.record_failure(ServerError())
+    assert breaker.state == "open" and breaker.trips == 2
+    time.sleep(0.3)
+    assert len(passed) == 2
+
+    breaker.record_success()
+    for thread in threads:
+        thread.join(1)
+    assert len(passed) == 4 and breaker.state == "closed"
+
+
+def test_provider_answer_closes_half_open_breaker():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.record_failure(ServerError())
+    breaker.wait()
+    assert breaker.state == "half_open"
+    breaker.record_failure(RateLimitedError())
+    assert breaker.state == "closed" and breaker.trips == 1
+
+
+def test_lost_probe_is_replaced_after_cooldown():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.1)
+    breaker.record_failure(ServerError())
+    breaker.wait()  # проба, которая так и не отчитается
+    passed, threads = start_waiters(breaker, 2)
+    time.sleep(0.15)
+    assert len(passed) == 1
+    breaker.record_success()
+    for thread in threads:
+        thread.join(1)
+    assert len(passed) == 2
+
+
+def test_disabled_breaker_never_blocks():
+    breaker = CircuitBreaker(threshold=0)
+    for _ in range(10):
+        breaker.record_failure(ServerError())
+    breaker.wait()
+    assert breaker.trips == 0
+
+
+def test_provider_answer_breaks_the_failure_streak():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    for _ in range(3):
+        breaker.record_failure(ServerError())
+        breaker.record_failure(RateLimitedError())
+    assert breaker.state == "closed" and breaker.trips == 0
+    breaker.record_failure(ServerError())
+    breaker.record_failure(ServerError())
+    assert breaker.state == "open" and breaker.trips == 1
+    # Поздний 429 на запрос, отправленный до паузы, открытый breaker не закрывает
+    breaker.record_failure(RateLimitedError())
+    assert breaker.state == "open"
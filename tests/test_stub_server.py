@@ -0,0 +1,125 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("dotenv")
+
+import dataset_pipeline as dp
+
+OUTPUT = {"hard_skills": ["SQL"], "soft_skills": ["коммуникабельность"], "recommendations": ["Изучить BPMN."]}
+
+
+class StubServer:
+    """
+    Локальный OpenAI-совместимый /v1/chat/completions: отвечает OUTPUT,
+    а каждый fail_every-й запрос получает 503.
+    """
+
+    def __init__(self, fail_every: int = 0):
+        self.fail_every = fail_every
+        self.requests = 0
+        self.failures = 0
+        self.models = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _handler(stub):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub._lock:
+                    stub.requests += 1
+                    stub.models.append(body["model"])
+                    fail = stub.fail_every and stub.requests % stub.fail_every == 0
+                    stub.failures += bool(fail)
+                if fail:
+                    self._send(503, {"error": {"message": "overloaded"}})
+                    return
+                self._send(200, {
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant",
+                                             "content": json.dumps({"output": OUTPUT}, ensure_ascii=False)}}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                })
+
+            def _send(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Рабочая папка в раскладке репозитория: prepared_data с одним диалогом на два чанка.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dp, "WAIT_SECONDS", 0.01)
+    (tmp_path / ".env").write_text("OPENROUTER_API_KEY=test\nOPENROUTER_API_BASE=http://127.0.0.1:9/v1\n"
+                                   "MODEL_NAME=stub-model\n", encoding="utf-8")
+    dialogue = [{"start_time": f"00:00:{i:02d},000", "end_time": f"00:00:{i + 1:02d},000",
+                 "speaker": "interviewer" if i % 2 == 0 else "candidate", "text": f"Реплика {i}"}
+                for i in range(8)]
+    prepared = tmp_path / "prepared_data"
+    prepared.mkdir()
+    (prepared / "dialoge_pair_final.json").write_text(json.dumps({"dialogue": dialogue}, ensure_ascii=False),
+                                                      encoding="utf-8")
+    return tmp_path
+
+
+def run_pipeline(monkeypatch, stub, *args):
+    monkeypatch.setattr("sys.argv", ["dataset_pipeline.py", "--api-base", stub.url, "--rpm", "0", "--tpm", "0",
+                                     "--concurrency", "1", "--no-cache", "--report", "report.json", *args])
+    dp.main()
+    return json.loads(open("report.json", encoding="utf-8").read())["counters"]
+
+
+def read_samples(workdir):
+    path = workdir / "finetuning_samples" / "dialoge_pair_final_samples.jsonl"
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_annotation_through_stub_server(workdir, monkeypatch):
+    stub = StubServer()
+    try:
+        counters = run_pipeline(monkeypatch, stub)
+    finally:
+        stub.close()
+    samples = read_samples(workdir)
+    assert [sample["chunk_id"] for sample in samples] == [0, 1]
+    assert all(sample["output"] == OUTPUT and sample["source_file"] == "dialoge_pair_final.json"
+               for sample in samples)
+    assert stub.requests == 2 and set(stub.models) == {"stub-model"}
+    assert counters["requests"] == 2 and counters.get("retries", 0) == 0
+
+
+def test_server_errors_are_retried_by_the_pipeline(workdir, monkeypatch):
+    # Каждый второй запрос — 503: второй чанк проходит со второй попытки.
+    # Повторы делает конвейер, а не SDK (max_retries=0), поэтому они видны в отчёте.
+    stub = StubServer(fail_every=2)
+    try:
+        counters = run_pipeline(monkeypatch, stub)
+    finally:
+        stub.close()
+    assert [sample["output"] for sample in read_samples(workdir)] == [OUTPUT, OUTPUT]
+    assert (stub.requests, stub.failures) == (3, 1)
+    assert counters["retries"] == 1 and counters["errors_server_error"] == 1
+    assert counters.get("failed_requests", 0) == 0
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("dotenv")
+pytest.importorskip("docx")
+
+import dataset_pipeline
+import watch_pipeline
+
+
+class RecordingProcessFile:
+    """
+    Подменяет dataset_pipeline.process_file: запоминает вызовы и самую большую
+    одновременную разметку одного файла; первый вызов ждёт release.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.running = {}
+        self.max_parallel = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, json_file, *args):
+        with self._lock:
+            self.calls.append(json_file)
+            self.running[json_file] = self.running.get(json_file, 0) + 1
+            self.max_parallel = max(self.max_parallel, self.running[json_file])
+        self.started.set()
+        self.release.wait(5)
+        time.sleep(0.01)
+        with self._lock:
+            self.running[json_file] -= 1
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    fake = RecordingProcessFile()
+    monkeypatch.setattr(dataset_pipeline, "process_file", fake)
+    args, annotate_args = watch_pipeline.parse_args([
+        "--annotate-workers", "3", "--prepared-data-dir", str(tmp_path / "prepared"),
+        "--output-dir", str(tmp_path / "out"), "--no-cache", "--report", str(tmp_path / "report.json"),
+    ])
+    pipe = watch_pipeline.WatchPipeline(args, annotate_args, client=object(), model_name="stub")
+    workers = [threading.Thread(target=pipe.annotate_worker, daemon=True) for _ in range(3)]
+    for thread in workers:
+        thread.start()
+    yield pipe, fake
+    fake.release.set()
+    pipe.annotate_queue.put(watch_pipeline._STOP)
+    for thread in workers:
+        thread.join(5)
+
+
+def test_same_file_is_never_annotated_in_parallel(pipeline, tmp_path):
+    pipe, fake = pipeline
+    json_file = tmp_path / "dialoge_pair_final.json"
+    pipe.enqueue_annotation(json_file)
+    assert fake.started.wait(5)
+    # Пересборки во время разметки: не параллельный запуск, а один повторный проход
+    for _ in range(3):
+        pipe.enqueue_annotation(json_file)
+    fake.release.set()
+    deadline = time.monotonic() + 5
+    while (pipe.annotating or pipe.annotate_queued) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake.calls == [json_file, json_file]
+    assert fake.max_parallel == 1
+
+
+def test_stop_skips_queued_files(pipeline, tmp_path):
+    pipe, fake = pipeline
+    files = [tmp_path / f"dialoge_{i}_final.json" for i in range(3)]
+    pipe.enqueue_annotation(files[0])
+    assert fake.started.wait(5)
+    pipe.stop.set()
+    pipe.enqueue_annotation(files[0])
+    for json_file in files[1:]:
+        pipe.enqueue_annotation(json_file)
+    fake.release.set()
+    deadline = time.monotonic() + 5
+    while (pipe.annotating or pipe.annotate_queued) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake.calls == [files[0]]
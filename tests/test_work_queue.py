@@ -0,0 +1,146 @@
+import json
+import types
+
+import pytest
+
+import work_queue as work_queue_module
+from progress_manifest import COMPLETED
+from run_metrics import RunMetrics
+from work_queue import WorkQueue, ShardWriter, merge_shards, PENDING, SHARD_DIR
+
+
+def record(chunk_id):
+    return {"input": f"chunk {chunk_id}", "chunk_id": chunk_id, "source_file": "a.json"}
+
+
+def annotate(work_queue, shard, worker):
+    for source_file, chunk_id, _, input_hash in work_queue.claim(worker, limit=100):
+        shard.append(source_file, input_hash, chunk_id, record(chunk_id))
+        work_queue.finish(source_file, chunk_id, COMPLETED)
+
+
+def merged_inputs(path):
+    return [json.loads(line)["input"] for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_claim_lease_and_merge_in_chunk_order(tmp_path):
+    work_queue = WorkQueue(tmp_path / "q.sqlite")
+    assert work_queue.add_file("a.json", "a.json", "h1", 4, skipped=[2]) == "added"
+    assert work_queue.add_file("a.json", "a.json", "h1", 4) == "existing"
+
+    first = work_queue.claim("w1", limit=2, lease=60)
+    second = work_queue.claim("w2", limit=10, lease=60)
+    assert [row[1] for row in first] == [0, 1]
+    assert [row[1] for row in second] == [3]
+    # Аренда истекла — задачи w1 достаются другому воркеру
+    work_queue.heartbeat("w1", lease=-1)
+    assert [row[1] for row in work_queue.claim("w3", limit=10)] == [0, 1]
+
+    shard = ShardWriter(tmp_path / "shards", "w3")
+    for chunk_id in (3, 1, 0):
+        shard.append("a.json", "h1", chunk_id, record(chunk_id))
+        work_queue.finish("a.json", chunk_id, COMPLETED)
+    shard.close()
+
+    assert work_queue.claim_merge("w") == ["a.json"]
+    assert work_queue.claim_merge("w") == []
+    merge_shards(work_queue, tmp_path / "shards", tmp_path)
+    assert merged_inputs(tmp_path / "a_samples.jsonl") == ["chunk 0", "chunk 1", "chunk 3"]
+
+
+def test_restarted_worker_does_not_glue_onto_torn_shard(tmp_path):
+    work_queue = WorkQueue(tmp_path / "q.sqlite")
+    work_queue.add_file("a.json", "a.json", "h1", 3)
+    shard = ShardWriter(tmp_path / "shards", "w1")
+    shard.append("a.json", "h1", 0, record(0))
+    work_queue.finish("a.json", 0, COMPLETED)
+    shard.close()
+    # Воркер упал посреди записи чанка 1 (до finish) и перезапущен с тем же --worker-id
+    with shard.path.open("a", encoding="utf-8") as f:
+        f.write('{"source_file": "a.json", "input_ha')
+
+    shard = ShardWriter(tmp_path / "shards", "w1")
+    annotate(work_queue, shard, "w1")
+    shard.close()
+
+    assert work_queue.claim_merge("w") == ["a.json"]
+    merge_shards(work_queue, tmp_path / "shards", tmp_path)
+    assert merged_inputs(tmp_path / "a_samples.jsonl") == ["chunk 0", "chunk 1", "chunk 2"]
+
+
+def test_completed_chunk_without_record_is_requeued(tmp_path):
+    work_queue = WorkQueue(tmp_path / "q.sqlite")
+    work_queue.add_file("a.json", "a.json", "h1", 3)
+    shard = ShardWriter(tmp_path / "shards", "w1")
+    annotate(work_queue, shard, "w1")
+    shard.close()
+    # Запись чанка 1 повреждена, хотя в очереди он completed
+    lines = shard.path.read_text(encoding="utf-8").splitlines(keepends=True)
+    lines[1] = lines[1][:20] + "\n"
+    shard.path.write_text("".join(lines), encoding="utf-8")
+
+    assert work_queue.claim_merge("w") == ["a.json"]
+    assert merge_shards(work_queue, tmp_path / "shards", tmp_path) == {}
+    assert not (tmp_path / "a_samples.jsonl").exists()
+    assert work_queue.counts()[PENDING] == 1
+
+    shard = ShardWriter(tmp_path / "shards", "w1")
+    annotate(work_queue, shard, "w1")
+    shard.close()
+    assert work_queue.claim_merge("w") == ["a.json"]
+    merge_shards(work_queue, tmp_path / "shards", tmp_path)
+    assert merged_inputs(tmp_path / "a_samples.jsonl") == ["chunk 0", "chunk 1", "chunk 2"]
+
+
+
+def annotated_queue(tmp_path, shard_dir):
+    work_queue = WorkQueue(tmp_path / "q.sqlite")
+    work_queue.add_file("a.json", "a.json", "h1", 2)
+    shard = ShardWriter(shard_dir, "w1")
+    annotate(work_queue, shard, "w1")
+    shard.close()
+    return work_queue
+
+
+def crash_during_merge(work_queue, shard_dir, output_dir, monkeypatch, lease):
+    """
+    Воркер арендовал сборку и упал до записи *_samples.jsonl (без release).
+    """
+    def broken_write(path, text):
+        raise OSError("диск отвалился")
+
+    assert work_queue.claim_merge("w1", lease=lease) == ["a.json"]
+    with monkeypatch.context() as patch:
+        patch.setattr(work_queue_module, "atomic_write_text", broken_write)
+        with pytest.raises(OSError):
+            merge_shards(work_queue, shard_dir, output_dir, ["a.json"])
+    assert work_queue.unmerged() == 1
+
+
+def test_merge_lost_with_its_worker_is_taken_over_after_the_lease(tmp_path, monkeypatch):
+    work_queue = annotated_queue(tmp_path, tmp_path / "shards")
+    crash_during_merge(work_queue, tmp_path / "shards", tmp_path, monkeypatch, lease=60)
+    # Аренда сборки ещё действует — другой воркер не вмешивается
+    assert work_queue.claim_merge("w2") == []
+    work_queue.heartbeat("w1", lease=-1)
+    assert work_queue.claim_merge("w2") == ["a.json"]
+    merge_shards(work_queue, tmp_path / "shards", tmp_path, ["a.json"])
+    assert merged_inputs(tmp_path / "a_samples.jsonl") == ["chunk 0", "chunk 1"]
+    assert work_queue.unmerged() == 0
+
+
+def test_next_worker_merges_files_after_a_crashed_merge(tmp_path, monkeypatch):
+    pytest.importorskip("openai")
+    pytest.importorskip("dotenv")
+    import dataset_pipeline
+
+    shard_dir = tmp_path / SHARD_DIR
+    work_queue = annotated_queue(tmp_path, shard_dir)
+    crash_during_merge(work_queue, shard_dir, tmp_path, monkeypatch, lease=0.2)
+
+    # Все задачи completed: новый воркер сразу переходит к сборке и ждёт истечения чужой аренды
+    args = types.SimpleNamespace(concurrency=1, batch_size=1, lease=0.2)
+    dataset_pipeline.run_queue_worker(work_queue, "w2", tmp_path, None, "m", args, None, None, None,
+                                      RunMetrics("test"))
+    assert merged_inputs(tmp_path / "a_samples.jsonl") == ["chunk 0", "chunk 1"]
+    assert work_queue.unmerged() == 0
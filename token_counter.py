@@ -0,0 +1,54 @@
+"""
+Локальные счётчики токенов для чанкинга и оценки запросов.
+
+Спецификация счётчика — строка:
+  - "chars" (по умолчанию) — грубая оценка по длине текста, без зависимостей;
+  - "tiktoken:<encoding>" — tiktoken, например "tiktoken:cl100k_base";
+  - "hf:<имя или путь>" — токенайзер transformers, например "hf:unsloth/Llama-3.2-3B-Instruct".
+tiktoken и transformers — необязательные зависимости и импортируются только при выборе.
+"""
+from functools import lru_cache
+
+CHARS_PER_TOKEN = 3  # грубая оценка для русского текста
+
+
+def count_tokens_approx(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def make_token_counter(spec: str = "chars"):
+    """
+    Возвращает функцию text -> число токенов по спецификации (см. описание модуля).
+    Результаты кэшируются: реплики и фиксированные промпты считаются много раз.
+    """
+    spec = spec or "chars"
+    kind, _, name = spec.partition(":")
+    if kind == "chars":
+        return count_tokens_approx
+    if kind == "tiktoken":
+        try:
+            import tiktoken
+        except ImportError as e:
+            raise RuntimeError("Для счётчика tiktoken установите пакет tiktoken.") from e
+        encoding = tiktoken.get_encoding(name or "cl100k_base")
+        return lru_cache(maxsize=65536)(lambda text: len(encoding.encode(text, disallowed_special=())))
+    if kind == "hf":
+        try:
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise RuntimeError("Для счётчика hf установите пакет transformers.") from e
+        if not name:
+            raise ValueError("Укажите токенайзер: hf:<имя или путь>")
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        return lru_cache(maxsize=65536)(lambda text: len(tokenizer.encode(text, add_special_tokens=False)))
+    raise ValueError(f"Неизвестный счётчик токенов: {spec}")
+
+
+TOKENS_PER_MESSAGE = 4  # служебные токены chat-шаблона на одно сообщение (роль, разделители)
+
+
+def count_message_tokens(messages: list, count_tokens=count_tokens_approx) -> int:
+    """
+    Токены списка сообщений chat API: содержимое плюс служебные токены шаблона.
+    """
+    return sum(count_tokens(m["content"]) + TOKENS_PER_MESSAGE for m in messages)
@@ -0,0 +1,362 @@
+import os
+import time
+import queue
+import logging
+import argparse
+import threading
+from pathlib import Path
+
+import dataset_pipeline
+from data_preparation import (
+    DIARIZATION_DIR, TRANSCRIPTION_DIR, DIARIZATION_GLOB, TRANSCRIPTION_GLOB, TOLERANCE_RATIO,
+    pair_base, build_pairs, output_paths,
+)
+from get_data_from_transcribation import RESULTS_DIR, move_final_files
+from retry_policy import CircuitBreaker
+from run_metrics import RunMetrics, default_report_path
+from token_counter import make_token_counter
+
+PREPARED_DATA_DIR = Path("prepared_data")
+OUTPUT_DIR = Path("finetuning_samples")
+POLL_INTERVAL = 2.0       # секунды между опросами папок в режиме poll
+QUEUE_SIZE = 4            # сколько пар/файлов может ждать следующей стадии
+ANNOTATE_WORKERS = 1
+_STOP = object()          # сигнал завершения для очередей
+
+
+def load_inotify():
+    try:
+        import inotify_simple
+    except ImportError as e:
+        raise RuntimeError("Для --watcher inotify установите пакет inotify_simple (только Linux).") from e
+    return inotify_simple
+
+
+class PollWatcher:
+    """
+    Опрос папок раз в interval секунд: сравниваются только (size, mtime) записей каталога,
+    содержимое файлов не читается. Файл считается пришедшим, когда его stat не изменился
+    между двумя опросами подряд (запись завершена).
+    """
+
+    def __init__(self, dirs: list, interval: float = POLL_INTERVAL):
+        self.dirs = dirs
+        self.interval = interval
+        self.seen = {}      # путь -> stat, уже отданный как событие
+        self.pending = {}   # путь -> stat с прошлого опроса (файл ещё может дописываться)
+
+    def _scan(self) -> dict:
+        current = {}
+        for directory in self.dirs:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            current[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                continue
+        return current
+
+    def changes(self, timeout: float) -> list:
+        time.sleep(timeout)
+        current = self._scan()
+        changed = []
+        for path, stat in current.items():
+            if self.seen.get(path) == stat:
+                continue
+            if self.pending.get(path) == stat:
+                self.seen[path] = stat
+                changed.append(path)
+        self.pending = {path: stat for path, stat in current.items() if self.seen.get(path) != stat}
+        return changed
+
+
+class InotifyWatcher:
+    """
+    inotify (Linux): ядро сообщает о закрытых после записи и переименованных в папку файлах —
+    get_data_from_transcribation кладёт файлы через rename, так что событие приходит
+    для уже целого файла.
+    """
+
+    def __init__(self, dirs: list):
+        self.inotify_simple = load_inotify()
+        flags = self.inotify_simple.flags
+        self.inotify = self.inotify_simple.INotify()
+        self.dirs = {}
+        for directory in dirs:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            wd = self.inotify.add_watch(str(directory), flags.CLOSE_WRITE | flags.MOVED_TO)
+            self.dirs[wd] = Path(directory)
+
+    def changes(self, timeout: float) -> list:
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        return list(dict.fromkeys(self.dirs[event.wd] / event.name for event in events if event.wd in self.dirs))
+
+
+def make_watcher(kind: str, dirs: list, interval: float):
+    if kind == "poll":
+        return PollWatcher(dirs, interval)
+    if kind == "inotify":
+        return InotifyWatcher(dirs)
+    try:
+        return InotifyWatcher(dirs)
+    except (RuntimeError, OSError) as e:
+        logging.info(f"inotify недоступен ({e}), опрашиваем папки раз в {interval} с.")
+        return PollWatcher(dirs, interval)
+
+
+def initial_files(dirs: list) -> list:
+    """
+    Файлы, уже лежащие в папках на момент старта (один листинг каталога, без чтения файлов).
+    """
+    files = []
+    for directory, pattern in zip(dirs, (DIARIZATION_GLOB, TRANSCRIPTION_GLOB)):
+        files.extend(Path(directory).glob(pattern))
+    return files
+
+
+class PairTracker:
+    """
+    Собирает половинки пар по базовому имени: пара готова, когда есть оба файла.
+    """
+
+    def __init__(self):
+        self.diarization = {}
+        self.transcription = {}
+
+    def add(self, path: Path) -> str:
+        """
+        Учитывает пришедший файл. Возвращает базовое имя, если пара теперь полная.
+        """
+        base = pair_base(path)
+        if base is None:
+            return None
+        halves = self.diarization if path.name.endswith(".txt") else self.transcription
+        halves[base] = path
+        if base in self.diarization and base in self.transcription:
+            return base
+        return None
+
+    def pair(self, base: str) -> tuple:
+        return self.diarization[base], self.transcription[base]
+
+
+class WatchPipeline:
+    """
+    Долгоживущий конвейер raw_data -> prepared_data -> finetuning_samples.
+
+    - наблюдатель (основной поток) собирает пары и кладёт базовые имена в очередь подготовки;
+    - поток подготовки вызывает build_pairs для одной пары (process_pair, пропуск по манифесту)
+      и кладёт получившийся *_final.json в очередь разметки;
+    - annotate_workers потоков размечают файлы через dataset_pipeline.process_file с --resume,
+      поэтому уже размеченные чанки повторно не запрашиваются.
+
+    Обе очереди ограничены queue_size: если разметка отстаёт, put() блокирует подготовку,
+    а та — наблюдателя (backpressure), и в памяти не копятся необработанные пары.
+    Пара, уже стоящая в очереди, повторно не ставится: поток подготовки всё равно прочитает
+    актуальные версии файлов. Так же и с разметкой: один *_final.json никогда не размечается
+    двумя потоками сразу. Если файл пересобран, пока его размечают, тот же поток после
+    завершения размечает его ещё раз.
+
+    При остановке (Ctrl-C) новые элементы из очередей не берутся: дорабатываются только
+    файлы, которые уже в работе.
+    """
+
+    def __init__(self, pipeline_args, annotate_args, client=None, model_name: str = None):
+        self.args = pipeline_args
+        self.annotate_args = annotate_args
+        self.prepared_data_dir = Path(pipeline_args.prepared_data_dir)
+        self.output_dir = Path(pipeline_args.output_dir)
+        self.prepare_queue = queue.Queue(maxsize=max(1, pipeline_args.queue_size))
+        self.annotate_queue = queue.Queue(maxsize=max(1, pipeline_args.queue_size))
+        self.tracker = PairTracker()
+        self.queued = set()
+        self.annotate_queued = set()   # *_final.json в очереди разметки
+        self.annotating = set()        # *_final.json, которые сейчас размечаются
+        self.reannotate = set()        # пересобраны во время разметки, нужен ещё один проход
+        self._lock = threading.Lock()
+        self.stop = threading.Event()
+
+        self.prepare_metrics = RunMetrics("data_preparation")
+        self.metrics = RunMetrics("watch_pipeline")
+        self.client, self.model_name = client, model_name
+        self.pool = None
+        if self.client is None:
+            self.pool = dataset_pipeline.make_pool(annotate_args)
+            if self.pool:
+                self.model_name = self.pool.name
+            else:
+                self.client, self.model_name = dataset_pipeline.make_client(annotate_args)
+        self.count_tokens = make_token_counter(annotate_args.token_counter)
+        self.limiter = dataset_pipeline.RateLimiter(annotate_args.rpm, annotate_args.tpm)
+        self.report = dataset_pipeline.BatchReport()
+        self.breaker = CircuitBreaker(annotate_args.breaker_threshold, annotate_args.breaker_cooldown)
+        self.cache = dataset_pipeline.make_cache(annotate_args)
+
+    def submit(self, path: Path):
+        base = self.tracker.add(path)
+        if base is None:
+            return
+        with self._lock:
+            if base in self.queued:
+                return
+            self.queued.add(base)
+        logging.info(f"[{base}] Пара готова, ставим в очередь подготовки.")
+        self.prepare_queue.put(base)
+
+    def prepare_worker(self):
+        while True:
+            base = self.prepare_queue.get()
+            if base is _STOP:
+                break
+            with self._lock:
+                self.queued.discard(base)
+            if self.stop.is_set():
+                continue
+            try:
+                build_pairs({base: self.tracker.pair(base)}, self.prepared_data_dir, jobs=1,
+                            tolerance_ratio=self.args.tolerance_ratio, metrics=self.prepare_metrics)
+            except Exception as e:
+                logging.error(f"[{base}] Ошибка подготовки: {e}")
+                continue
+            final_json = output_paths(base, self.prepared_data_dir)[1]
+            if final_json.is_file():
+                self.enqueue_annotation(final_json)
+
+    def enqueue_annotation(self, json_file: Path):
+        with self._lock:
+            if json_file in self.annotate_queued:
+                return  # ещё не взят из очереди — прочитается актуальная версия
+            if json_file in self.annotating:
+                self.reannotate.add(json_file)
+                return
+            self.annotate_queued.add(json_file)
+        self.annotate_queue.put(json_file)
+
+    def annotate_worker(self):
+        while True:
+            json_file = self.annotate_queue.get()
+            if json_file is _STOP:
+                self.annotate_queue.put(_STOP)  # сигнал для остальных потоков разметки
+                break
+            with self._lock:
+                self.annotate_queued.discard(json_file)
+                if self.stop.is_set():
+                    continue
+                self.annotating.add(json_file)
+            while True:
+                self.annotate(json_file)
+                with self._lock:
+                    if json_file not in self.reannotate or self.stop.is_set():
+                        self.reannotate.discard(json_file)
+                        self.annotating.discard(json_file)
+                        break
+                    self.reannotate.discard(json_file)
+
+    def annotate(self, json_file: Path):
+        try:
+            dataset_pipeline.process_file(json_file, self.output_dir, self.client, self.model_name,
+                                          self.annotate_args, self.limiter, self.cache, self.report,
+                                          self.metrics, self.breaker, self.count_tokens, self.pool)
+            self.metrics.inc("files_annotated")
+        except Exception as e:
+            logging.error(f"Ошибка разметки {json_file}: {e}")
+            self.metrics.inc("files_failed")
+
+    def sync(self):
+        results_dir = Path(self.args.results_dir).expanduser()
+        move_final_files(results_dir / "postprocessed", TRANSCRIPTION_DIR, ".docx")
+        move_final_files(results_dir / "diarization", DIARIZATION_DIR, ".txt")
+
+    def run(self, once: bool = False):
+        """
+        Запускает конвейер. При once=True обрабатывает уже лежащие файлы и завершается,
+        когда обе очереди опустели.
+        """
+        self.prepared_data_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        dirs = [DIARIZATION_DIR, TRANSCRIPTION_DIR]
+        preparer = threading.Thread(target=self.prepare_worker, name="prepare", daemon=True)
+        annotators = [threading.Thread(target=self.annotate_worker, name=f"annotate-{i}", daemon=True)
+                      for i in range(max(1, self.args.annotate_workers))]
+        preparer.start()
+        for thread in annotators:
+            thread.start()
+
+        try:
+            if self.args.sync_interval:
+                self.sync()
+            watcher = None if once else make_watcher(self.args.watcher, dirs, self.args.poll_interval)
+            for path in initial_files(dirs):
+                self.submit(path)
+            if watcher and isinstance(watcher, PollWatcher):
+                # Уже поставленные файлы не должны прийти повторно как новые
+                watcher.seen = watcher._scan()
+            last_sync = time.monotonic()
+            while watcher and not self.stop.is_set():
+                for path in watcher.changes(self.args.poll_interval):
+                    self.submit(path)
+                if self.args.sync_interval and time.monotonic() - last_sync >= self.args.sync_interval:
+                    self.sync()
+                    last_sync = time.monotonic()
+        except KeyboardInterrupt:
+            logging.info("Остановка: новые файлы не берём, дожидаемся тех, что уже в работе.")
+            self.stop.set()
+        finally:
+            self.prepare_queue.put(_STOP)
+            preparer.join()
+            self.annotate_queue.put(_STOP)
+            for thread in annotators:
+                thread.join()
+            self.finish()
+
+    def finish(self):
+        self.metrics.merge(self.prepare_metrics.snapshot())
+        dataset_pipeline.write_run_report(self.metrics, self.annotate_args, self.model_name, self.cache, self.breaker,
+                                          self.pool)
+        if self.pool:
+            self.pool.close()
+        if self.cache:
+            self.cache.evict()
+            self.cache.close()
+
+
+def parse_args(argv=None):
+    """
+    Свои параметры демона; всё остальное передаётся dataset_pipeline
+    (например --model, --rpm, --chunk-tokens, --stream).
+    """
+    parser = argparse.ArgumentParser(
+        description="Демон: новые пары raw_data -> prepared_data -> finetuning_samples.",
+        epilog="Прочие параметры (--model, --rpm, --stream, ...) передаются dataset_pipeline.",
+    )
+    parser.add_argument("--watcher", choices=["auto", "inotify", "poll"], default="auto",
+                        help="способ наблюдения за папками (auto — inotify, если доступен)")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="период опроса папок (и таймаут ожидания событий inotify), с")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="ёмкость очередей между стадиями")
+    parser.add_argument("--annotate-workers", type=int, default=ANNOTATE_WORKERS,
+                        help="сколько файлов размечать одновременно")
+    parser.add_argument("--tolerance-ratio", type=float, default=TOLERANCE_RATIO,
+                        help="минимальная доля перекрытия сегментов при сопоставлении")
+    parser.add_argument("--prepared-data-dir", default=str(PREPARED_DATA_DIR))
+    parser.add_argument("--output-dir", default=str(OUTPUT_DIR))
+    parser.add_argument("--sync-interval", type=float, default=0,
+                        help="раз в сколько секунд забирать новые файлы из --results-dir (0 — не забирать)")
+    parser.add_argument("--results-dir", default=str(RESULTS_DIR), help="см. get_data_from_transcribation")
+    parser.add_argument("--once", action="store_true", help="обработать уже лежащие файлы и выйти")
+    args, rest = parser.parse_known_args(argv)
+    annotate_args = dataset_pipeline.parse_args(rest + ["--resume"])
+    if not annotate_args.report:
+        annotate_args.report = str(default_report_path("watch_pipeline"))
+    return args, annotate_args
+
+
+def main():
+    args, annotate_args = parse_args()
+    WatchPipeline(args, annotate_args).run(once=args.once)
+
+
+if __name__ == "__main__":
+    main()
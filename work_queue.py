@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from progress_manifest import atomic_write_text, truncate_torn_tail, COMPLETED, FAILED, SKIPPED
+
+PENDING = "pending"
+LEASED = "leased"
+LEASE_SECONDS = 120.0   # аренда задачи без heartbeat; воркер продлевает её каждые LEASE_SECONDS / 3
+MAX_ATTEMPTS = 3        # после стольких неудач (у любых воркеров) чанк остаётся failed
+SHARD_DIR = ".shards"   # папка шардов воркеров внутри finetuning_samples
+POLL_INTERVAL = 1.0     # как часто воркер без задач проверяет, не освободились ли задачи других
+
+
+class WorkQueue:
+    """
+    Общая очередь задач разметки (source_file, chunk_id) в SQLite.
+
+    Несколько процессов (и машин, если файл лежит на общем диске) берут задачи через claim():
+    задача арендуется воркером до lease_until, воркер продлевает аренду heartbeat'ом,
+    а задачи упавшего воркера после истечения аренды снова выдаются другим.
+    Результаты в базу не пишутся — они в шардах воркеров (см. ShardWriter), база хранит только статусы.
+
+    Все изменения идут в транзакциях BEGIN IMMEDIATE, поэтому одну задачу не получат два воркера.
+    Журнал SQLite оставлен в режиме DELETE: WAL требует общей памяти и не работает на сетевых ФС.
+    Для нескольких машин файловая система должна поддерживать блокировки POSIX.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " source_file TEXT PRIMARY KEY,"
+                " path TEXT NOT NULL,"
+                " input_hash TEXT NOT NULL,"
+                " total_chunks INTEGER NOT NULL,"
+                " merged INTEGER NOT NULL DEFAULT 0,"
+                " merge_worker TEXT,"
+                " merge_until REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+            if "merge_worker" not in columns:
+                # Очереди, созданные до аренды сборки
+                conn.execute("ALTER TABLE files ADD COLUMN merge_worker TEXT")
+                conn.execute("ALTER TABLE files ADD COLUMN merge_until REAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " source_file TEXT NOT NULL,"
+                " chunk_id INTEGER NOT NULL,"
+                " status TEXT NOT NULL,"
+                " worker TEXT,"
+                " lease_until REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (source_file, chunk_id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, lease_until)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_worker ON tasks(worker)")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def add_file(self, source_file: str, path: str, input_hash: str, total_chunks: int,
+                 skipped: list = (), retry_failed: bool = False) -> str:
+        """
+        Ставит чанки файла в очередь. Повторная постановка того же входа ничего не меняет
+        (все воркеры могут запускаться одной командой), retry_failed возвращает failed-чанки в очередь.
+        Если вход изменился (другой input_hash), задачи файла создаются заново.
+        Возвращает "added", "reset" или "existing".
+        """
+        skipped = set(skipped)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT input_hash FROM files WHERE source_file = ?", (source_file,)).fetchone()
+            if row and row[0] == input_hash:
+                if retry_failed:
+                    cur = conn.execute(
+                        "UPDATE tasks SET status = ?, attempts = 0 WHERE source_file = ? AND status = ?",
+                        (PENDING, source_file, FAILED),
+                    )
+                    if cur.rowcount:
+                        conn.execute("UPDATE files SET merged = 0 WHERE source_file = ?", (source_file,))
+                return "existing"
+            conn.execute("DELETE FROM tasks WHERE source_file = ?", (source_file,))
+            conn.execute(
+                "INSERT OR REPLACE INTO files (source_file, path, input_hash, total_chunks, merged)"
+                " VALUES (?, ?, ?, ?, 0)",
+                (source_file, path, input_hash, total_chunks),
+            )
+            conn.executemany(
+                "INSERT INTO tasks (source_file, chunk_id, status) VALUES (?, ?, ?)",
+                [(source_file, chunk_id, SKIPPED if chunk_id in skipped else PENDING)
+                 for chunk_id in range(total_chunks)],
+            )
+        return "reset" if row else "added"
+
+    def claim(self, worker: str, limit: int, lease: float = LEASE_SECONDS) -> list:
+        """
+        Арендует до limit задач: сначала ожидающие и с истёкшей арендой, в порядке файлов и чанков.
+        Возвращает [(source_file, chunk_id, path, input_hash)].
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT t.source_file, t.chunk_id, f.path, f.input_hash FROM tasks t"
+                " JOIN files f ON f.source_file = t.source_file"
+                " WHERE t.status = ? OR (t.status = ? AND t.lease_until < ?)"
+                " ORDER BY t.source_file, t.chunk_id LIMIT ?",
+                (PENDING, LEASED, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = ?, worker = ?, lease_until = ? WHERE source_file = ? AND chunk_id = ?",
+                [(LEASED, worker, now + lease, source_file, chunk_id) for source_file, chunk_id, _, _ in rows],
+            )
+        return rows
+
+    def heartbeat(self, worker: str, lease: float = LEASE_SECONDS) -> int:
+        """
+        Продлевает аренду всех задач воркера и собираемых им файлов. Возвращает число продлённых задач.
+        """
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE tasks SET lease_until = ? WHERE worker = ? AND status = ?",
+                (time.time() + lease, worker, LEASED),
+            )
+            conn.execute("UPDATE files SET merge_until = ? WHERE merge_worker = ? AND merged = 0",
+                         (time.time() + lease, worker))
+        return cur.rowcount
+
+    def finish(self, source_file: str, chunk_id: int, status: str,
+               max_attempts: int = MAX_ATTEMPTS) -> str:
+        """
+        Отмечает результат задачи. Неудачная задача возвращается в очередь, пока не исчерпаны
+        max_attempts. Готовый чанк не понижается до failed, даже если аренду успели передать
+        другому воркеру. Возвращает итоговый статус задачи.
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT status, attempts FROM tasks WHERE source_file = ? AND chunk_id = ?",
+                (source_file, chunk_id),
+            ).fetchone()
+            if row is None or row[0] in (COMPLETED, SKIPPED):
+                return row[0] if row else None
+            attempts = row[1] + (status == FAILED)
+            if status == FAILED and attempts < max_attempts:
+                status = PENDING
+            conn.execute(
+                "UPDATE tasks SET status = ?, attempts = ?, worker = NULL, lease_until = NULL"
+                " WHERE source_file = ? AND chunk_id = ?",
+                (status, attempts, source_file, chunk_id),
+            )
+        return status
+
+    def release(self, worker: str) -> int:
+        """
+        Возвращает в очередь невыполненные задачи воркера (штатное завершение или Ctrl-C)
+        и снимает его аренду недособранных файлов.
+        """
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE tasks SET status = ?, worker = NULL, lease_until = NULL WHERE worker = ? AND status = ?",
+                (PENDING, worker, LEASED),
+            )
+            conn.execute("UPDATE files SET merge_worker = NULL, merge_until = NULL WHERE merge_worker = ?",
+                         (worker,))
+        return cur.rowcount
+
+    def active(self) -> int:
+        """
+        Сколько задач ещё не завершено (ожидают или арендованы).
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)", (PENDING, LEASED)
+            ).fetchone()[0]
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        counts = {PENDING: 0, LEASED: 0, COMPLETED: 0, FAILED: 0, SKIPPED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def files(self) -> dict:
+        """
+        source_file -> {"path", "input_hash", "total_chunks"} всех файлов очереди.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT source_file, path, input_hash, total_chunks FROM files").fetchall()
+        return {row[0]: {"path": row[1], "input_hash": row[2], "total_chunks": row[3]} for row in rows}
+
+    def completed(self, names: list) -> dict:
+        """
+        source_file -> множество chunk_id со статусом completed.
+        """
+        done = {name: set() for name in names}
+        with self._lock:
+            for source_file, chunk_id in self._conn.execute(
+                "SELECT source_file, chunk_id FROM tasks WHERE status = ?", (COMPLETED,)
+            ):
+                if source_file in done:
+                    done[source_file].add(chunk_id)
+        return done
+
+    def requeue(self, lost: dict) -> int:
+        """
+        Возвращает в очередь completed-задачи, записи которых не нашлись в шардах
+        (lost: source_file -> chunk_id); такие файлы снова ждут сборки.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE tasks SET status = ?, attempts = 0, worker = NULL, lease_until = NULL"
+                " WHERE source_file = ? AND chunk_id = ? AND status = ?",
+                [(PENDING, name, chunk_id, COMPLETED) for name, chunk_ids in lost.items() for chunk_id in chunk_ids],
+            )
+            conn.executemany("UPDATE files SET merged = 0, merge_worker = NULL, merge_until = NULL"
+                             " WHERE source_file = ?", [(name,) for name in lost])
+        return sum(len(chunk_ids) for chunk_ids in lost.values())
+
+    def claim_merge(self, worker: str, lease: float = LEASE_SECONDS) -> list:
+        """
+        Если в очереди не осталось незавершённых задач, арендует сборку ещё не собранных файлов
+        и возвращает их: сборку делает один воркер — тот, кто закончил последним.
+        Собранным файл отмечает merge_shards (mark_merged) только после записи *_samples.jsonl,
+        поэтому сборку упавшего воркера после истечения аренды подхватит другой.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            active = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)", (PENDING, LEASED)
+            ).fetchone()[0]
+            if active:
+                return []
+            names = [row[0] for row in conn.execute(
+                "SELECT source_file FROM files WHERE merged = 0 AND (merge_until IS NULL OR merge_until < ?)", (now,)
+            )]
+            conn.executemany("UPDATE files SET merge_worker = ?, merge_until = ? WHERE source_file = ?",
+                             [(worker, now + lease, name) for name in names])
+        return names
+
+    def mark_merged(self, source_file: str):
+        with self._transaction() as conn:
+            conn.execute("UPDATE files SET merged = 1, merge_worker = NULL, merge_until = NULL WHERE source_file = ?",
+                         (source_file,))
+
+    def unmerged(self) -> int:
+        """
+        Сколько файлов ещё ждут сборки (в том числе арендованных другим воркером).
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files WHERE merged = 0").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LeaseKeeper:
+    """
+    Фоновый поток, продлевающий аренду задач воркера каждые lease / 3 секунд,
+    пока воркер жив: долгий запрос (повторы, backoff) не теряет задачу, а упавший
+    воркер перестаёт продлевать аренду, и его задачи через lease секунд уходят другим.
+    """
+
+    def __init__(self, work_queue: WorkQueue, worker: str, lease: float = LEASE_SECONDS):
+        self.work_queue = work_queue
+        self.worker = worker
+        self.lease = lease
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{worker}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease / 3):
+            try:
+                self.work_queue.heartbeat(self.worker, self.lease)
+            except sqlite3.Error as e:
+                print(f"Не удалось продлить аренду задач ({e}), повторим через {self.lease / 3:.0f} с.")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class ShardWriter:
+    """
+    Шард результатов одного воркера: <папка>/<worker>.jsonl, append-only,
+    каждая строка {"source_file", "input_hash", "chunk_id", "record"} сразу fsync'ится.
+    Запись в шард делается до finish() в очереди: если воркер упадёт между ними, чанк
+    разметят повторно, а дубль отбросит merge_shards. Оборванная при падении последняя строка
+    отрезается при открытии, иначе воркер с тем же именем дописал бы запись прямо к ней.
+    """
+
+    def __init__(self, shard_dir: Path, worker: str):
+        self.path = Path(shard_dir) / f"{worker}.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if truncate_torn_tail(self.path):
+            print(f"Отброшена оборванная последняя строка шарда {self.path}.")
+        self._file = self.path.open("a", encoding="utf-8")
+
+    def append(self, source_file: str, input_hash: str, chunk_id: int, record: dict):
+        entry = {"source_file": source_file, "input_hash": input_hash, "chunk_id": chunk_id, "record": record}
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def read_shards(shard_dir: Path, files: dict) -> dict:
+    """
+    Читает все шарды: source_file -> {chunk_id: record}. Записи для устаревшего входа
+    (другой input_hash) пропускаются. Нечитаемые строки тоже пропускаются с предупреждением:
+    потерянные так completed-чанки находит и возвращает в очередь merge_shards.
+    """
+    records = {name: {} for name in files}
+    for shard in sorted(Path(shard_dir).glob("*.jsonl")):
+        with shard.open("r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"{shard}:{line_no}: повреждённая строка пропущена.")
+                    continue
+                info = files.get(entry["source_file"])
+                if info and entry["input_hash"] == info["input_hash"]:
+                    records[entry["source_file"]].setdefault(entry["chunk_id"], entry["record"])
+    return records
+
+
+def merge_shards(work_queue: WorkQueue, shard_dir: Path, output_dir: Path, names: list = None) -> dict:
+    """
+    Собирает из шардов обычные <stem>_samples.jsonl (записи в порядке chunk_id, как ProgressJournal.finalize).
+    names — какие файлы собирать (по умолчанию все файлы очереди). Возвращает source_file -> число записей.
+
+    Если чанк в очереди completed, а его записи нет ни в одном шарде (строка повреждена, шард удалён),
+    файл не собирается: такие чанки возвращаются в очередь, и файл соберёт воркер, который их доразметит.
+    """
+    files = work_queue.files()
+    if names is not None:
+        files = {name: files[name] for name in names if name in files}
+    records = read_shards(shard_dir, files)
+    completed = work_queue.completed(list(files))
+    lost = {name: sorted(completed[name] - set(records[name])) for name in files}
+    lost = {name: chunk_ids for name, chunk_ids in lost.items() if chunk_ids}
+    if lost:
+        requeued = work_queue.requeue(lost)
+        for name, chunk_ids in lost.items():
+            print(f"{name}: нет записей для completed-чанков {chunk_ids} — возвращены в очередь, файл не собран.")
+        print(f"В очередь возвращено {requeued} чанков; запустите воркер, чтобы доразметить их.")
+    written = {}
+    for name, by_chunk in records.items():
+        if name in lost:
+            continue
+        out_file = Path(output_dir) / f"{Path(name).stem}_samples.jsonl"
+        lines = [json.dumps(by_chunk[chunk_id], ensure_ascii=False) + "\n" for chunk_id in sorted(by_chunk)]
+        atomic_write_text(out_file, "".join(lines))
+        work_queue.mark_merged(name)
+        written[name] = len(lines)
+        missing = files[name]["total_chunks"] - len(lines)
+        print(f"Собран {out_file}: {len(lines)} записей" + (f", без записи {missing} чанков" if missing else ""))
+    return written